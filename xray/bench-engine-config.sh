@@ -0,0 +1,75 @@
+#!/bin/bash
+# Замер генерации массива clients для engine.conf в зависимости от числа
+# пользователей: старый цикл с конкатенацией строк против generate_clients_json.
+#
+# Использование: bench-engine-config.sh [число пользователей ...]
+#   BENCH_LEGACY_MAX — до какого числа пользователей гонять старый цикл
+#                      (по умолчанию 1000, дальше он работает минутами)
+
+set -e
+script_dir="$(cd "$(dirname "$0")" && pwd)"
+counts=("$@")
+if [[ ${#counts[@]} -eq 0 ]]; then
+  counts=(100 1000 10000 50000)
+fi
+legacy_max="${BENCH_LEGACY_MAX:-1000}"
+
+declare -A config
+declare -A users
+declare -A disabled_users
+eval "$(sed -n '/^function generate_clients_json {/,/^}/p' "${script_dir}/reality-ezpz.py")"
+
+function legacy_clients_json {
+  local users_object=""
+  local user
+  for user in "${!users[@]}"; do
+    if [ -n "$users_object" ]; then
+      users_object="${users_object},"$'\n'
+    fi
+    if [[ ${config[protocol]} == 'hysteria2' ]]; then
+      users_object="${users_object}"'{"auth": "'"$(echo -n "${user}${users[${user}]}" | sha256sum | cut -d ' ' -f 1 | head -c 16)"'", "email": "'"${user}"'"}'
+    else
+      users_object="${users_object}"'{"id": "'"${users[${user}]}"'", "flow": "'"$([[ ${config[transport]} == 'tcp' ]] && echo 'xtls-rprx-vision' || true)"'", "email": "'"${user}"'"}'
+    fi
+  done
+  printf '%s' "${users_object}"
+}
+
+function fill_users {
+  local count=$1
+  local i
+  users=()
+  for ((i = 0; i < count; i++)); do
+    printf -v uuid '%08x-0000-4000-8000-%012x' "${i}" "${i}"
+    users["user${i}"]="${uuid}"
+  done
+}
+
+function elapsed_ms {
+  local start=$1
+  local end=$2
+  echo $(( (${end/./} - ${start/./}) / 1000 ))
+}
+
+printf '%-10s %-8s %12s %12s\n' "protocol" "users" "legacy, ms" "batched, ms"
+for protocol in vless hysteria2; do
+  config[protocol]="${protocol}"
+  config[transport]=tcp
+  for count in "${counts[@]}"; do
+    fill_users "${count}"
+    start=${EPOCHREALTIME}
+    batched=$(generate_clients_json)
+    batched_ms=$(elapsed_ms "${start}" "${EPOCHREALTIME}")
+    legacy_ms="-"
+    if (( count <= legacy_max )); then
+      start=${EPOCHREALTIME}
+      legacy=$(legacy_clients_json)
+      legacy_ms=$(elapsed_ms "${start}" "${EPOCHREALTIME}")
+      if [[ ${legacy} != "${batched}" ]]; then
+        echo "Вывод отличается от старого генератора (${protocol}, ${count})" >&2
+        exit 1
+      fi
+    fi
+    printf '%-10s %-8s %12s %12s\n' "${protocol}" "${count}" "${legacy_ms}" "${batched_ms}"
+  done
+done
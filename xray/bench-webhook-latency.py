@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Замер задержки "обновление пришло в Bot API -> вызван обработчик" для
+# режимов polling и webhook бота. Вместо api.telegram.org поднимается
+# локальный фейковый Bot API; сеть до Telegram по умолчанию в замер не входит
+# и добавляется через BENCH_RTT.
+#
+# Использование: bench-webhook-latency.py [число обновлений]
+#   BENCH_INTERVAL — пауза между обновлениями, сек (по умолчанию 0.02)
+#   BENCH_RTT      — имитируемый RTT до Telegram, мс (по умолчанию 0). При
+#                    polling обновление, пришедшее между двумя getUpdates,
+#                    ждёт повторного запроса; webhook доставляет его сразу.
+
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+TOKEN = '12345678:abcdefghijabcdefghijabcdefghijabcde'
+SECRET = 'bench-secret'
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+INTERVAL = float(os.environ.get('BENCH_INTERVAL', '0.02'))
+ONE_WAY = float(os.environ.get('BENCH_RTT', '0')) / 2000
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: getMe, getUpdates (long poll), set/deleteWebhook."""
+
+    def __init__(self):
+        self.updates = []
+        self.arrived = asyncio.Condition()
+        self.webhook = ''
+
+    async def push(self, update):
+        async with self.arrived:
+            self.updates.append(update)
+            self.arrived.notify_all()
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        async with self.arrived:
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self.updates)
+
+    async def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 12345678, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            return await self.get_updates(params)
+        if method == 'setWebhook':
+            self.webhook = params.get('url', '')
+            return True
+        if method == 'deleteWebhook':
+            self.webhook = ''
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook, 'has_custom_certificate': False, 'pending_update_count': 0}
+        return True
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                path = lines[0].split(' ')[1]
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+                await asyncio.sleep(ONE_WAY)
+                if headers.get('content-type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {}
+                    for key, value in parse_qsl(body.decode()):
+                        try:
+                            params[key] = json.loads(value)
+                        except ValueError:
+                            params[key] = value
+                result = await self.call(path.rsplit('/', 1)[-1], params)
+                await asyncio.sleep(ONE_WAY)
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'},
+            'text': 'ping'
+        }
+    }
+
+
+def build_app(api_port, sent, latencies, done):
+    async def handler(update, context):
+        latencies.append(time.perf_counter() - sent[update.update_id])
+        if len(latencies) == COUNT:
+            done.set()
+
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f'http://127.0.0.1:{api_port}/bot')
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, handler))
+    return app
+
+
+async def bench_polling(api, api_port):
+    sent, latencies, done = {}, [], asyncio.Event()
+    app = build_app(api_port, sent, latencies, done)
+    await app.initialize()
+    await app.start()
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await asyncio.sleep(0.2)
+    for i in range(1, COUNT + 1):
+        sent[i] = time.perf_counter()
+        await api.push(make_update(i))
+        await asyncio.sleep(INTERVAL)
+    await asyncio.wait_for(done.wait(), 30)
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    return latencies
+
+
+async def bench_webhook(api_port, hook_port):
+    sent, latencies, done = {}, [], asyncio.Event()
+    app = build_app(api_port, sent, latencies, done)
+    await app.initialize()
+    await app.start()
+    await app.updater.start_webhook(
+        listen='127.0.0.1',
+        port=hook_port,
+        url_path='hook',
+        webhook_url=f'http://127.0.0.1:{hook_port}/hook',
+        secret_token=SECRET
+    )
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+
+    async def deliver(client, update_id):
+        await asyncio.sleep(ONE_WAY)
+        response = await client.post(
+            f'http://127.0.0.1:{hook_port}/hook', json=make_update(update_id), headers=headers
+        )
+        response.raise_for_status()
+
+    # Telegram держит соединение к webhook открытым, как и httpx здесь
+    async with httpx.AsyncClient() as client:
+        deliveries = []
+        for i in range(1, COUNT + 1):
+            sent[i] = time.perf_counter()
+            deliveries.append(asyncio.create_task(deliver(client, i)))
+            await asyncio.sleep(INTERVAL)
+        await asyncio.gather(*deliveries)
+    await asyncio.wait_for(done.wait(), 30)
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    return latencies
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def report(name, latencies):
+    ms = sorted(x * 1000 for x in latencies)
+    p95 = ms[max(0, int(len(ms) * 0.95) - 1)]
+    print(f'{name:<10} {len(ms):>8} {statistics.median(ms):>12.2f} {p95:>12.2f} {ms[-1]:>12.2f}')
+
+
+async def main():
+    api = FakeBotAPI()
+    server = await asyncio.start_server(api.serve, '127.0.0.1', 0)
+    api_port = server.sockets[0].getsockname()[1]
+    print(f'{"mode":<10} {"updates":>8} {"median, ms":>12} {"p95, ms":>12} {"max, ms":>12}')
+    report('polling', await bench_polling(api, api_port))
+    report('webhook', await bench_webhook(api_port, free_port()))
+    server.close()
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -6,6 +6,12 @@ declare -A config_file
 declare -A args
 declare -A config
 declare -A users
+# config и users в том виде, в каком их прочитал (или записал) этот запуск:
+# при записи меняются только ключи и пользователи, которые он изменил
+declare -A config_read
+declare -A users_read
+# Пользователи, которых нет в engine: имя -> OFF | quota | expired
+declare -A disabled_users
 declare -A path
 declare -A service
 declare -A md5
@@ -14,6 +20,10 @@ declare -A image
 
 # Путь к данным инстанса — переопределяется через REALITY_CONFIG_PATH для мульти-инстанс
 config_path="${REALITY_CONFIG_PATH:-/opt/reality-ezpz}"
+# Сколько секунд доверять закешированным публичным IPv4/IPv6 адресам
+address_ttl="${REALITY_ADDRESS_TTL:-21600}"
+# Сколько секунд доверять пустому ответу (адреса нет или запрос не прошёл)
+address_negative_ttl="${REALITY_ADDRESS_NEGATIVE_TTL:-300}"
 # Имя инстанса = последний компонент пути
 # /opt/reality-ezpz          -> instance_name=reality-ezpz  (совместимо со старым!)
 # /opt/reality-ezpz-instances/main -> instance_name=main
@@ -42,6 +52,8 @@ image[certbot]="certbot/certbot:latest"
 image[haproxy]="haproxy:latest"
 image[python]="python:3.12-alpine"
 image[wgcf]="virb3/wgcf:latest"
+# gRPC API ядра — слушает только loopback внутри контейнера engine
+engine_api_port=10085
 
 defaults[protocol]=vless
 defaults[transport]=tcp
@@ -58,10 +70,19 @@ defaults[warp_interface_ipv4]=""
 defaults[warp_interface_ipv6]=""
 defaults[core]=xray
 defaults[security]=reality
-defaults[server]=$(curl -fsSL --ipv4 https://cloudflare.com/cdn-cgi/trace | grep ip | cut -d '=' -f2)
+# Определяется лениво (resolve_default_server), только когда сервер не задан
+defaults[server]=""
 defaults[tgbot]=OFF
 defaults[tgbot_token]=""
 defaults[tgbot_admins]=""
+defaults[tgbot_webhook]=OFF
+defaults[tgbot_webhook_path]=""
+defaults[tgbot_webhook_secret]=""
+defaults[tgbot_subscription]=OFF
+defaults[tgbot_subscription_path]=""
+defaults[tgbot_subscription_secret]=""
+# Порт /metrics бота на 127.0.0.1 хоста; 0 — метрики выключены
+defaults[tgbot_metrics_port]=0
 defaults[host_header]=""
 
 config_items=(
@@ -89,12 +110,20 @@ config_items=(
   "tgbot"
   "tgbot_token"
   "tgbot_admins"
+  "tgbot_webhook"
+  "tgbot_webhook_path"
+  "tgbot_webhook_secret"
+  "tgbot_subscription"
+  "tgbot_subscription_path"
+  "tgbot_subscription_secret"
+  "tgbot_metrics_port"
 )
 
 regex[domain]="^[a-zA-Z0-9]+([-.][a-zA-Z0-9]+)*\.[a-zA-Z]{2,}$"
 regex[port]="^[1-9][0-9]*$"
 regex[warp_license]="^[a-zA-Z0-9]{8}-[a-zA-Z0-9]{8}-[a-zA-Z0-9]{8}$"
 regex[username]="^[a-zA-Z0-9]+$"
+regex[uuid]="^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$"
 regex[ip]="^([0-9]{1,3}\.){3}[0-9]{1,3}$"
 regex[tgbot_token]="^[0-9]{8,10}:[a-zA-Z0-9_-]{35}$"
 regex[tgbot_admins]="^[a-zA-Z][a-zA-Z0-9_]{4,31}(,[a-zA-Z][a-zA-Z0-9_]{4,31})*$"
@@ -108,7 +137,7 @@ function show_help {
   echo "Использование: reality-ezpz.sh [--protocol=vless|hysteria2] [-t|--transport=tcp|http|xhttp|grpc|ws] [-d|--domain=<домен>] [--server=<сервер>] [--regenerate] [--default]
   [-r|--restart] [--enable-safenet=true|false] [--port=<порт>] [-c|--core=xray] [--enable-warp=true|false]
   [--warp-license=<лицензия>] [--security=reality|letsencrypt|selfsigned|notls] [-m|--menu] [--show-server-config] [--add-user=<имя>] [--lists-users]
-  [--show-user=<имя>] [--delete-user=<имя>] [--backup] [--restore=<url|файл>] [--backup-password=<пароль>] [-u|--uninstall]
+  [--show-user=<имя>] [--user-stats] [--online] [--delete-user=<имя>] [--add-users-from=<файл>] [--delete-users-from=<файл>] [--export-links=<файл>] [--backup] [--restore=<url|файл>] [--backup-password=<пароль>] [-u|--uninstall]
   [--path=<путь>] [--host=<хост>]"
   echo ""
   echo "      --protocol <vless|hysteria2>  Протокол (по умолчанию: ${defaults[protocol]})
@@ -131,11 +160,19 @@ function show_help {
   echo "      --enable-tgbot <true|false> Включить Telegram бота для управления"
   echo "      --tgbot-token <токен>  Токен Telegram бота"
   echo "      --tgbot-admins <юзернейм> Юзернеймы админов бота (через запятую, без символа '@')"
+  echo "      --enable-tgbot-webhook <true|false> Получать обновления бота через webhook за haproxy вместо polling"
+  echo "      --enable-subscription <true|false> Раздавать подписки пользователей через бота за haproxy"
+  echo "      --tgbot-metrics-port <порт> Отдавать метрики бота (Prometheus) на 127.0.0.1:<порт>/metrics хоста (и контейнерам в сетях бота), 0 — выключить"
   echo "      --show-server-config   Показать конфигурацию сервера"
   echo "      --add-user <имя>       Добавить нового пользователя"
   echo "      --list-users           Список всех пользователей"
+  echo "      --user-stats           Трафик пользователей (собирает Telegram бот)"
+  echo "      --online               Подключения и IP пользователей сейчас (собирает Telegram бот)"
   echo "      --show-user <имя>      Показать конфиг и QR код пользователя"
   echo "      --delete-user <имя>    Удалить пользователя"
+  echo "      --add-users-from <файл> Добавить пользователей из файла (имя[,uuid] в строке, CSV/TXT)"
+  echo "      --delete-users-from <файл> Удалить пользователей, перечисленных в файле"
+  echo "      --export-links <файл>  Сохранить ссылки всех пользователей в файл"
   echo "      --backup               Создать резервную копию и загрузить на temp.sh"
   echo "      --restore <url|файл>   Восстановить из резервной копии (URL или путь к файлу)"
   echo "      --backup-password <пароль> Создать/Восстановить защищенный паролем бэкап"
@@ -145,7 +182,7 @@ function show_help {
 
 function parse_args {
   local opts
-  opts=$(getopt -o t:d:ruc:mh --long protocol:,transport:,domain:,server:,path:,host:,regenerate,default,restart,uninstall,enable-safenet:,port:,warp-license:,enable-warp:,core:,security:,menu,show-server-config,add-user:,list-users,show-user:,delete-user:,backup,restore:,backup-password:,enable-tgbot:,tgbot-token:,tgbot-admins:,help -- "$@")
+  opts=$(getopt -o t:d:ruc:mh --long protocol:,transport:,domain:,server:,path:,host:,regenerate,default,restart,uninstall,enable-safenet:,port:,warp-license:,enable-warp:,core:,security:,menu,show-server-config,add-user:,list-users,user-stats,online,show-user:,delete-user:,add-users-from:,delete-users-from:,export-links:,backup,restore:,backup-password:,enable-tgbot:,tgbot-token:,tgbot-admins:,enable-tgbot-webhook:,enable-subscription:,tgbot-metrics-port:,help -- "$@")
   if [[ $? -ne 0 ]]; then
     return 1
   fi
@@ -301,6 +338,41 @@ function parse_args {
             ;;
         esac
         ;;
+      --enable-tgbot-webhook)
+        case "$2" in
+          true|false)
+            $2 && args[tgbot_webhook]=ON || args[tgbot_webhook]=OFF
+            shift 2
+            ;;
+          *)
+            echo "Неверная опция enable-tgbot-webhook: $2"
+            return 1
+            ;;
+        esac
+        ;;
+      --enable-subscription)
+        case "$2" in
+          true|false)
+            $2 && args[tgbot_subscription]=ON || args[tgbot_subscription]=OFF
+            shift 2
+            ;;
+          *)
+            echo "Неверная опция enable-subscription: $2"
+            return 1
+            ;;
+        esac
+        ;;
+      --tgbot-metrics-port)
+        args[tgbot_metrics_port]="$2"
+        if [[ ${args[tgbot_metrics_port]} != '0' ]] && ! [[ ${args[tgbot_metrics_port]} =~ ${regex[port]} ]]; then
+          echo "Неверный порт метрик бота: ${args[tgbot_metrics_port]}"
+          return 1
+        elif ((args[tgbot_metrics_port] > 65535)); then
+          echo "Порт вне диапазона: ${args[tgbot_metrics_port]}"
+          return 1
+        fi
+        shift 2
+        ;;
       --tgbot-token)
         args[tgbot_token]="$2"
         if [[ ! ${args[tgbot_token]} =~ ${regex[tgbot_token]} ]]; then
@@ -337,6 +409,14 @@ function parse_args {
         args[list_users]=true
         shift
         ;;
+      --user-stats)
+        args[user_stats]=true
+        shift
+        ;;
+      --online)
+        args[online]=true
+        shift
+        ;;
       --show-user)
         args[show_config]="$2"
         shift 2
@@ -345,6 +425,22 @@ function parse_args {
         args[delete_user]="$2"
         shift 2
         ;;
+      --add-users-from|--delete-users-from)
+        if [[ ! -r $2 ]]; then
+          echo "Файл не найден: $2"
+          return 1
+        fi
+        args[${1:2}]="$2"
+        shift 2
+        ;;
+      --export-links)
+        args[export_links]="$2"
+        if [[ ! ${args[export_links]} =~ ${regex[file_path]} ]]; then
+          echo "Ошибка: Неверный путь к файлу: ${args[export_links]}"
+          return 1
+        fi
+        shift 2
+        ;;
       --backup)
         args[backup]=true
         shift
@@ -478,17 +574,17 @@ function dict_expander {
 }
 
 function parse_config_file {
+  config_read=()
   if [[ ! -r "${path[config]}" ]]; then
     generate_keys
     return 0
   fi
-  while IFS= read -r line; do
-    if [[ "${line}" =~ ^\s*# ]] || [[ "${line}" =~ ^\s*$ ]]; then
+  while IFS= read -r line || [[ -n ${line} ]]; do
+    if [[ "${line}" =~ ^\s*# ]] || [[ "${line}" =~ ^\s*$ ]] || [[ ${line} != *=* ]]; then
       continue
     fi
-    key=$(echo "$line" | cut -d "=" -f 1)
-    value=$(echo "$line" | cut -d "=" -f 2-)
-    config_file["${key}"]="${value}"
+    config_file["${line%%=*}"]="${line#*=}"
+    config_read["${line%%=*}"]="${line#*=}"
   done < "${path[config]}"
   if [[ -z "${config_file[public_key]}" || \
         -z "${config_file[private_key]}" || \
@@ -502,15 +598,45 @@ function parse_config_file {
   return 0
 }
 
+# Ограничения пользователей, строка на пользователя:
+# "имя квота срок состояние [устройства]". Квота — байт за календарный месяц,
+# срок — unix time окончания, устройства — число одновременных IP (0 — без
+# ограничения). Состояние: ON, OFF (выключен вручную), quota, expired или
+# devices (выключен ботом). В engine попадают только включённые с неистёкшим
+# сроком; квоту и устройства проверяет бот.
+function parse_users_meta {
+  local name
+  local quota
+  local expires
+  local state
+  local now
+  disabled_users=()
+  if [[ ! -r ${path[users_meta]} ]]; then
+    return 0
+  fi
+  now=$(date +%s)
+  while read -r name quota expires state _ || [[ -n ${name} ]]; do
+    if [[ -z ${name} || ${name} == \#* || -z ${users[${name}]} ]]; then
+      continue
+    fi
+    if [[ ${state:-ON} != 'ON' ]]; then
+      disabled_users["${name}"]="${state}"
+    elif [[ ${expires} =~ ^[0-9]+$ ]] && ((expires > 0 && expires <= now)); then
+      disabled_users["${name}"]=expired
+    fi
+  done < "${path[users_meta]}"
+}
+
 function parse_users_file {
   mkdir -p "$config_path"
   touch "${path[users]}"
-  while read -r line; do
+  while read -r line || [[ -n ${line} ]]; do
     if [[ "${line}" =~ ^\s*# ]] || [[ "${line}" =~ ^\s*$ ]]; then
       continue
     fi
     IFS="=" read -r key value <<< "${line}"
     users["${key}"]="${value}"
+    users_read["${key}"]="${value}"
   done < "${path[users]}"
   if [[ -n ${args[add_user]} ]]; then
     if [[ -z "${users["${args[add_user]}"]}" ]]; then
@@ -531,6 +657,12 @@ function parse_users_file {
       exit 1
     fi
   fi
+  if [[ -n ${args[add-users-from]} ]]; then
+    add_users_from_file "${args[add-users-from]}"
+  fi
+  if [[ -n ${args[delete-users-from]} ]]; then
+    delete_users_from_file "${args[delete-users-from]}"
+  fi
   if [[ ${#users[@]} -eq 0 ]]; then
     users[RealityEZPZ]=$(cat /proc/sys/kernel/random/uuid)
     echo "RealityEZPZ=${users[RealityEZPZ]}" >> "${path[users]}"
@@ -539,6 +671,89 @@ function parse_users_file {
   return 0
 }
 
+# Файл со списком пользователей: одно имя в строке, через запятую, точку
+# с запятой, '=' или пробел может идти uuid (так подходят и CSV, и файл
+# users). Пустые строки, комментарии и заголовок name/user пропускаются.
+# Результат — в user_list (имя -> uuid или пусто), число плохих строк —
+# в user_list_invalid.
+function read_user_list_file {
+  local file=$1
+  local line
+  local name
+  local rest
+  local first=true
+  user_list=()
+  user_list_invalid=0
+  while IFS= read -r line || [[ -n ${line} ]]; do
+    line="${line%%#*}"
+    line="${line//$'\r'/}"
+    line="${line#"${line%%[![:space:]]*}"}"
+    if [[ -z ${line} ]]; then
+      continue
+    fi
+    name="${line%%[,;=[:space:]]*}"
+    rest="${line#"${name}"}"
+    rest="${rest#[,;=[:space:]]}"
+    rest="${rest#"${rest%%[![:space:]]*}"}"
+    if [[ ${first} == true ]]; then
+      first=false
+      if [[ ${name,,} =~ ^(name|user|username|имя)$ ]]; then
+        continue
+      fi
+    fi
+    if ! [[ ${name} =~ ${regex[username]} ]]; then
+      user_list_invalid=$((user_list_invalid + 1))
+      continue
+    fi
+    user_list["${name}"]="${rest%%[,;=[:space:]]*}"
+  done < "${file}"
+}
+
+function add_users_from_file {
+  local name
+  local uuid
+  local added=0
+  local existing=0
+  local -A user_list
+  read_user_list_file "$1"
+  for name in "${!user_list[@]}"; do
+    if [[ -n ${users["${name}"]} ]]; then
+      existing=$((existing + 1))
+      continue
+    fi
+    uuid="${user_list["${name}"]}"
+    if ! [[ ${uuid} =~ ${regex[uuid]} ]]; then
+      read -r uuid < /proc/sys/kernel/random/uuid
+    fi
+    users["${name}"]="${uuid}"
+    added=$((added + 1))
+  done
+  echo "Импорт из $1: добавлено ${added}, уже существовали ${existing}, пропущено строк ${user_list_invalid}."
+}
+
+function delete_users_from_file {
+  local name
+  local deleted=()
+  local missing=0
+  local -A user_list
+  read_user_list_file "$1"
+  for name in "${!user_list[@]}"; do
+    if [[ -n ${users["${name}"]} ]]; then
+      deleted+=("${name}")
+    else
+      missing=$((missing + 1))
+    fi
+  done
+  if [[ ${#deleted[@]} -ge ${#users[@]} ]]; then
+    echo -e "Нельзя удалить всех пользователей.\nНеобходим минимум один пользователь."
+    exit 1
+  fi
+  for name in "${deleted[@]}"; do
+    unset users["${name}"]
+  done
+  echo "Удаление по $1: удалено ${#deleted[@]}, не найдено ${missing}, пропущено строк ${user_list_invalid}."
+}
+
 function restore_defaults {
   local defaults_items=("${!defaults[@]}")
   local keep=false
@@ -549,6 +764,7 @@ function restore_defaults {
   if [[ -n ${config[warp_id]} && -n ${config[warp_token]} ]]; then
     warp_delete_account "${config[warp_id]}" "${config[warp_token]}"
   fi
+  resolve_default_server
   for item in "${defaults_items[@]}"; do
     keep=false
     for i in "${exclude_list[@]}"; do
@@ -569,6 +785,9 @@ function build_config {
   if [[ ${args[regenerate]} == true ]]; then
     generate_keys
   fi
+  if [[ -z ${args[server]} && -z ${config_file[server]} ]]; then
+    resolve_default_server
+  fi
   for item in "${config_items[@]}"; do
     if [[ -n ${args["${item}"]} ]]; then
       config["${item}"]="${args[${item}]}"
@@ -590,6 +809,28 @@ function build_config {
     echo 'Чтобы включить Telegram бота, вы должны указать список авторизованных админов с помощью опции --tgbot-admins.'
     exit 1
   fi
+  if [[ ${config[tgbot]} == 'ON' && ${config[tgbot_webhook]} == 'ON' ]]; then
+    if [[ -z ${config[tgbot_webhook_path]} ]]; then
+      config[tgbot_webhook_path]=$(openssl rand -hex 8)
+    fi
+    if [[ -z ${config[tgbot_webhook_secret]} ]]; then
+      config[tgbot_webhook_secret]=$(openssl rand -hex 16)
+    fi
+    if ! tgbot_webhook_enabled; then
+      echo 'Webhook бота работает только за haproxy (security letsencrypt/selfsigned, транспорт не tcp) на порту 443, 88 или 8443 — бот использует polling.'
+    fi
+  fi
+  if [[ ${config[tgbot]} == 'ON' && ${config[tgbot_subscription]} == 'ON' ]]; then
+    if [[ -z ${config[tgbot_subscription_path]} ]]; then
+      config[tgbot_subscription_path]=$(openssl rand -hex 8)
+    fi
+    if [[ -z ${config[tgbot_subscription_secret]} ]]; then
+      config[tgbot_subscription_secret]=$(openssl rand -hex 32)
+    fi
+    if ! tgbot_subscription_enabled; then
+      echo 'Подписки работают только за haproxy (security letsencrypt/selfsigned, транспорт не tcp, протокол vless) — подписки выключены.'
+    fi
+  fi
   if [[ ! ${config[server]} =~ ${regex[domain]} && ${config[security]} == 'letsencrypt' ]]; then
     echo 'Вы должны назначить домен серверу с помощью опции "--server <domain>", если хотите использовать "letsencrypt".'
     exit 1
@@ -659,24 +900,112 @@ function build_config {
   fi
 }
 
+# Оба файла пишутся за один проход во временный файл и подменяются через
+# rename: прерванный запуск никогда не оставит config или users наполовину.
+# config и users пишет и бот (ConfigTransaction в tgbot.py), в том числе
+# пока этот запуск работает со своей прочитанной копией. Поэтому под общей
+# advisory-блокировкой на ${path[lock]} файл перечитывается и в него
+# вносятся только изменения этого запуска (относительно config_read и
+# users_read); чужие изменения попадают в config/users и в генерируемые файлы.
+# Без блокировки запуск ничего не пишет и завершается с ошибкой.
+function lock_config_files {
+  exec {config_lock_fd}>>"${path[lock]}"
+  if which flock >/dev/null 2>&1; then
+    if ! flock -w 30 "${config_lock_fd}"; then
+      echo "Не удалось дождаться блокировки ${path[lock]}, файлы не изменены." >&2
+      exit 1
+    fi
+  fi
+}
+
+function unlock_config_files {
+  exec {config_lock_fd}>&-
+}
+
 function update_config_file {
+  local line
+  local key
+  local item
+  local temp_file
+  local -A managed
+  local -A written
   mkdir -p "${config_path}"
-  touch "${path[config]}"
   for item in "${config_items[@]}"; do
-    if grep -q "^${item}=" "${path[config]}"; then
-      sed -i "s|^${item}=.*|${item}=${config[${item}]}|" "${path[config]}"
-    else
-      echo "${item}=${config[${item}]}" >> "${path[config]}"
+    managed["${item}"]=1
+  done
+  lock_config_files
+  temp_file="${path[config]}.$$"
+  {
+    if [[ -r ${path[config]} ]]; then
+      while IFS= read -r line || [[ -n ${line} ]]; do
+        key="${line%%=*}"
+        if [[ ${line} == *=* && -n ${key} && -n ${managed["${key}"]} ]]; then
+          if [[ ${config[${key}]} == "${config_read[${key}]}" ]]; then
+            config["${key}"]="${line#*=}"
+          fi
+          printf '%s=%s\n' "${key}" "${config[${key}]}"
+          written["${key}"]=1
+        else
+          printf '%s\n' "${line}"
+        fi
+      done < "${path[config]}"
     fi
+    for item in "${config_items[@]}"; do
+      if [[ -z ${written[${item}]} ]]; then
+        printf '%s=%s\n' "${item}" "${config[${item}]}"
+      fi
+    done
+  } > "${temp_file}"
+  sync "${temp_file}" 2>/dev/null || true
+  mv -f "${temp_file}" "${path[config]}"
+  unlock_config_files
+  for item in "${config_items[@]}"; do
+    config_read["${item}"]="${config[${item}]}"
   done
   check_reload
 }
 
 function update_users_file {
-  rm -f "${path[users]}"
+  local user
+  local line
+  local key
+  local value
+  local temp_file
+  local -A current=()
+  mkdir -p "${config_path}"
+  lock_config_files
+  if [[ -r ${path[users]} ]]; then
+    while read -r line || [[ -n ${line} ]]; do
+      if [[ "${line}" =~ ^\s*# ]] || [[ "${line}" =~ ^\s*$ ]]; then
+        continue
+      fi
+      IFS="=" read -r key value <<< "${line}"
+      current["${key}"]="${value}"
+    done < "${path[users]}"
+  fi
+  for user in "${!users_read[@]}"; do
+    if [[ -z ${users[${user}]} ]]; then
+      unset 'current[${user}]'
+    fi
+  done
   for user in "${!users[@]}"; do
-    echo "${user}=${users[${user}]}" >> "${path[users]}"
+    if [[ ${users[${user}]} != "${users_read[${user}]}" ]]; then
+      current["${user}"]="${users[${user}]}"
+    fi
   done
+  users=()
+  users_read=()
+  for user in "${!current[@]}"; do
+    users["${user}"]="${current[${user}]}"
+    users_read["${user}"]="${current[${user}]}"
+  done
+  temp_file="${path[users]}.$$"
+  for user in "${!users[@]}"; do
+    printf '%s=%s\n' "${user}" "${users[${user}]}"
+  done > "${temp_file}"
+  sync "${temp_file}" 2>/dev/null || true
+  mv -f "${temp_file}" "${path[users]}"
+  unlock_config_files
   check_reload
 }
 
@@ -708,16 +1037,16 @@ function install_packages {
   if [[ -n $BOT_TOKEN ]]; then 
     return 0
   fi
-  if ! which qrencode whiptail jq xxd zip unzip >/dev/null 2>&1; then
+  if ! which qrencode whiptail jq xxd zip unzip python3 >/dev/null 2>&1; then
     if which apt >/dev/null 2>&1; then
       apt update
-      DEBIAN_FRONTEND=noninteractive apt install qrencode whiptail jq xxd zip unzip -y
+      DEBIAN_FRONTEND=noninteractive apt install qrencode whiptail jq xxd zip unzip python3 python3-yaml -y
       return 0
     fi
     if which yum >/dev/null 2>&1; then
       yum makecache
       yum install epel-release -y || true
-      yum install qrencode newt jq vim-common zip unzip -y
+      yum install qrencode newt jq vim-common zip unzip python3 python3-pyyaml -y
       return 0
     fi
     echo "ОС не поддерживается!"
@@ -853,6 +1182,33 @@ fi)
 EOF
 }
 
+# Webhook бота: Telegram -> haproxy (TLS, секретный путь) -> tgbot:8088.
+# Нужен haproxy в режиме http, а Telegram шлёт webhook только на 443/80/88/8443
+# (80 — без TLS, не подходит). Иначе бот остаётся на polling.
+tgbot_webhook_port=8088
+
+function tgbot_webhook_enabled {
+  [[ ${config[tgbot]} == 'ON' && ${config[tgbot_webhook]} == 'ON' ]] || return 1
+  [[ ${config[security]} == 'letsencrypt' || ${config[security]} == 'selfsigned' ]] || return 1
+  [[ ${config[protocol]} != 'hysteria2' && ${config[transport]} != 'tcp' ]] || return 1
+  [[ ${config[port]} =~ ^(443|88|8443)$ ]]
+}
+
+# Подписки: клиент -> haproxy (TLS, секретный путь) -> tgbot:8089. Ответы
+# бот собирает заранее и отдаёт из памяти с ETag.
+tgbot_subscription_port=8089
+
+function tgbot_subscription_enabled {
+  [[ ${config[tgbot]} == 'ON' && ${config[tgbot_subscription]} == 'ON' ]] || return 1
+  [[ ${config[security]} == 'letsencrypt' || ${config[security]} == 'selfsigned' ]] || return 1
+  [[ ${config[protocol]} != 'hysteria2' && ${config[transport]} != 'tcp' ]]
+}
+
+# haproxy ходит к боту по общей сети reality
+function tgbot_behind_haproxy {
+  tgbot_webhook_enabled || tgbot_subscription_enabled
+}
+
 function generate_tgbot_compose {
   cat >"${path[tgbot_compose]}" <<EOF
 networks:
@@ -862,6 +1218,11 @@ networks:
     ipam:
       config:
       - subnet: ${subnet_tgbot}
+$(if tgbot_behind_haproxy; then echo "
+  reality:
+    external: true
+    name: ${compose_project}_reality
+" | grep -vE '^\s*$'; fi)
 services:
   tgbot:
     build: ./
@@ -869,12 +1230,37 @@ services:
     environment:
       BOT_TOKEN: ${config[tgbot_token]}
       BOT_ADMIN: ${config[tgbot_admins]}
+      BOT_COMPOSE_PROJECT: ${compose_project}
+$(if [[ ${config[tgbot_metrics_port]} != '0' ]]; then echo "
+      BOT_METRICS_PORT: ${config[tgbot_metrics_port]}
+      # Внутри контейнера — на всех интерфейсах, иначе проброс порта до
+      # /metrics не дойдёт. Снаружи он опубликован только на 127.0.0.1 хоста,
+      # но /metrics доступен и контейнерам сетей tgbot и reality (haproxy, engine)
+      BOT_METRICS_LISTEN: 0.0.0.0
+" | grep -vE '^\s*$'; fi)
+$(if tgbot_webhook_enabled; then echo "
+      BOT_WEBHOOK_URL: https://${config[server]}:${config[port]}/${config[tgbot_webhook_path]}
+      BOT_WEBHOOK_SECRET: ${config[tgbot_webhook_secret]}
+      BOT_WEBHOOK_PORT: ${tgbot_webhook_port}
+$([[ ${config[security]} == 'selfsigned' ]] && echo "      BOT_WEBHOOK_CERT: /opt/reality-ezpz/${path[server_crt]#${config_path}/}" || true)
+" | grep -vE '^\s*$'; fi)
+$(if tgbot_subscription_enabled; then echo "
+      BOT_SUB_URL: https://${config[server]}:${config[port]}/${config[tgbot_subscription_path]}
+      BOT_SUB_SECRET: ${config[tgbot_subscription_secret]}
+      BOT_SUB_PORT: ${tgbot_subscription_port}
+" | grep -vE '^\s*$'; fi)
     volumes:
     - /var/run/docker.sock:/var/run/docker.sock
     - ..:/opt/reality-ezpz
     - /etc/docker/:/etc/docker/
+$([[ -r /etc/machine-id ]] && echo "    - /etc/machine-id:/etc/machine-id:ro" || true)
+$(if [[ ${config[tgbot_metrics_port]} != '0' ]]; then echo "
+    ports:
+    - 127.0.0.1:${config[tgbot_metrics_port]}:${config[tgbot_metrics_port]}
+" | grep -vE '^\s*$'; fi)
     networks:
     - tgbot
+$(if tgbot_behind_haproxy; then echo "    - reality"; fi)
 EOF
 }
 
@@ -882,6 +1268,11 @@ function generate_haproxy_config {
 echo "
 global
   ssl-default-bind-options ssl-min-ver TLSv1.2
+$(if tgbot_behind_haproxy; then echo "
+resolvers docker
+  nameserver dns 127.0.0.11:53
+  hold valid 10s
+"; fi)
 defaults
   option http-server-close
   timeout connect 5s
@@ -909,9 +1300,13 @@ $(if [[ ${config[transport]} != 'tcp' ]]; then echo "
 $(if [[ ${config[security]} == 'letsencrypt' ]]; then echo "
   use_backend certbot if { path_beg /.well-known/acme-challenge }
 "; fi)
-echo "
+$(if tgbot_webhook_enabled; then echo "
+  use_backend tgbot if { path_beg /${config[tgbot_webhook_path]} }
+"; fi)
+$(if tgbot_subscription_enabled; then echo "
+  use_backend tgbot_sub if { path_beg /${config[tgbot_subscription_path]}/ }
+"; fi)
   use_backend engine if { path_beg /${config[service_path]} }
-")
   use_backend default
 "; else echo "
   bind :::8443 v4v6
@@ -939,6 +1334,16 @@ backend certbot
   mode http
   server certbot certbot:80
 "; fi)
+$(if tgbot_webhook_enabled; then echo "
+backend tgbot
+  mode http
+  server tgbot tgbot:${tgbot_webhook_port} resolvers docker init-addr last,libc,none
+"; fi)
+$(if tgbot_subscription_enabled; then echo "
+backend tgbot_sub
+  mode http
+  server tgbot tgbot:${tgbot_subscription_port} resolvers docker init-addr last,libc,none
+"; fi)
 backend default
   mode http
   server nginx nginx:80
@@ -1018,7 +1423,7 @@ function generate_tgbot_dockerfile {
 FROM ${image[python]}
 WORKDIR /opt/reality-ezpz/tgbot
 RUN apk add --no-cache docker-cli-compose curl bash newt libqrencode-tools sudo openssl jq zip unzip
-RUN pip install --no-cache-dir python-telegram-bot==22.3 qrcode[pil]==8.2
+RUN pip install --no-cache-dir python-telegram-bot[webhooks]==22.3 qrcode[pil]==8.2 pyyaml==6.0.2
 CMD [ "python", "./tgbot.py" ]
 EOF
 }
@@ -1035,6 +1440,39 @@ function generate_selfsigned_certificate {
   rm -f /tmp/server.csr
 }
 
+# Элементы массива clients для inbound. Все пользователи обрабатываются одним
+# процессом python3 (ставится в install_packages), хеши hysteria2 считаются за
+# тот же проход: время линейно по числу пользователей, без форка на каждого.
+function generate_clients_json {
+  local user
+  local flow=""
+  if ! command -v python3 >/dev/null 2>&1; then
+    echo "Для генерации конфигурации нужен python3." >&2
+    return 1
+  fi
+  if [[ ${config[protocol]} != 'hysteria2' && ${config[transport]} == 'tcp' ]]; then
+    flow='xtls-rprx-vision'
+  fi
+  for user in "${!users[@]}"; do
+    if [[ -n ${disabled_users[${user}]} ]]; then
+      continue
+    fi
+    printf '%s\t%s\n' "${user}" "${users[${user}]}"
+  done | python3 -c '
+import hashlib, json, sys
+protocol, flow = sys.argv[1], sys.argv[2]
+clients = []
+for line in sys.stdin:
+    name, uuid = line.rstrip("\n").split("\t", 1)
+    if protocol == "hysteria2":
+        auth = hashlib.sha256((name + uuid).encode()).hexdigest()[:16]
+        clients.append(json.dumps({"auth": auth, "email": name}))
+    else:
+        clients.append(json.dumps({"id": uuid, "flow": flow, "email": name}))
+sys.stdout.write(",\n".join(clients))
+' "${config[protocol]}" "${flow}"
+}
+
 function generate_engine_config {
   local users_object=""
   local reality_object=""
@@ -1042,6 +1480,10 @@ function generate_engine_config {
   local warp_object=""
   local reality_port=443
   local temp_file
+  local api_object
+  local api_inbound
+  local api_rule
+  local policy_object
 
   if [[ ${config[security]} == 'reality' && ${config[domain]} =~ ":" ]]; then
     reality_port="${config[domain]#*:}"
@@ -1053,11 +1495,22 @@ function generate_engine_config {
       "dest": "'"${config[domain]%%:*}"':'"${reality_port}"'",
       "xver": 0,
       "serverNames": ["'"${config[domain]%%:*}"'"],
-      "privateKey": "'"${config[private_key]}'"',
+      "privateKey": "'"${config[private_key]}"'",
       "maxTimeDiff": 60000,
-      "shortIds": ["'"${config[short_id]}'"']
+      "shortIds": ["'"${config[short_id]}"'"]
     }'
 
+  # Через API --add-user / --delete-user применяются без перезапуска engine,
+  # а бот снимает счётчики трафика (StatsService, пользователи помечены email)
+  api_object='"api": {"tag": "api", "services": ["HandlerService", "StatsService"]},
+  "stats": {},'
+  api_inbound='{"listen": "127.0.0.1", "port": '"${engine_api_port}"', "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}, "tag": "api"},'
+  api_rule='{"type": "field", "inboundTag": ["api"], "outboundTag": "api"},'
+  policy_object='"policy": {
+    "levels": {"0": {"handshake": 2, "connIdle": 120, "statsUserUplink": true, "statsUserDownlink": true, "statsUserOnline": true}},
+    "system": {"statsInboundUplink": true, "statsInboundDownlink": true, "statsOutboundUplink": true, "statsOutboundDownlink": true}
+  }'
+
   tls_object='"security": "tls",
     "tlsSettings": {
       "certificates": [{
@@ -1072,10 +1525,10 @@ function generate_engine_config {
         "protocol": "wireguard",
         "tag": "warp",
         "settings": {
-          "secretKey": "'"${config[warp_private_key]}'"',
+          "secretKey": "'"${config[warp_private_key]}"'",
           "address": [
-            "'"${config[warp_interface_ipv4]}'"'/32",
-            "'"${config[warp_interface_ipv6]}'"'/128"
+            "'"${config[warp_interface_ipv4]}"'/32",
+            "'"${config[warp_interface_ipv6]}"'/128"
           ],
           "peers": [{
             "endpoint": "engage.cloudflareclient.com:2408",
@@ -1092,12 +1545,7 @@ function generate_engine_config {
   #   protocol="hysteria", network="hysteria", alpn=["h3"]
   # ─────────────────────────────────────────────────────────────
   if [[ ${config[protocol]} == 'hysteria2' ]]; then
-    for user in "${!users[@]}"; do
-      if [ -n "$users_object" ]; then
-        users_object="${users_object},"$'\n'
-      fi
-      users_object="${users_object}"'{"auth": "'"$(echo -n "${user}${users[${user}]}" | sha256sum | cut -d ' ' -f 1 | head -c 16)"'", "email": "'"${user}"'"}'
-    done
+    users_object=$(generate_clients_json)
 
     local hy2_tls_block
     if [[ ${config[security]} == 'notls' ]]; then
@@ -1121,7 +1569,10 @@ function generate_engine_config {
   "dns": {
     "servers": [$([[ ${config[safenet]} == ON ]] && echo '"tcp+local://1.1.1.3","tcp+local://1.0.0.3"' || echo '"tcp+local://1.1.1.1","tcp+local://1.0.0.1"')]
   },
-  "inbounds": [{
+  ${api_object}
+  "inbounds": [
+    ${api_inbound}
+    {
     "listen": "0.0.0.0",
     "port": 8443,
     "protocol": "hysteria",
@@ -1146,6 +1597,7 @@ function generate_engine_config {
   "routing": {
     "domainStrategy": "IPIfNonMatch",
     "rules": [
+      ${api_rule}
       {"type": "field", "ip": [
           $([[ ${config[warp]} == OFF ]] && echo '"geoip:cn", "geoip:ir",')
           "0.0.0.0/8","10.0.0.0/8","100.64.0.0/10","127.0.0.0/8","169.254.0.0/16",
@@ -1164,7 +1616,7 @@ function generate_engine_config {
         "outboundTag": "$([[ ${config[warp]} == ON ]] && echo "warp" || echo "internet")"}
     ]
   },
-  "policy": {"levels": {"0": {"handshake": 2, "connIdle": 120}}}
+  ${policy_object}
 }
 XEOF
 
@@ -1172,12 +1624,7 @@ XEOF
     # ─────────────────────────────────────────────────────────────
     # VLESS — tcp / http / grpc / ws / xhttp
     # ─────────────────────────────────────────────────────────────
-    for user in "${!users[@]}"; do
-      if [ -n "$users_object" ]; then
-        users_object="${users_object},"$'\n'
-      fi
-      users_object="${users_object}"'{"id": "'"${users[${user}]}'"', "flow": "'"$([[ ${config[transport]} == 'tcp' ]] && echo 'xtls-rprx-vision' || true)'"', "email": "'"${user}"'"}'
-    done
+    users_object=$(generate_clients_json)
 
     cat >"${path[engine]}" <<XEOF
 {
@@ -1185,7 +1632,9 @@ XEOF
   "dns": {
     "servers": [$([[ ${config[safenet]} == ON ]] && echo '"tcp+local://1.1.1.3","tcp+local://1.0.0.3"' || echo '"tcp+local://1.1.1.1","tcp+local://1.0.0.1"')]
   },
+  ${api_object}
   "inbounds": [
+    ${api_inbound}
     {
       "listen": "0.0.0.0", "port": 8080, "protocol": "dokodemo-door",
       "settings": {"address": "${config[domain]%%:*}", "port": 80, "network": "tcp"}
@@ -1197,13 +1646,13 @@ XEOF
       "tag": "inbound",
       "settings": {"clients": [${users_object}], "decryption": "none"},
       "streamSettings": {
-        $([[ ${config[transport]} == 'grpc' ]] && echo '"grpcSettings": {"serviceName": "'"${config[service_path]}'"'},' || true)
-        $([[ ${config[transport]} == 'ws'   ]] && echo '"wsSettings": {"headers": {"Host": "'"${config[host_header]:-${config[server]}}'"'"}, \"path\": \"/'"${config[service_path]}'"'"},' || true)
-        $([[ ${config[transport]} == 'http' ]] && echo '"httpSettings": {"host":["'"${config[server]}'"'"], \"path\": \"/'"${config[service_path]}'"'"},' || true)
+        $([[ ${config[transport]} == 'grpc' ]] && echo '"grpcSettings": {"serviceName": "'"${config[service_path]}"'"},' || true)
+        $([[ ${config[transport]} == 'ws'   ]] && echo '"wsSettings": {"headers": {"Host": "'"${config[host_header]:-${config[server]}}"'"}, "path": "/'"${config[service_path]}"'"},' || true)
+        $([[ ${config[transport]} == 'http' ]] && echo '"httpSettings": {"host":["'"${config[server]}"'"], "path": "/'"${config[service_path]}"'"},' || true)
         $(if [[ ${config[transport]} == 'xhttp' ]]; then
           echo '"xhttpSettings": {'
-          [[ -n ${config[host_header]} ]] && echo '"host": "'"${config[host_header]}'"'",'
-          echo '"path": "/'"${config[service_path]}'"'"'
+          [[ -n ${config[host_header]} ]] && echo '"host": "'"${config[host_header]}"'",'
+          echo '"path": "/'"${config[service_path]}"'"'
           echo '},'
         fi)
         "network": "${config[transport]}",
@@ -1228,6 +1677,7 @@ XEOF
   "routing": {
     "domainStrategy": "IPIfNonMatch",
     "rules": [
+      ${api_rule}
       {"type": "field", "ip": [
           $([[ ${config[warp]} == OFF ]] && echo '"geoip:cn", "geoip:ir",')
           "0.0.0.0/8","10.0.0.0/8","100.64.0.0/10","127.0.0.0/8","169.254.0.0/16",
@@ -1246,7 +1696,7 @@ XEOF
         "outboundTag": "$([[ ${config[warp]} == ON ]] && echo "warp" || echo "internet")"}
     ]
   },
-  "policy": {"levels": {"0": {"handshake": 2, "connIdle": 120}}}
+  ${policy_object}
 }
 XEOF
   fi
@@ -1289,19 +1739,63 @@ function generate_config {
     mkdir -p "${config_path}/tgbot"
     generate_tgbot_compose
     generate_tgbot_dockerfile
-    download_tgbot_script
+    # В быстром режиме бот уже скачан — не ходим за ним в сеть на каждый вызов
+    if [[ ${fast_path} != true || ! -r ${path[tgbot_script]} ]]; then
+      download_tgbot_script
+    fi
+  fi
+}
+
+function get_public_address {
+  local family=$1
+  local now
+  local key
+  local value
+  local temp_file
+  local ttl
+  local -A cache
+  printf -v now '%(%s)T' -1
+  if [[ -r ${path[address_cache]} ]]; then
+    while IFS='=' read -r key value; do
+      cache["${key}"]="${value}"
+    done < "${path[address_cache]}"
+  fi
+  ttl=${address_ttl}
+  [[ -z ${cache[ipv${family}]} ]] && ttl=${address_negative_ttl}
+  if [[ -n ${cache[ipv${family}_time]} ]] && (( now - cache[ipv${family}_time] < ttl )); then
+    echo "${cache[ipv${family}]}"
+    return 0
+  fi
+  value=$(curl -fsSL -m 5 --ipv${family} https://cloudflare.com/cdn-cgi/trace 2> /dev/null | grep ip | cut -d '=' -f2 || true)
+  # Пустой IPv6 — тоже ответ (его у сервера нет, или сбой сети — поэтому
+  # живёт address_negative_ttl), пустой IPv4 — сбой сети
+  if [[ -n ${value} || ${family} == 6 ]] && [[ -d ${config_path} ]]; then
+    cache[ipv${family}]="${value}"
+    cache[ipv${family}_time]="${now}"
+    temp_file="${path[address_cache]}.$$"
+    for key in "${!cache[@]}"; do
+      printf '%s=%s\n' "${key}" "${cache[${key}]}"
+    done > "${temp_file}"
+    mv -f "${temp_file}" "${path[address_cache]}"
+  fi
+  echo "${value}"
+}
+
+function resolve_default_server {
+  if [[ -z ${defaults[server]} ]]; then
+    defaults[server]=$(get_public_address 4)
   fi
 }
 
 function get_ipv6 {
-  curl -fsSL -m 3 --ipv6 https://cloudflare.com/cdn-cgi/trace 2> /dev/null | grep ip | cut -d '=' -f2
+  get_public_address 6
 }
 
-function print_client_configuration {
+# Ссылка клиента для пользователя $1 — в переменную client_link, без
+# подоболочек (кроме sha256sum для hysteria2): её строят и для одного
+# пользователя, и для выгрузки всех.
+function build_client_link {
   local username=$1
-  local client_config
-  local ipv6
-  local client_config_ipv6
   local hy2_sni
   local hy2_params
 
@@ -1311,25 +1805,75 @@ function print_client_configuration {
     hy2_sni="${config[domain]:-${config[server]}}"
     hy2_params="sni=${hy2_sni}"
     [[ ${config[security]} == 'selfsigned' ]] && hy2_params="${hy2_params}&insecure=1"
-    client_config="hy2://$(echo -n "${username}${users[${username}]}" | sha256sum | cut -d ' ' -f 1 | head -c 16)@${config[server]}:${config[port]}/?${hy2_params}#${username}"
+    client_link="hy2://$(echo -n "${username}${users[${username}]}" | sha256sum | cut -d ' ' -f 1 | head -c 16)@${config[server]}:${config[port]}/?${hy2_params}#${username}"
+    return 0
+  fi
+  client_link="vless://${users[${username}]}@${config[server]}:${config[port]}"
+  if [[ ${config[security]} == 'reality' ]]; then
+    client_link="${client_link}?security=reality"
+  elif [[ ${config[security]} == 'notls' ]]; then
+    client_link="${client_link}?security=none"
   else
-    client_config="vless://${users[${username}]}@${config[server]}:${config[port]}"
-    client_config="${client_config}?security=$([[ ${config[security]} == 'reality' ]] && echo reality || { [[ ${config[security]} == 'notls' ]] && echo none || echo tls; })"
-    client_config="${client_config}&encryption=none&headerType=none&type=${config[transport]}"
-    if [[ ${config[security]} != 'notls' ]]; then
-      client_config="${client_config}&alpn=$([[ ${config[transport]} == 'ws' ]] && echo 'http/1.1' || echo 'h2,http/1.1')"
-      client_config="${client_config}&fp=chrome&sni=${config[domain]%%:*}"
-      [[ ${config[transport]} == 'tcp' ]] && client_config="${client_config}&flow=xtls-rprx-vision"
-    fi
-    [[ ${config[security]} == 'reality' ]] && client_config="${client_config}&pbk=${config[public_key]}&sid=${config[short_id]}"
-    [[ ${config[transport]} == 'ws' || ${config[transport]} == 'http' || ${config[transport]} == 'xhttp' ]] && client_config="${client_config}&path=%2F${config[service_path]}"
-    [[ ${config[transport]} == 'xhttp' && -n ${config[host_header]} ]] && client_config="${client_config}&host=${config[host_header]}"
-    [[ ${config[transport]} == 'ws'   ]] && client_config="${client_config}&host=${config[host_header]:-${config[server]}}"
-    [[ ${config[transport]} == 'http' ]] && client_config="${client_config}&host=${config[host_header]:-${config[server]}}"
-    [[ ${config[transport]} == 'xhttp' ]] && client_config="${client_config}&mode=auto"
-    [[ ${config[transport]} == 'grpc'  ]] && client_config="${client_config}&mode=gun&serviceName=${config[service_path]}"
-    client_config="${client_config}#${username}"
+    client_link="${client_link}?security=tls"
   fi
+  client_link="${client_link}&encryption=none&headerType=none&type=${config[transport]}"
+  if [[ ${config[security]} != 'notls' ]]; then
+    if [[ ${config[transport]} == 'ws' ]]; then
+      client_link="${client_link}&alpn=http/1.1"
+    else
+      client_link="${client_link}&alpn=h2,http/1.1"
+    fi
+    client_link="${client_link}&fp=chrome&sni=${config[domain]%%:*}"
+    [[ ${config[transport]} == 'tcp' ]] && client_link="${client_link}&flow=xtls-rprx-vision"
+  fi
+  [[ ${config[security]} == 'reality' ]] && client_link="${client_link}&pbk=${config[public_key]}&sid=${config[short_id]}"
+  [[ ${config[transport]} == 'ws' || ${config[transport]} == 'http' || ${config[transport]} == 'xhttp' ]] && client_link="${client_link}&path=%2F${config[service_path]}"
+  [[ ${config[transport]} == 'xhttp' && -n ${config[host_header]} ]] && client_link="${client_link}&host=${config[host_header]}"
+  [[ ${config[transport]} == 'ws'   ]] && client_link="${client_link}&host=${config[host_header]:-${config[server]}}"
+  [[ ${config[transport]} == 'http' ]] && client_link="${client_link}&host=${config[host_header]:-${config[server]}}"
+  [[ ${config[transport]} == 'xhttp' ]] && client_link="${client_link}&mode=auto"
+  [[ ${config[transport]} == 'grpc'  ]] && client_link="${client_link}&mode=gun&serviceName=${config[service_path]}"
+  client_link="${client_link}#${username}"
+  return 0
+}
+
+# IPv6 вариант ссылки: адрес сервера в [], к имени добавляется -ipv6
+function ipv6_client_link {
+  local link=$1
+  local username=$2
+  local ipv6=$3
+  link="${link/@${config[server]}:/@[${ipv6}]:}"
+  printf '%s' "${link%"#${username}"}#${username}-ipv6"
+}
+
+# Ссылки всех пользователей в файл $1, по строке на ссылку
+function export_client_links {
+  local file=$1
+  local user
+  local ipv6
+  local count=0
+  ipv6=$(get_ipv6)
+  mkdir -p "$(dirname "${file}")"
+  while IFS= read -r user; do
+    [[ -z ${user} ]] && continue
+    build_client_link "${user}"
+    printf '%s\n' "${client_link}"
+    if [[ -n ${ipv6} ]]; then
+      printf '%s\n' "$(ipv6_client_link "${client_link}" "${user}" "${ipv6}")"
+    fi
+    count=$((count + 1))
+  done < <(printf '%s\n' "${!users[@]}" | sort) > "${file}"
+  echo "Ссылки ${count} пользователей сохранены в ${file}"
+}
+
+function print_client_configuration {
+  local username=$1
+  local client_config
+  local ipv6
+  local client_config_ipv6
+
+  build_client_link "${username}"
+  client_config="${client_link}"
 
   echo ""
   echo "=================================================="
@@ -1343,7 +1887,7 @@ function print_client_configuration {
 
   ipv6=$(get_ipv6)
   if [[ -n $ipv6 ]]; then
-    client_config_ipv6=$(echo "$client_config" | sed "s/@${config[server]}:/@[${ipv6}]:/" | sed "s/#${username}/#${username}-ipv6/")
+    client_config_ipv6=$(ipv6_client_link "${client_config}" "${username}" "${ipv6}")
     echo ""
     echo "==================IPv6 Конфиг======================"
     echo "Конфигурация клиента:"
@@ -1563,6 +2107,53 @@ function list_users_menu {
   echo "${selection}"
 }
 
+# Трафик из traffic.json — снимка, который бот пересобирает после каждого
+# сбора счётчиков engine. Сам engine здесь не опрашивается.
+function print_user_stats {
+  if [[ ! -s ${path[traffic]} ]]; then
+    echo "Статистика трафика ещё не собрана: её собирает Telegram бот (--enable-tgbot true)."
+    return 1
+  fi
+  jq -r '
+    def human:
+      if . >= 1073741824 then "\(. / 1073741824 * 100 | floor / 100) GiB"
+      elif . >= 1048576 then "\(. / 1048576 * 10 | floor / 10) MiB"
+      elif . >= 1024 then "\(. / 1024 | floor) KiB"
+      else "\(.) B" end;
+    def pair($k): (.[$k] // [0, 0]);
+    def rpad($n): . + (" " * ([$n - length, 0] | max));
+    def lpad($n): (" " * ([$n - length, 0] | max)) + .;
+    def row: "\(.[0] | rpad(20)) \(.[1] | lpad(12)) \(.[2] | lpad(12))  \(.[3])";
+    .users as $u |
+    "Обновлено: \(.updated | strflocaltime("%Y-%m-%d %H:%M:%S"))",
+    (["Пользователь", "Сегодня", "Месяц", "Всего (↑/↓)"] | row),
+    ([$ARGS.positional[] | {name: ., t: ($u[.] // {})}]
+      | sort_by(-(.t | pair("month") | add)) | .[]
+      | [.name,
+         (.t | pair("today") | add | human),
+         (.t | pair("month") | add | human),
+         (.t | pair("total") | "\(.[0] | human) / \(.[1] | human)")]
+      | row)
+  ' --args "${!users[@]}" < "${path[traffic]}"
+}
+
+# Кто подключён сейчас — из online.json, который бот обновляет по опросу
+# statsonline/statsonlineiplist. Engine здесь не опрашивается.
+function print_online_users {
+  if [[ ! -s ${path[online]} ]]; then
+    echo "Данные о подключениях ещё не собраны: их собирает Telegram бот (--enable-tgbot true)."
+    return 1
+  fi
+  jq -r '
+    def rpad($n): . + (" " * ([$n - length, 0] | max));
+    def lpad($n): (" " * ([$n - length, 0] | max)) + .;
+    "Обновлено: \(.updated | strflocaltime("%Y-%m-%d %H:%M:%S")), онлайн: \(.users | length)",
+    "\("Пользователь" | rpad(20)) \("Подкл." | lpad(7)) \("IP" | lpad(4))  Адреса",
+    (.users | to_entries | sort_by(-(.value.ips | length), .key) | .[]
+      | "\(.key | rpad(20)) \(.value.conns | tostring | lpad(7)) \(.value.ips | length | tostring | lpad(4))  \(.value.ips | keys | join(", "))")
+  ' "${path[online]}"
+}
+
 function show_server_config {
   local srv
   srv="Протокол: ${config[protocol]}"
@@ -1726,6 +2317,7 @@ function config_server_menu {
       continue
     fi
     if [[ -z ${server} ]]; then
+      resolve_default_server
       server="${defaults[server]}"
     fi
     config[server]="${server}"
@@ -2099,6 +2691,7 @@ function restore_backup_menu {
     if result=$(restore "${backup_file}" "${backup_password}" 2>&1); then
       parse_config_file
       parse_users_file
+      parse_users_meta
       build_config
       update_config_file
       update_users_file
@@ -2122,12 +2715,86 @@ function restart_tgbot_compose {
 }
 
 function restart_container {
+  local start
   if [[ -z "$(${docker_cmd} ls | grep "${path[compose]}" | grep running || true)" ]]; then
     restart_docker_compose
     return
   fi
   if ${docker_cmd} --project-directory ${config_path} -p ${compose_project} ps --services "$1" | grep "$1"; then
+    start=${EPOCHREALTIME}
     ${docker_cmd} --project-directory ${config_path} -p ${compose_project} restart --timeout 2 "$1"
+    report_downtime "$1" "${start}"
+  fi
+}
+
+function report_downtime {
+  local what=$1
+  local start=$2
+  local end=${EPOCHREALTIME}
+  echo "Простой ${what}: $(( (${end/[.,]/} - ${start/[.,]/}) / 1000 )) мс"
+}
+
+# haproxy работает в master-worker режиме (-W в entrypoint образа): по HUP
+# master перечитывает конфиг и поднимает новых воркеров на тех же слушающих
+# сокетах, которые держит сам; старые воркеры дорабатывают соединения.
+function reload_haproxy {
+  if ! ${docker_cmd} --project-directory ${config_path} -p ${compose_project} kill -s HUP haproxy >/dev/null 2>&1; then
+    restart_container haproxy
+    return
+  fi
+  echo "haproxy перезагружен без простоя."
+}
+
+function apply_service_change {
+  if [[ $1 == 'haproxy' ]]; then
+    reload_haproxy
+  else
+    restart_container "$1"
+  fi
+}
+
+# Применяет изменённый docker-compose.yml без down: compose пересоздаёт
+# только сервисы с изменившимся описанием, образы собираются, только если
+# поменялся Dockerfile. Сервисам, у которых поменялись лишь смонтированные
+# файлы, а контейнер остался прежним, достаточно перезапуска или reload.
+function reconcile_docker_compose {
+  local build=$1
+  shift
+  local compose="${docker_cmd} --project-directory ${config_path} -p ${compose_project}"
+  local svc
+  local start
+  local -A before
+  for svc in "$@"; do
+    before["${svc}"]=$(${compose} ps -q "${svc}" 2>/dev/null || true)
+  done
+  start=${EPOCHREALTIME}
+  if [[ ${build} == true ]]; then
+    ${compose} up -d --remove-orphans --build
+  else
+    ${compose} up -d --remove-orphans
+  fi
+  report_downtime "compose" "${start}"
+  for svc in "$@"; do
+    if [[ -n ${before[${svc}]} && ${before[${svc}]} == "$(${compose} ps -q "${svc}" 2>/dev/null || true)" ]]; then
+      apply_service_change "${svc}"
+    fi
+  done
+}
+
+function reconcile_tgbot_compose {
+  local build=$1
+  local recreate=$2
+  local compose="${docker_cmd} --project-directory ${config_path}/tgbot -p ${tgbot_project}"
+  if [[ -z "$(${docker_cmd} ls | grep "${path[tgbot_compose]}" | grep running || true)" ]]; then
+    restart_tgbot_compose
+    return
+  fi
+  if [[ ${build} == true ]]; then
+    ${compose} up -d --remove-orphans --build
+  elif [[ ${recreate} == true ]]; then
+    ${compose} up -d --remove-orphans
+  else
+    ${compose} restart --timeout 2 tgbot
   fi
 }
 
@@ -2237,29 +2904,102 @@ function warp_decode_reserved {
   echo "${reserved}"
 }
 
+function engine_hot_apply_users {
+  local before=$1
+  local delta
+  local removed
+  local output
+  local engine_exec
+  if [[ ! -s ${before} ]] || ! jq -e '.api' "${before}" >/dev/null 2>&1; then
+    return 1
+  fi
+  # Применимо только если конфиги отличаются одними клиентами inbound
+  delta=$(jq -n -c --slurpfile old "${before}" --slurpfile new "${path[engine]}" '
+    def strip: del(.inbounds[]?.settings.clients);
+    def clients: [.inbounds[]? | select(.tag == "inbound") | .settings.clients[]?];
+    $old[0] as $o | $new[0] as $n |
+    if ($o | strip) != ($n | strip) then empty else
+      ($o | clients) as $oc | ($n | clients) as $nc |
+      INDEX($oc[]; tojson) as $oi | INDEX($nc[]; tojson) as $ni |
+      ($n.inbounds[] | select(.tag == "inbound")) as $in |
+      {
+        removed: [$oc[] | select($ni[tojson] | not) | .email],
+        add: {inbounds: [{
+          tag: "inbound",
+          protocol: $in.protocol,
+          settings: ($in.settings + {clients: [$nc[] | select($oi[tojson] | not)]})
+        }]}
+      }
+    end' 2>/dev/null)
+  if [[ -z ${delta} ]]; then
+    return 1
+  fi
+  engine_exec="${docker_cmd} --project-directory ${config_path} -p ${compose_project} exec -T engine"
+  removed=$(jq -r '.removed | join(" ")' <<< "${delta}")
+  if [[ -n ${removed} ]]; then
+    # Выключенных бот уже мог убрать сам (rmu) — «not found» не ошибка
+    if ! output=$(${engine_exec} xray api rmu --server=127.0.0.1:${engine_api_port} -tag=inbound ${removed} 2>&1) \
+      && ! grep -qi 'not found' <<< "${output}"; then
+      return 1
+    fi
+  fi
+  if [[ $(jq '.add.inbounds[0].settings.clients | length' <<< "${delta}") -gt 0 ]]; then
+    jq -c '.add' <<< "${delta}" | ${engine_exec} sh -c \
+      "cat > /tmp/adu.json && xray api adu --server=127.0.0.1:${engine_api_port} /tmp/adu.json" >/dev/null 2>&1 || return 1
+  fi
+  echo "Пользователи применены без перезапуска engine."
+}
+
 function check_reload {
   declare -A restart
+  declare -A changed
+  local engine_before
+  local fingerprint
+  local plan
+  local services=()
+  engine_before=$(mktemp)
+  cp -f "${path[engine]}" "${engine_before}" 2>/dev/null || true
   generate_config
   for key in "${!path[@]}"; do
-    if [[ "${md5["$key"]}" != $(get_md5 "${path[$key]}") ]]; then
+    fingerprint=$(get_fingerprint "${key}" "${path[$key]}")
+    if [[ "${md5["$key"]}" != "${fingerprint}" ]]; then
+      md5["$key"]="${fingerprint}"
+      changed["${key}"]='true'
+      if [[ ${key} == 'engine' ]] && engine_hot_apply_users "${engine_before}"; then
+        continue
+      fi
       restart["${service["$key"]}"]='true'
-      md5["$key"]=$(get_md5 "${path[$key]}")
     fi
   done
+  rm -f "${engine_before}"
+  for key in "${!restart[@]}"; do
+    if [[ $key != 'none' ]]; then
+      plan="${plan:+${plan}, }${key}"
+    fi
+  done
+  if [[ -n ${plan} ]]; then
+    if [[ -n ${changed[compose]}${changed[tgbot_compose]} ]] && ! python3 -c 'import yaml' 2>/dev/null; then
+      plan="${plan} (compose сравнивался построчно: нет модуля yaml для python3)"
+    fi
+    echo "План применения: ${plan}"
+  fi
   if [[ "${restart[tgbot]}" == 'true' && "${config[tgbot]}" == 'ON' ]]; then
-    restart_tgbot_compose
+    reconcile_tgbot_compose "${changed[tgbot_dockerfile]:-false}" "${changed[tgbot_compose]:-false}"
   fi
   if [[ "${config[tgbot]}" == 'OFF' ]]; then
     ${docker_cmd} --project-directory ${config_path}/tgbot -p ${tgbot_project} down --remove-orphans --timeout 2 >/dev/null 2>&1 || true
   fi
+  for key in "${!restart[@]}"; do
+    if [[ $key != 'none' && $key != 'tgbot' && $key != 'compose' ]]; then
+      services+=("${key}")
+    fi
+  done
   if [[ "${restart[compose]}" == 'true' ]]; then
-    restart_docker_compose
+    reconcile_docker_compose "${changed[certbot_dockerfile]:-false}" "${services[@]}"
     return
   fi
-  for key in "${!restart[@]}"; do
-    if [[ $key != 'none' && $key != 'tgbot' ]]; then
-      restart_container "${key}"
-    fi
+  for key in "${services[@]}"; do
+    apply_service_change "${key}"
   done
 }
 
@@ -2275,15 +3015,50 @@ function message_box {
     3>&1 1>&2 2>&3
 }
 
-function get_md5 {
-  local file_path
-  file_path=$1
-  md5sum "${file_path}" 2>/dev/null | cut -f1 -d' ' || true
+# Отпечаток файла для check_reload: сравнивается смысл, а не байты.
+# engine.conf — JSON с отсортированными ключами и клиентами по email,
+# compose — разобранный YAML в JSON с отсортированными ключами (порядок
+# ключей и отступы не важны), haproxy — без пустых строк, комментариев и
+# пробелов по краям строк, users — без учёта порядка строк (у ассоциативных
+# массивов bash его нет). Без модуля yaml для python3 compose сравнивается
+# как haproxy, построчно.
+function get_fingerprint {
+  local key=$1
+  local file_path=$2
+  local canonical
+  if [[ ! -r ${file_path} ]]; then
+    return 0
+  fi
+  case ${key} in
+    engine)
+      if ! canonical=$(jq -S -c '.inbounds[]? |= (if .settings.clients then .settings.clients |= sort_by(.email) else . end)' "${file_path}" 2>/dev/null); then
+        canonical=$(< "${file_path}")
+      fi
+      ;;
+    compose|tgbot_compose|haproxy)
+      if [[ ${key} == 'haproxy' ]] || ! canonical=$(python3 -c '
+import json, sys, yaml
+with open(sys.argv[1]) as f:
+    print(json.dumps(yaml.safe_load(f), sort_keys=True, separators=(",", ":")))
+' "${file_path}" 2>/dev/null); then
+        canonical=$(sed -e 's/^[[:space:]]*//' -e 's/[[:space:]]*$//' -e '/^#/d' -e '/^$/d' "${file_path}")
+      fi
+      ;;
+    users)
+      canonical=$(sort "${file_path}")
+      ;;
+    *)
+      md5sum "${file_path}" 2>/dev/null | cut -f1 -d' ' || true
+      return 0
+      ;;
+  esac
+  md5sum <<< "${canonical}" | cut -f1 -d' '
 }
 
 function generate_file_list {
   path[config]="${config_path}/config"
   path[users]="${config_path}/users"
+  path[users_meta]="${config_path}/users.meta"
   path[compose]="${config_path}/docker-compose.yml"
   path[engine]="${config_path}/engine.conf"
   path[haproxy]="${config_path}/haproxy.cfg"
@@ -2296,9 +3071,15 @@ function generate_file_list {
   path[tgbot_script]="${config_path}/tgbot/tgbot.py"
   path[tgbot_dockerfile]="${config_path}/tgbot/Dockerfile"
   path[tgbot_compose]="${config_path}/tgbot/docker-compose.yml"
+  path[provision]="${config_path}/.provisioned"
+  path[address_cache]="${config_path}/.address-cache"
+  path[traffic]="${config_path}/traffic.json"
+  path[online]="${config_path}/online.json"
+  path[lock]="${config_path}/.lock"
 
   service[config]='none'
   service[users]='none'
+  service[users_meta]='none'
   service[compose]='compose'
   service[engine]='engine'
   service[haproxy]='haproxy'
@@ -2309,11 +3090,16 @@ function generate_file_list {
   service[server_key]='engine'
   service[server_crt]='engine'
   service[tgbot_script]='tgbot'
-  service[tgbot_dockerfile]='compose'
+  service[tgbot_dockerfile]='tgbot'
   service[tgbot_compose]='tgbot'
+  service[provision]='none'
+  service[address_cache]='none'
+  service[traffic]='none'
+  service[online]='none'
+  service[lock]='none'
 
   for key in "${!path[@]}"; do
-    md5["$key"]=$(get_md5 "${path[$key]}")
+    md5["$key"]=$(get_fingerprint "${key}" "${path[$key]}")
   done
 }
 
@@ -2343,6 +3129,62 @@ EOF
   sysctl -qp /etc/sysctl.d/99-reality-ezpz.conf >/dev/null 2>&1 || true
 }
 
+# Быстрый режим: команды чтения и управления пользователями на уже
+# подготовленном хосте пропускают установку пакетов, docker, upgrade и
+# tune_kernel. Что и какой версией скрипта подготовлено — в path[provision].
+function fast_path_allowed {
+  local key
+  local allowed=" list_users user_stats online show_config server-config add_user delete_user add-users-from delete-users-from export_links "
+  if [[ -z ${args[list_users]}${args[user_stats]}${args[online]}${args[show_config]}${args[server-config]}${args[add_user]}${args[delete_user]}${args[add-users-from]}${args[delete-users-from]}${args[export_links]} ]]; then
+    return 1
+  fi
+  for key in "${!args[@]}"; do
+    if [[ ${allowed} != *" ${key} "* ]]; then
+      return 1
+    fi
+  done
+  if [[ -z ${args[add_user]}${args[delete_user]}${args[add-users-from]}${args[delete-users-from]} ]]; then
+    fast_path_mode=readonly
+  else
+    fast_path_mode=users
+  fi
+}
+
+# Идентификатор хоста для отметки подготовки: machine-id (в контейнер бота
+# он смонтирован), без него — путь к конфигурации. HOSTNAME не подходит:
+# в контейнере бота он другой, и быстрый режим оттуда не включался бы.
+function provision_host_id {
+  if [[ -r /etc/machine-id ]]; then
+    cat /etc/machine-id
+  else
+    echo "${config_path}"
+  fi
+}
+
+function read_provision_stamp {
+  local key
+  local value
+  local -A stamp
+  if [[ ! -r ${path[provision]} || ! -r ${path[config]} ]]; then
+    return 1
+  fi
+  while IFS='=' read -r key value; do
+    stamp["${key}"]="${value}"
+  done < "${path[provision]}"
+  if [[ ${stamp[version]} != "${script_version}" || ${stamp[host]} != "$(provision_host_id)" || -z ${stamp[docker_cmd]} ]]; then
+    return 1
+  fi
+  if ! command -v docker >/dev/null 2>&1; then
+    return 1
+  fi
+  docker_cmd="${stamp[docker_cmd]}"
+}
+
+function write_provision_stamp {
+  printf 'version=%s\nhost=%s\ndocker_cmd=%s\nkernel=tuned\n' \
+    "${script_version}" "$(provision_host_id)" "${docker_cmd}" > "${path[provision]}"
+}
+
 function configure_docker {
   local docker_config="/etc/docker/daemon.json"
   local config_modified=false
@@ -2403,16 +3245,29 @@ if [[ -n ${args[restore]} ]]; then
   clear
 fi
 generate_file_list
-install_packages
-install_docker
-configure_docker
-upgrade
+# Версия скрипта = хеш всех функций: меняется при любом обновлении скрипта
+script_version=$(declare -f | md5sum | cut -d ' ' -f 1)
+fast_path=false
+if fast_path_allowed && read_provision_stamp; then
+  fast_path=true
+else
+  install_packages
+  install_docker
+  configure_docker
+  upgrade
+fi
 parse_config_file
 parse_users_file
+parse_users_meta
 build_config
-update_config_file
-update_users_file
-tune_kernel
+if [[ ${fast_path} != true || ${fast_path_mode} != 'readonly' ]]; then
+  update_config_file
+  update_users_file
+fi
+if [[ ${fast_path} != true ]]; then
+  tune_kernel
+  write_provision_stamp
+fi
 
 if [[ ${args[menu]} == 'true' ]]; then
   set +e
@@ -2425,11 +3280,13 @@ if [[ ${args[restart]} == 'true' ]]; then
     restart_tgbot_compose
   fi
 fi
-if [[ -z "$(${docker_cmd} ls | grep "${path[compose]}" | grep running || true)" ]]; then
-  restart_docker_compose
-fi
-if [[ -z "$(${docker_cmd} ls | grep "${path[tgbot_compose]}" | grep running || true)" && ${config[tgbot]} == 'ON' ]]; then
-  restart_tgbot_compose
+if [[ ${fast_path} != true ]]; then
+  if [[ -z "$(${docker_cmd} ls | grep "${path[compose]}" | grep running || true)" ]]; then
+    restart_docker_compose
+  fi
+  if [[ -z "$(${docker_cmd} ls | grep "${path[tgbot_compose]}" | grep running || true)" && ${config[tgbot]} == 'ON' ]]; then
+    restart_tgbot_compose
+  fi
 fi
 if [[ ${args[server-config]} == true ]]; then
   show_server_config
@@ -2441,6 +3298,18 @@ if [[ -n ${args[list_users]} ]]; then
   done
   exit 0
 fi
+if [[ -n ${args[export_links]} ]]; then
+  export_client_links "${args[export_links]}"
+  exit 0
+fi
+if [[ -n ${args[user_stats]} ]]; then
+  print_user_stats
+  exit 0
+fi
+if [[ -n ${args[online]} ]]; then
+  print_online_users
+  exit 0
+fi
 if [[ ${#users[@]} -eq 1 ]]; then
   username="${!users[@]}"
 fi
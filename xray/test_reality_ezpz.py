@@ -0,0 +1,288 @@
+"""Проверки генераторов reality-ezpz без docker: нужные функции вырезаются
+из скрипта (как в bench-engine-config.sh) и запускаются в bash. Оба варианта
+скрипта — reality-ezpz.sh (xray и sing-box, его запускают бот и install.sh)
+и reality-ezpz.py (только xray) — проверяются одинаково."""
+
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+from urllib.parse import urlsplit
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = ('reality-ezpz.sh', 'reality-ezpz.py')
+RAW = 'https://raw.githubusercontent.com/qp-io/qp-io.github.io/refs/heads/main/xray/'
+
+BASE_CONFIG = {
+    'protocol': 'vless',
+    'core': 'xray',
+    'security': 'selfsigned',
+    'transport': 'ws',
+    'service_path': '73cb0dfb',
+    'server': '203.0.113.7',
+    'port': '8443',
+    'tgbot': 'ON',
+    'tgbot_token': '12345678:token',
+    'tgbot_admins': 'admin1',
+    'tgbot_webhook': 'ON',
+    'tgbot_webhook_path': '95df033e8e6950fe',
+    'tgbot_webhook_secret': 'webhooksecret',
+    'tgbot_subscription': 'ON',
+    'tgbot_subscription_path': 'bd80e0ae7ef666dc',
+    'tgbot_subscription_secret': 'subsecret',
+    'tgbot_metrics_port': '0',
+}
+
+FUNCTIONS = (
+    'tgbot_haproxy_http', 'tgbot_webhook_enabled', 'tgbot_subscription_enabled',
+    'tgbot_behind_haproxy', 'generate_tgbot_compose', 'generate_haproxy_config',
+)
+
+
+@pytest.fixture(params=SCRIPTS)
+def script(request) -> str:
+    return request.param
+
+
+def script_source(script: str) -> str:
+    with open(os.path.join(HERE, script), encoding='utf-8') as f:
+        return f.read()
+
+
+def has_function(source: str, name: str) -> bool:
+    return re.search(r'^function %s \{$' % re.escape(name), source, re.M) is not None
+
+
+def extract_function(source: str, name: str) -> str:
+    m = re.search(r'^function %s \{\n.*?^\}\n' % re.escape(name), source, re.M | re.S)
+    assert m, name
+    return m.group(0)
+
+
+def generate(tmp_path, script, **overrides) -> tuple:
+    """(haproxy.cfg, compose бота) для config с заменами overrides."""
+    source = script_source(script)
+    config = {**BASE_CONFIG, **overrides}
+    lines = ['set -e', 'declare -A config', 'declare -A path']
+    lines += [f'config[{k}]={shlex.quote(v)}' for k, v in config.items()]
+    lines += [
+        f'config_path={shlex.quote(str(tmp_path))}',
+        'compose_project=inst',
+        'subnet_tgbot=fc12::160d:0/112',
+        f'path[haproxy]={shlex.quote(str(tmp_path / "haproxy.cfg"))}',
+        f'path[tgbot_compose]={shlex.quote(str(tmp_path / "compose.yml"))}',
+        f'path[server_crt]={shlex.quote(str(tmp_path / "certificate" / "server.crt"))}',
+    ]
+    lines += re.findall(r'^tgbot_\w+_port=\d+$', source, re.M)
+    lines += [extract_function(source, name) for name in FUNCTIONS if has_function(source, name)]
+    lines += ['generate_haproxy_config', 'generate_tgbot_compose']
+    subprocess.run(['bash', '-c', '\n'.join(lines)], check=True)
+    return (tmp_path / 'haproxy.cfg').read_text(), (tmp_path / 'compose.yml').read_text()
+
+
+def compose_env(compose: str) -> dict:
+    return dict(re.findall(r'^      (BOT_[A-Z_]+): (.*)$', compose, re.M))
+
+
+def haproxy_routes(haproxy: str) -> dict:
+    """{backend: (префикс пути, host:port сервера)} для бэкендов бота."""
+    prefixes = dict(
+        (backend, prefix) for backend, prefix in
+        re.findall(r'use_backend (tgbot\w*) if \{ path_beg (\S+) \}', haproxy)
+    )
+    servers = dict(re.findall(r'^backend (tgbot\w*)\n  mode http\n  server tgbot (\S+)', haproxy, re.M))
+    assert prefixes.keys() == servers.keys()
+    return {b: (prefixes[b], servers[b]) for b in prefixes}
+
+
+def test_bot_and_installer_run_this_script():
+    with open(os.path.join(HERE, 'tgbot.py'), encoding='utf-8') as f:
+        urls = set(re.findall(re.escape(RAW) + r'reality-ezpz\.\w+', f.read()))
+    with open(os.path.join(HERE, 'install.sh'), encoding='utf-8') as f:
+        urls |= set(re.findall(re.escape(RAW) + r'reality-ezpz\.\w+', f.read()))
+    assert urls == {RAW + 'reality-ezpz.sh'}
+
+
+def test_haproxy_routes_match_bot_env(tmp_path, script):
+    haproxy, compose = generate(tmp_path, script)
+    env = compose_env(compose)
+    routes = haproxy_routes(haproxy)
+    assert set(routes) == {'tgbot', 'tgbot_sub'}
+
+    webhook = urlsplit(env['BOT_WEBHOOK_URL'])
+    assert routes['tgbot'] == (webhook.path, f"tgbot:{env['BOT_WEBHOOK_PORT']}")
+    assert webhook.netloc == f"{BASE_CONFIG['server']}:{BASE_CONFIG['port']}"
+
+    sub = urlsplit(env['BOT_SUB_URL'])
+    # Бот отдаёт подписки по префиксу <путь>/ (SubscriptionServer.prefix)
+    assert routes['tgbot_sub'] == (sub.path.rstrip('/') + '/', f"tgbot:{env['BOT_SUB_PORT']}")
+    assert env['BOT_SUB_SECRET'] == BASE_CONFIG['tgbot_subscription_secret']
+
+    assert 'resolvers docker' in haproxy
+    assert re.search(r'^    - reality$', compose, re.M)
+
+
+@pytest.mark.parametrize('script, overrides', [
+    (script, overrides) for script in SCRIPTS for overrides in (
+        {'tgbot_webhook': 'OFF', 'tgbot_subscription': 'OFF'},
+        {'tgbot': 'OFF'},
+        {'security': 'reality'},
+        {'transport': 'tcp'},
+    )
+] + [
+    ('reality-ezpz.py', {'protocol': 'hysteria2'}),
+] + [
+    ('reality-ezpz.sh', {'core': 'sing-box', 'transport': transport})
+    for transport in ('tuic', 'hysteria2', 'shadowtls')
+])
+def test_no_bot_routes_without_http_haproxy(tmp_path, script, overrides):
+    haproxy, compose = generate(tmp_path, script, **overrides)
+    env = compose_env(compose)
+    assert 'tgbot' not in haproxy
+    assert not {k for k in env if k.startswith(('BOT_WEBHOOK', 'BOT_SUB'))}
+    assert 'external: true' not in compose
+
+
+def test_webhook_needs_telegram_port(tmp_path, script):
+    haproxy, compose = generate(tmp_path, script, port='9443')
+    env = compose_env(compose)
+    assert set(haproxy_routes(haproxy)) == {'tgbot_sub'}
+    assert 'BOT_WEBHOOK_URL' not in env and 'BOT_SUB_URL' in env
+
+
+def run_config_update(tmp_path, script, between: str, change: str):
+    """parse -> изменения этого запуска (change) -> запись; между чтением и
+    записью файлы правит «бот» (between)."""
+    source = script_source(script)
+    items = re.search(r'^config_items=\(\n.*?^\)\n', source, re.M | re.S).group(0)
+    lines = [
+        'set -e', 'declare -A config_file args config users config_read users_read path',
+        f'config_path={shlex.quote(str(tmp_path))}',
+        'path[config]="${config_path}/config"', 'path[users]="${config_path}/users"',
+        'path[lock]="${config_path}/.lock"',
+        items,
+        'function generate_keys { :; }', 'function check_reload { :; }',
+    ]
+    lines += [extract_function(source, name) for name in (
+        'parse_config_file', 'parse_users_file', 'lock_config_files', 'unlock_config_files',
+        'update_config_file', 'update_users_file',
+    )]
+    lines += [
+        'parse_config_file', 'parse_users_file',
+        'for k in "${config_items[@]}"; do config[$k]="${config_file[$k]}"; done',
+        between, change,
+        'update_config_file', 'update_users_file',
+        'echo "transport=${config[transport]} warp=${config[warp]}"',
+    ]
+    out = subprocess.run(['bash', '-c', '\n'.join(lines)], check=True, capture_output=True, text=True)
+    config = dict(l.split('=', 1) for l in (tmp_path / 'config').read_text().splitlines())
+    users = dict(l.split('=', 1) for l in (tmp_path / 'users').read_text().splitlines())
+    return config, users, out.stdout.strip()
+
+
+def test_update_keeps_changes_made_after_parse(tmp_path, script):
+    (tmp_path / 'config').write_text('transport=ws\nwarp=OFF\nport=443\n')
+    (tmp_path / 'users').write_text('alice=a\ncarol=c\n')
+    config, users, seen = run_config_update(
+        tmp_path, script,
+        between=(
+            "sed -i 's/^warp=OFF/warp=ON/' \"${path[config]}\"; "
+            "echo bob=b >> \"${path[users]}\"; sed -i '/^carol=/d' \"${path[users]}\""
+        ),
+        change="config[transport]=grpc; users[dave]=d; unset 'users[alice]'",
+    )
+    assert config['transport'] == 'grpc'
+    assert config['warp'] == 'ON'
+    assert config['port'] == '443'
+    assert users == {'bob': 'b', 'dave': 'd'}
+    # Чужие изменения видны и самому запуску (для generate_config)
+    assert seen == 'transport=grpc warp=ON'
+
+
+def test_update_reads_users_without_trailing_newline(tmp_path, script):
+    (tmp_path / 'config').write_text('transport=ws\n')
+    (tmp_path / 'users').write_text('alice=a\ncarol=c')
+    config, users, _ = run_config_update(
+        tmp_path, script,
+        between="printf '\\nbob=b' >> \"${path[users]}\"",
+        change='users[dave]=d',
+    )
+    assert users == {'alice': 'a', 'bob': 'b', 'carol': 'c', 'dave': 'd'}
+
+
+def test_read_user_list_file(tmp_path, script):
+    (tmp_path / 'list.csv').write_bytes(
+        'username,uuid\r\n'
+        'alice,0b5a7f3e-1d2c-4b5a-9e8f-7a6b5c4d3e2f\r\n'
+        '\n'
+        '  # комментарий\n'
+        'bob;x  # хвост\n'
+        'carol\n'
+        'dave=y\n'
+        'bad-name,z\n'
+        'name\n'
+        'erin y'.encode()
+    )
+    lines = [
+        'declare -A regex user_list',
+        'regex[username]="^[a-zA-Z0-9]+$"',
+        extract_function(script_source(script), 'read_user_list_file'),
+        f'read_user_list_file {shlex.quote(str(tmp_path / "list.csv"))}',
+        'for name in "${!user_list[@]}"; do echo "${name}=${user_list[${name}]}"; done',
+        'echo "invalid=${user_list_invalid}"',
+    ]
+    out = subprocess.run(['bash', '-c', '\n'.join(lines)], check=True, capture_output=True, text=True)
+    result = dict(l.split('=', 1) for l in out.stdout.splitlines())
+    assert result.pop('invalid') == '1'
+    # Заголовок пропускается только в первой строке, последняя строка без \n читается
+    assert result == {
+        'alice': '0b5a7f3e-1d2c-4b5a-9e8f-7a6b5c4d3e2f',
+        'bob': 'x', 'carol': '', 'dave': 'y', 'name': '', 'erin': 'y',
+    }
+
+
+@pytest.mark.parametrize('core, transport, client', [
+    ('xray', 'tcp', {'id': 'U', 'flow': 'xtls-rprx-vision', 'email': 'alice'}),
+    ('sing-box', 'grpc', {'uuid': 'U', 'flow': '', 'name': 'alice'}),
+    ('sing-box', 'tuic', {'uuid': 'U', 'password': 'P', 'name': 'alice'}),
+    ('sing-box', 'hysteria2', {'password': 'P', 'name': 'alice'}),
+    ('sing-box', 'shadowtls', {'password': 'U', 'name': 'alice'}),
+])
+def test_clients_json_per_core(core, transport, client):
+    uuid = '0b5a7f3e-1d2c-4b5a-9e8f-7a6b5c4d3e2f'
+    lines = [
+        'declare -A config users disabled_users',
+        f'config[core]={core}',
+        f'config[transport]={transport}',
+        f'users[alice]={uuid}',
+        f'users[bob]={uuid}',
+        'disabled_users[bob]=1',
+        extract_function(script_source('reality-ezpz.sh'), 'generate_clients_json'),
+        'echo "[$(generate_clients_json)]"',
+    ]
+    out = subprocess.run(['bash', '-c', '\n'.join(lines)], check=True, capture_output=True, text=True)
+    password = hashlib.sha256(('alice' + uuid).encode()).hexdigest()[:16]
+    expected = {k: {'U': uuid, 'P': password}.get(v, v) for k, v in client.items()}
+    assert json.loads(out.stdout) == [expected]
+
+
+def fingerprint(script, key, path) -> str:
+    lines = [
+        extract_function(script_source(script), 'get_fingerprint'),
+        f'get_fingerprint {key} {shlex.quote(str(path))}',
+    ]
+    return subprocess.run(['bash', '-c', '\n'.join(lines)], check=True, capture_output=True, text=True).stdout
+
+
+def test_compose_fingerprint_ignores_layout(tmp_path, script):
+    pytest.importorskip('yaml')
+    a, b, c = tmp_path / 'a.yml', tmp_path / 'b.yml', tmp_path / 'c.yml'
+    a.write_text('services:\n  engine:\n    image: xray\n    ports:\n      - 443:443\n    restart: always\n')
+    b.write_text('# comment\nservices:\n    engine:\n        restart: always\n        ports: ["443:443"]\n        image: xray\n')
+    c.write_text('services:\n  engine:\n    image: xray\n    ports:\n      - 8443:443\n    restart: always\n')
+    assert fingerprint(script, 'compose', a) == fingerprint(script, 'compose', b)
+    assert fingerprint(script, 'compose', a) != fingerprint(script, 'compose', c)
@@ -0,0 +1,236 @@
+"""Проверки чистых частей tgbot.py: без Telegram, docker и engine."""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('BOT_TOKEN', '12345678:token')
+
+import tgbot  # noqa: E402
+
+
+def local_ts(*args) -> int:
+    return int(datetime(*args).timestamp())
+
+
+def test_traffic_store_rollups(tmp_path):
+    store = tgbot.TrafficStore(str(tmp_path / 'stats.db'), str(tmp_path / 'traffic.json'))
+    store.record({'alice': (10, 100)}, local_ts(2026, 9, 30, 12))
+    store.record({'alice': (1, 2), 'bob': (5, 5)}, local_ts(2026, 10, 17, 12))
+    store.record({'alice': (3, 4)}, local_ts(2026, 10, 18, 9))
+    snap = store.record({'alice': (5, 6)}, local_ts(2026, 10, 18, 10))
+
+    alice = snap['users']['alice']
+    assert alice['today'] == [8, 10]
+    assert alice['month'] == [9, 12]
+    assert alice['total'] == [19, 112]
+    assert alice['since'] == local_ts(2026, 9, 30, 12)
+    # Сегодня bob ничего не передал, но месяц и всё время остаются
+    assert snap['users']['bob'] == {
+        'today': [0, 0], 'month': [5, 5], 'total': [5, 5], 'since': local_ts(2026, 10, 17, 12),
+    }
+    assert json.loads((tmp_path / 'traffic.json').read_text()) == snap
+
+
+def test_traffic_store_retention_keeps_daily(tmp_path):
+    store = tgbot.TrafficStore(str(tmp_path / 'stats.db'), str(tmp_path / 'traffic.json'))
+    old = local_ts(2026, 8, 1, 12)
+    store.record({'alice': (1, 1)}, old)
+    snap = store.record({'alice': (1, 1)}, old + (tgbot.STATS_RETENTION + 1) * 86400)
+    db = store._conn()
+    assert db.execute('SELECT COUNT(*) FROM traffic').fetchone() == (1,)
+    assert db.execute('SELECT COUNT(*) FROM daily').fetchone() == (2,)
+    assert snap['users']['alice']['total'] == [2, 2]
+
+
+@pytest.fixture
+def user_index(tmp_path):
+    users = tmp_path / 'users'
+    users.write_text(''.join(f'u{i:02d}=x\n' for i in range(10)))
+    return users, tgbot.UserIndex(tgbot.FileSnapshot(str(users), tgbot.parse_key_values))
+
+
+def test_user_index_paging(user_index):
+    users, index = user_index
+    items, start, prev, nxt = index.page('', 4)
+    assert (items, start, prev, nxt) == (['u00', 'u01', 'u02', 'u03'], 0, None, 'u04')
+    items, start, prev, nxt = index.page(nxt, 4)
+    assert (items, start, prev, nxt) == (['u04', 'u05', 'u06', 'u07'], 4, 'u00', 'u08')
+
+    # Курсор — имя: удаление перед ним не сдвигает следующую страницу
+    users.write_text(''.join(f'u{i:02d}=x\n' for i in range(10) if i != 1) + 'u045=x\n')
+    items, start, _, nxt = index.page('u04', 4)
+    assert items == ['u04', 'u045', 'u05', 'u06']
+    assert (start, nxt) == (3, 'u07')
+    items, _, _, nxt = index.page('u08', 4)
+    assert (items, nxt) == (['u08', 'u09'], None)
+
+
+def test_user_index_find_prefix_first(tmp_path):
+    users = tmp_path / 'users'
+    users.write_text('bob=x\nalice=x\nmalice=x\nALICE2=x\n')
+    index = tgbot.UserIndex(tgbot.FileSnapshot(str(users), tgbot.parse_key_values))
+    assert index.find('alice') == (['alice', 'ALICE2', 'malice'], 3)
+    assert index.find('alice', limit=1) == (['alice'], 3)
+    assert index.find('nobody') == ([], 0)
+
+
+def test_merge_args_last_value_per_flag():
+    batch = [
+        {'args': '--transport ws'},
+        {'args': '--enable-warp true'},
+        {'args': ''},
+        {'args': '--transport grpc'},
+    ]
+    assert tgbot.ReconfigureScheduler.merge_args(batch) == '--transport grpc --enable-warp true'
+    assert tgbot.ReconfigureScheduler.merge_args([{'args': ''}]) == ''
+
+
+def test_parse_user_list():
+    text = (
+        'name,uuid\n'
+        'alice,0b5a7f3e-1d2c-4b5a-9e8f-7a6b5c4d3e2f\n'
+        '\n'
+        '# комментарий\n'
+        'bob;x  # хвост\n'
+        'carol\n'
+        'dave = y\n'
+        'bad-name,z\n'
+        'имя\n'
+    )
+    users, invalid = tgbot.parse_user_list(text)
+    assert users == {
+        'alice': '0b5a7f3e-1d2c-4b5a-9e8f-7a6b5c4d3e2f',
+        'bob': 'x', 'carol': '', 'dave': 'y',
+    }
+    # Заголовок пропускается только в первой строке
+    assert invalid == 2
+
+
+def test_sub_token(monkeypatch):
+    monkeypatch.setattr(tgbot, 'SUB_SECRET', 'secret')
+    token = tgbot.sub_token('alice')
+    assert token == hmac.new(b'secret', b'alice', hashlib.sha256).hexdigest()[:32]
+    assert token != tgbot.sub_token('bob')
+    monkeypatch.setattr(tgbot, 'SUB_SECRET', 'other')
+    assert token != tgbot.sub_token('alice')
+
+
+def test_histogram_buckets_are_cumulative():
+    h = tgbot.Histogram('t_seconds', 'doc', (1, 0.1, 0.5), ('command',))
+    for value in (0.05, 0.5, 0.7, 5):
+        h.observe(value, command='/start')
+    assert h.render() == [
+        '# HELP t_seconds doc',
+        '# TYPE t_seconds histogram',
+        't_seconds_bucket{command="/start",le="0.1"} 1',
+        't_seconds_bucket{command="/start",le="0.5"} 2',
+        't_seconds_bucket{command="/start",le="1"} 3',
+        't_seconds_bucket{command="/start",le="+Inf"} 4',
+        't_seconds_sum{command="/start"} 6.250000',
+        't_seconds_count{command="/start"} 4',
+    ]
+
+
+@pytest.mark.parametrize('args, readonly', [
+    ('--show-user bob', True),
+    ('--list-users', True),
+    ('--export-links=/tmp/links.txt', True),
+    ('--online --user-stats', True),
+    ('', False),
+    ('--add-user bob', False),
+    ('--show-user bob --delete-user bob', False),
+])
+def test_script_readonly(args, readonly):
+    assert tgbot.script_readonly(args) is readonly
+
+
+def test_online_poller_limited_first_then_rotation():
+    poller = tgbot.OnlinePoller(3)
+    names = ['a', 'b', 'c', 'd', 'e']
+    picks = [poller.pick(names, {'d'}) for _ in range(3)]
+    assert picks == [['d', 'a', 'b'], ['d', 'c', 'e'], ['d', 'a', 'b']]
+
+    fresh = {'a': {'conns': 1, 'ips': {'192.0.2.1': 100}}}
+    previous = {'b': {'conns': 2, 'ips': {'192.0.2.2': 50}}}
+    assert tgbot.OnlinePoller.merge(['a', 'b', 'c'], fresh, previous) == {
+        'a': {'conns': 1, 'ips': {'192.0.2.1': 100}},
+        'b': {'conns': 2, 'ips': {'192.0.2.2': 50}},
+        'c': {'conns': 1, 'ips': {}},
+    }
+
+
+class Fixed:
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def test_subscription_skips_broken_user_and_rejects_missing_format(monkeypatch):
+    monkeypatch.setattr(tgbot, 'SUB_SECRET', 'secret')
+    monkeypatch.setattr(tgbot, 'config_snapshot', Fixed({}))
+    monkeypatch.setattr(tgbot, 'users_meta', Fixed({}))
+    monkeypatch.setattr(tgbot, 'users_snapshot', Fixed({'alice': 'a', 'bob': 'b'}))
+    monkeypatch.setattr(tgbot, 'client_params', lambda conf: {})
+
+    async def no_ipv6():
+        return None
+
+    def render_link(conf, name, uuid):
+        if name == 'bob':
+            raise ValueError('broken')
+        return 'vless://a@example.com:443'
+
+    monkeypatch.setattr(tgbot, 'get_ipv6', no_ipv6)
+    monkeypatch.setattr(tgbot, 'render_link', render_link)
+    monkeypatch.setattr(tgbot, 'xray_client_config', lambda c, name, uuid: {'name': name})
+    monkeypatch.setattr(tgbot, 'singbox_client_config', lambda c, name, uuid: None)
+
+    server = tgbot.SubscriptionServer('https://example.com/sub')
+
+    async def get(name, fmt):
+        target = f'/sub/{name}/{tgbot.sub_token(name)}?format={fmt}'
+        status, _, body = await server.handle(b'GET', target, {})
+        return status.split()[0], body
+
+    async def run():
+        return [await get('alice', 'xray'), await get('alice', 'sing-box'),
+                await get('alice', 'clash'), await get('bob', 'base64')]
+
+    xray, singbox, unknown, broken = asyncio.run(run())
+    assert xray == ('200', b'{\n  "name": "alice"\n}')
+    assert singbox[0] == unknown[0] == '415'
+    assert b'base64, xray' in singbox[1]
+    assert broken == ('404', b'')
+
+
+@pytest.mark.parametrize('conf, rmu', [
+    ({'api': {}, 'inbounds': [{'tag': 'inbound', 'settings': {'clients': [{'email': 'alice'}, {'email': 'bob'}]}}]}, True),
+    ({'inbounds': [{'tag': 'inbound', 'users': [{'name': 'alice'}, {'name': 'bob'}]}]}, False),
+])
+def test_kick_users_leaves_engine_conf_to_script(tmp_path, monkeypatch, conf, rmu):
+    engine = tmp_path / 'engine.conf'
+    engine.write_text(json.dumps(conf))
+    calls, submitted = [], []
+
+    async def engine_api(*args, **kw):
+        calls.append(args)
+        return ''
+
+    monkeypatch.setattr(tgbot, 'ENGINE_FILE', str(engine))
+    monkeypatch.setattr(tgbot, 'engine_api', engine_api)
+    monkeypatch.setattr(tgbot.reconfigure, 'submit', lambda bot, chat_id, label, *a: submitted.append((chat_id, label)))
+    asyncio.run(tgbot.kick_users({'bob', 'carol'}))
+
+    assert calls == ([('rmu', '-tag=inbound', 'bob')] if rmu else [])
+    assert submitted == [(None, 'выключение: bob')]
+    assert json.loads(engine.read_text()) == conf
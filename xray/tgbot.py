@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 import os
 import re
-import subprocess
+import signal
+import fcntl
+import asyncio
+import bisect
+import itertools
+import hashlib
+import hmac
+import base64
+import json
+import shlex
+import functools
+import contextlib
+from uuid import uuid4
+import glob
+import time
+import urllib.request
+import urllib.error
 import logging
 import zipfile
-from datetime import datetime
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 import io
+import html
 import qrcode
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -28,12 +51,29 @@ logger = logging.getLogger(__name__)
 DATA_DIR = '/opt/reality-ezpz'
 CONFIG_FILE = os.path.join(DATA_DIR, 'config')
 USERS_FILE = os.path.join(DATA_DIR, 'users')
+# Квоты, сроки и включённость пользователей (parse_users_meta в reality-ezpz)
+USERS_META_FILE = os.path.join(DATA_DIR, 'users.meta')
+ENGINE_FILE = os.path.join(DATA_DIR, 'engine.conf')
+# Общий со скриптом кеш публичных адресов (ipv4=, ipv6=, *_time=)
+ADDRESS_CACHE_FILE = os.path.join(DATA_DIR, '.address-cache')
+# Общая со скриптом advisory-блокировка записи config и users
+LOCK_FILE = os.path.join(DATA_DIR, '.lock')
+# Ряд трафика пользователей и его снимок, который читают бот и --user-stats
+STATS_DB = os.path.join(DATA_DIR, 'stats.db')
+TRAFFIC_FILE = os.path.join(DATA_DIR, 'traffic.json')
+# Кто подключён сейчас: подключения и IP по пользователям
+ONLINE_FILE = os.path.join(DATA_DIR, 'online.json')
+# gRPC API engine (engine_api_port в reality-ezpz) внутри контейнера engine
+ENGINE_API = '127.0.0.1:10085'
 
 SCRIPT_URL = 'https://raw.githubusercontent.com/qp-io/qp-io.github.io/refs/heads/main/xray/reality-ezpz.sh'
+SYSTEMCTL_STUB = 'function systemctl() { :; }; export -f systemctl; '
+# Запасной вариант, если локальной копии скрипта ещё нет
 BASE_CMD = (
-    'function systemctl() { :; }; export -f systemctl; '
+    SYSTEMCTL_STUB +
     f'bash <(curl -sL {SCRIPT_URL} | sed "s/docker run --rm -it/docker run --rm/g") '
 )
+SCRIPT_CACHE_DIR = os.path.join(DATA_DIR, 'tgbot', 'cache')
 
 # --- Переменные окружения ---
 TOKEN = os.environ.get('BOT_TOKEN')
@@ -41,96 +81,1871 @@ if not TOKEN:
     raise SystemExit("BOT_TOKEN env is not set")
 
 ADMIN = os.environ.get('BOT_ADMIN', '')
+# Сколько запусков скрипта может выполняться одновременно. Параллельно идут
+# только запуски на чтение (READONLY_FLAGS); меняющие состояние — по одному
+SCRIPT_WORKERS = int(os.environ.get('BOT_SCRIPT_WORKERS', '2'))
+# Как часто (сек) проверять обновление скрипта на GitHub
+SCRIPT_REFRESH = int(os.environ.get('BOT_SCRIPT_REFRESH', '3600'))
 username_regex = re.compile(r"^[a-zA-Z0-9]+$")
+# Сколько секунд доверять найденному IPv6 адресу (как REALITY_ADDRESS_TTL)
+IPV6_TTL = int(os.environ.get('BOT_IPV6_TTL', '21600'))
+# ...и пустому ответу: IPv6 нет или запрос не прошёл (как REALITY_ADDRESS_NEGATIVE_TTL)
+IPV6_NEGATIVE_TTL = int(os.environ.get('BOT_IPV6_NEGATIVE_TTL', '300'))
+# Отрисовка QR: число процессов, размер и время жизни кеша (сек)
+QR_WORKERS = int(os.environ.get('BOT_QR_WORKERS', '2'))
+QR_CACHE_SIZE = int(os.environ.get('BOT_QR_CACHE_SIZE', '256'))
+QR_CACHE_TTL = int(os.environ.get('BOT_QR_CACHE_TTL', '86400'))
+# Пауза (сек) между альбомами QR и число повторов альбома после RetryAfter:
+# альбом из 10 фото Telegram считает за 10 сообщений
+QR_GROUP_DELAY = float(os.environ.get('BOT_QR_GROUP_DELAY', '3'))
+QR_GROUP_RETRIES = int(os.environ.get('BOT_QR_GROUP_RETRIES', '5'))
+# Сколько пользователей показывать на одной странице списка
+PAGE_SIZE = int(os.environ.get('BOT_PAGE_SIZE', '20'))
+# Сколько секунд ждать следующих изменений настроек перед reconfigure
+RECONFIGURE_DELAY = float(os.environ.get('BOT_RECONFIGURE_DELAY', '3'))
+# Хвост вывода скрипта в сообщении: период обновления (сек) и число строк
+PROGRESS_INTERVAL = float(os.environ.get('BOT_PROGRESS_INTERVAL', '2'))
+PROGRESS_LINES = int(os.environ.get('BOT_PROGRESS_LINES', '25'))
+# Сколько секунд ждать общей со скриптом блокировки (как flock -w 30 в скрипте)
+LOCK_TIMEOUT = float(os.environ.get('BOT_LOCK_TIMEOUT', '30'))
+# Сколько секунд после SIGTERM ждать завершения группы процессов до SIGKILL
+CANCEL_GRACE = float(os.environ.get('BOT_CANCEL_GRACE', '5'))
+# Webhook вместо polling: задаёт reality-ezpz (--enable-tgbot-webhook), когда
+# перед ботом есть haproxy. Пустой BOT_WEBHOOK_URL — обычный polling.
+WEBHOOK_URL = os.environ.get('BOT_WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.environ.get('BOT_WEBHOOK_SECRET', '')
+WEBHOOK_PORT = int(os.environ.get('BOT_WEBHOOK_PORT', '8088'))
+# Самоподписанный сертификат, который нужно передать Telegram в setWebhook
+WEBHOOK_CERT = os.environ.get('BOT_WEBHOOK_CERT', '')
+# Как часто (сек) проверять getWebhookInfo
+WEBHOOK_CHECK = int(os.environ.get('BOT_WEBHOOK_CHECK', '60'))
+# Порт /metrics в формате Prometheus; 0 — метрики не отдаются
+METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', '0'))
+# Адрес /metrics. В docker-контейнере reality-ezpz ставит 0.0.0.0: порт
+# публикуется только на 127.0.0.1 хоста, но виден контейнерам в сетях бота
+METRICS_LISTEN = os.environ.get('BOT_METRICS_LISTEN', '127.0.0.1')
+# Проект docker compose инстанса: через него бот обращается к engine
+COMPOSE_PROJECT = os.environ.get('BOT_COMPOSE_PROJECT', os.path.basename(DATA_DIR))
+# Как часто (сек) снимать счётчики трафика с engine; 0 — не собирать
+STATS_INTERVAL = int(os.environ.get('BOT_STATS_INTERVAL', '60'))
+# Сколько дней хранить ряд по интервалам сбора (суммы по дням хранятся всегда)
+STATS_RETENTION = int(os.environ.get('BOT_STATS_RETENTION', '30'))
+# Как часто (сек) сверять трафик и сроки с ограничениями пользователей
+LIMITS_INTERVAL = int(os.environ.get('BOT_LIMITS_INTERVAL', '60'))
+# Как часто (сек) опрашивать онлайн-статистику engine; 0 — не опрашивать
+ONLINE_INTERVAL = int(os.environ.get('BOT_ONLINE_INTERVAL', '30'))
+# Скольким онлайн-пользователям за опрос запрашивать список IP (по процессу
+# xray api на каждого); остальные берутся по кругу в следующих опросах
+ONLINE_BATCH = int(os.environ.get('BOT_ONLINE_BATCH', '50'))
+# Подписки: задаёт reality-ezpz (--enable-subscription), когда перед ботом
+# есть haproxy. Пустой BOT_SUB_URL — подписки не раздаются.
+SUB_URL = os.environ.get('BOT_SUB_URL', '')
+SUB_SECRET = os.environ.get('BOT_SUB_SECRET', '')
+SUB_PORT = int(os.environ.get('BOT_SUB_PORT', '8089'))
+# Через сколько часов клиенту перезапрашивать подписку (Profile-Update-Interval)
+SUB_UPDATE_HOURS = int(os.environ.get('BOT_SUB_UPDATE_HOURS', '12'))
+
+
+# --- Метрики Prometheus ---
+
+def _label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(sorted(buckets))
+        self.labels = labels
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        item = self._values.get(key)
+        if item is None:
+            item = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            item['counts'][i] += 1
+        item['sum'] += value
+        item['count'] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} histogram']
+        for key, item in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self.buckets, item['counts']):
+                total += count
+                le = _labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{le} {total}')
+            le = _labels(self.labels, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{le} {item["count"]}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {item["sum"]:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {item["count"]}')
+        return lines
+
+
+class Gauge:
+    """Значение считается в момент сбора: collect() -> {(метки,): число}."""
+
+    def __init__(self, name: str, doc: str, collect, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.collect = collect
+        self.labels = labels
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Metrics:
+    """Реестр метрик и /metrics на asyncio-сервере в event loop бота.
+
+    Счётчики обновляются всегда (это пара операций со словарём), а
+    HTTP-сервер поднимается, только если задан BOT_METRICS_PORT.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._server = None
+
+    def add(self, metric):
+        self._items.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._items:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f'metric {metric.name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+    async def _serve(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            method, target = (head.split(b' ', 2) + [b'', b''])[:2]
+            if method == b'GET' and target.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, host, port)
+            logger.info(f'metrics on http://{host}:{port}/metrics')
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics = Metrics()
+handler_seconds = metrics.add(Histogram(
+    'tgbot_handler_seconds', 'Время обработки обновления по команде',
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300), ('command',)
+))
+handler_errors = metrics.add(Counter(
+    'tgbot_handler_errors_total', 'Исключения в обработчиках по команде', ('command',)
+))
+script_seconds = metrics.add(Histogram(
+    'tgbot_script_seconds', 'Длительность запуска скрипта по классу аргументов',
+    (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600), ('args',)
+))
+script_runs = metrics.add(Counter(
+    'tgbot_script_runs_total', 'Запуски скрипта по классу аргументов и коду выхода', ('args', 'exit')
+))
+qr_render_seconds = metrics.add(Histogram(
+    'tgbot_qr_render_seconds', 'Рендер PNG QR-кода в пуле процессов',
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+telegram_errors = metrics.add(Counter(
+    'tgbot_telegram_errors_total', 'Ошибки запросов к Bot API по методу и типу', ('method', 'error')
+))
+subscription_requests = metrics.add(Counter(
+    'tgbot_subscription_requests_total', 'Запросы подписок по формату и статусу ответа', ('format', 'status')
+))
+telegram_retries = metrics.add(Counter(
+    'tgbot_telegram_retries_total', 'Повторы после RetryAfter (flood control)', ('method',)
+))
+
+
+def script_arg_class(args: str) -> str:
+    """Класс запуска для меток: первый флаг без значения (--add-user bob -> add-user)."""
+    m = re.match(r'\s*--?([a-z][a-z0-9-]*)', args)
+    return m.group(1) if m else 'reconfigure'
+
+
+def handler_command(update: Update, context) -> str:
+    """Метка обработчика: команда кнопки, /команда, состояние ввода или документ."""
+    if update.callback_query and update.callback_query.data:
+        return update.callback_query.data.split('!')[0]
+    msg = update.effective_message
+    if msg is None:
+        return 'other'
+    if msg.document:
+        return 'document'
+    text = msg.text or ''
+    if text.startswith('/'):
+        return text.split()[0].split('@')[0]
+    state = context.user_data.get('state') if context.user_data is not None else None
+    return f'input:{state}' if state else 'text'
+
+
+def observed(func):
+    """Пишет время обработки и исключения в метрики с меткой команды."""
+    @functools.wraps(func)
+    async def wrap(update: Update, context: ContextTypes.DEFAULT_TYPE, *a, **kw):
+        command = handler_command(update, context)
+        started = time.perf_counter()
+        try:
+            return await func(update, context, *a, **kw)
+        except Exception:
+            handler_errors.inc(command=command)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, command=command)
+    return wrap
+
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest, который считает ошибки Bot API по методам."""
+
+    async def post(self, url: str, *args, **kwargs):
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            telegram_errors.inc(method=url.rsplit('/', 1)[-1], error=type(e).__name__)
+            raise
 
 
 # --- Вспомогательные функции ---
 
-def run_script(extra_args: str = '', timeout: int = 300) -> tuple:
-    """Запускает скрипт. Возвращает (exit_code, output)."""
-    cmd = BASE_CMD + extra_args
+class ScriptCache:
+    """Локальная копия reality-ezpz.sh внутри контейнера бота.
+
+    Файл уже пропатчен (sed для `docker run --rm -it` применён один раз)
+    и назван по sha256 содержимого, поэтому никогда не меняется на месте:
+    запущенный bash дочитывает свою версию, даже если вышла новая.
+    Обновление идёт в фоне по ETag / If-None-Match.
+    """
+
+    def __init__(self, url: str, cache_dir: str):
+        self.url = url
+        self.dir = cache_dir
+        self.meta_path = os.path.join(cache_dir, 'meta.json')
+        self.meta = {}
+        self._lock = asyncio.Lock()
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def path(self):
+        p = self.meta.get('file')
+        if p and os.path.exists(p):
+            return p
+        return None
+
+    def command(self) -> str:
+        p = self.path()
+        if not p:
+            return BASE_CMD
+        return SYSTEMCTL_STUB + f'bash {shlex.quote(p)} '
+
+    def _fetch(self):
+        headers = {}
+        if self.meta.get('etag') and self.path():
+            headers['If-None-Match'] = self.meta['etag']
+        req = urllib.request.Request(self.url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=15) as resp:
+                body = resp.read()
+                etag = resp.headers.get('ETag', '')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.meta['checked'] = int(time.time())
+                self._save_meta()
+                return
+            raise
+        script = body.decode('utf-8').replace('docker run --rm -it', 'docker run --rm')
+        digest = hashlib.sha256(script.encode('utf-8')).hexdigest()
+        os.makedirs(self.dir, exist_ok=True)
+        target = os.path.join(self.dir, f'reality-ezpz-{digest[:16]}.sh')
+        if not os.path.exists(target):
+            tmp = target + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(script)
+            os.replace(tmp, target)
+            logger.info(f'script cache: new version {digest[:16]}')
+        for old in glob.glob(os.path.join(self.dir, 'reality-ezpz-*.sh')):
+            if old != target:
+                os.remove(old)
+        self.meta = {
+            'file': target,
+            'sha256': digest,
+            'etag': etag,
+            'checked': int(time.time()),
+        }
+        self._save_meta()
+
+    def _save_meta(self):
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.meta_path)
+
+    async def refresh(self):
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._fetch)
+            except Exception as e:
+                logger.warning(f'script cache refresh: {e}')
+
+    async def ensure(self):
+        """Гарантирует локальную копию перед первым запуском."""
+        if not self.path():
+            await self.refresh()
+
+    async def refresh_loop(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(SCRIPT_REFRESH)
+
+
+script_cache = ScriptCache(SCRIPT_URL, SCRIPT_CACHE_DIR)
+
+
+class ScriptJob:
+    """Один запуск скрипта: id, аргументы, таймаут, процесс и флаг отмены."""
+
+    def __init__(self, job_id: int, args: str, timeout: int, on_line=None):
+        self.id = job_id
+        self.args = args
+        self.timeout = timeout
+        self.on_line = on_line
+        self.proc = None
+        self.started = None
+        self.cancelled = False
+
+
+# Флаги скрипта, которые ничего не меняют (fast path readonly в reality-ezpz)
+READONLY_FLAGS = frozenset((
+    '--show-user', '--list-users', '--user-stats', '--online', '--show-server-config', '--export-links',
+))
+
+
+def script_readonly(args: str) -> bool:
+    """True — запуск только читает: все флаги из READONLY_FLAGS.
+    Пустые аргументы — это reconfigure, он пишет всё."""
+    flags = [a for a in shlex.split(args) if a.startswith('-')]
+    return bool(flags) and all(f.split('=', 1)[0] in READONLY_FLAGS for f in flags)
+
+
+class ScriptExecutor:
+    """Асинхронный запуск скрипта с ограниченным пулом воркеров.
+
+    Запуски, которые меняют users, config, engine или compose (add/delete,
+    reconfigure и т.п.), идут строго по одному: скрипт сливает свои
+    изменения под блокировкой, но генерируемые файлы и docker compose
+    параллельных запусков всё равно бы гонялись. Параллельно с ними и друг
+    с другом идут только запуски на чтение (--show-user, --list-users...).
+
+    Каждый процесс стартует в собственной группе, поэтому по таймауту
+    убивается всё дерево (bash, curl | sed, docker compose), а не только
+    верхний bash. Event loop бота при этом не блокируется.
+    """
+
+    def __init__(self, workers: int):
+        self._slots = asyncio.Semaphore(max(1, workers))
+        self._writer = asyncio.Lock()
+        self._ids = itertools.count(1)
+        self.jobs = {}
+
+    def queued(self) -> int:
+        """Количество задач, которые ещё ждут свободного воркера."""
+        return sum(1 for j in self.jobs.values() if j.proc is None)
+
+    def new_job(self, extra_args: str = '', timeout: int = 300, on_line=None) -> ScriptJob:
+        """Регистрирует задачу заранее, чтобы её id можно было показать в кнопке отмены."""
+        job = ScriptJob(next(self._ids), extra_args, timeout, on_line)
+        self.jobs[job.id] = job
+        return job
+
+    async def run_job(self, job: ScriptJob) -> tuple:
+        try:
+            await script_cache.ensure()
+            # Очередь пишущих — до занятия слота, чтобы ждущие её не
+            # занимали слоты запусков на чтение
+            async with contextlib.nullcontext() if script_readonly(job.args) else self._writer:
+                async with self._slots:
+                    if job.cancelled:
+                        return 1, "Отменено до запуска."
+                    return await self._execute(job)
+        finally:
+            self.jobs.pop(job.id, None)
+
+    async def run(self, extra_args: str = '', timeout: int = 300, on_line=None) -> tuple:
+        return await self.run_job(self.new_job(extra_args, timeout, on_line))
+
+    def cancel(self, job_id: int) -> bool:
+        """Отменяет задачу: ещё не запущенная не стартует, запущенная завершается."""
+        job = self.jobs.get(job_id)
+        if job is None or job.cancelled:
+            return False
+        job.cancelled = True
+        logger.info(f'job #{job.id} cancel requested')
+        if job.proc is not None and job.proc.returncode is None:
+            asyncio.create_task(self._terminate(job))
+        return True
+
+    async def _execute(self, job: ScriptJob) -> tuple:
+        loop = asyncio.get_running_loop()
+        job.started = loop.time()
+        logger.info(f'job #{job.id} start: {job.args or "(reconfigure)"}')
+        try:
+            job.proc = await asyncio.create_subprocess_exec(
+                '/bin/bash', '-c', script_cache.command() + job.args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+                limit=1024 * 1024
+            )
+            out, err = [], []
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    self._read(job, job.proc.stdout, out),
+                    self._read(job, job.proc.stderr, err),
+                    job.proc.wait()
+                ), job.timeout)
+            except asyncio.TimeoutError:
+                await self._terminate(job)
+                await job.proc.wait()
+                logger.warning(f'job #{job.id} timeout after {job.timeout}s')
+                self._observe(job, 'timeout')
+                return 1, "Команда заняла слишком много времени."
+            except asyncio.CancelledError:
+                self._kill(job)
+                self._observe(job, 'cancelled')
+                raise
+        except Exception as e:
+            logger.error(f'job #{job.id}: {e}')
+            self._observe(job, 'error')
+            return 1, str(e)
+        out_s = '\n'.join(out).strip()
+        err_s = '\n'.join(err).strip()
+        if job.proc.returncode != 0 and err_s:
+            combined = out_s + '\n' + err_s
+        else:
+            combined = out_s
+        logger.info(
+            f'job #{job.id} {"cancelled, " if job.cancelled else ""}exit {job.proc.returncode} '
+            f'in {loop.time() - job.started:.1f}s'
+        )
+        self._observe(job, 'cancelled' if job.cancelled else job.proc.returncode)
+        return job.proc.returncode, combined.strip()
+
+    @staticmethod
+    def _observe(job: ScriptJob, result):
+        arg_class = script_arg_class(job.args)
+        script_seconds.observe(asyncio.get_running_loop().time() - job.started, args=arg_class)
+        script_runs.inc(args=arg_class, exit=result)
+
+    @staticmethod
+    async def _read(job: ScriptJob, stream, lines: list):
+        """Читает поток построчно, отдавая каждую строку в job.on_line."""
+        async for raw in stream:
+            line = raw.decode(errors='ignore').rstrip('\r\n')
+            lines.append(line)
+            if job.on_line:
+                try:
+                    job.on_line(line)
+                except Exception as e:
+                    logger.warning(f'job #{job.id} on_line: {e}')
+
+    @staticmethod
+    def _kill(job: ScriptJob, sig=signal.SIGKILL) -> bool:
+        """Шлёт сигнал всей группе процессов задачи. False — группы уже нет."""
+        try:
+            os.killpg(job.proc.pid, sig)
+            return True
+        except ProcessLookupError:
+            return False
+
+    async def _terminate(self, job: ScriptJob):
+        """SIGTERM всей группе (docker compose успевает завершиться сам),
+        через CANCEL_GRACE секунд — SIGKILL тем, кто остался."""
+        if not self._kill(job, signal.SIGTERM):
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CANCEL_GRACE
+        while loop.time() < deadline:
+            await asyncio.sleep(0.2)
+            if not self._kill(job, 0):
+                return
+        if self._kill(job, signal.SIGKILL):
+            logger.warning(f'job #{job.id}: SIGKILL after {CANCEL_GRACE}s')
+
+
+executor = ScriptExecutor(SCRIPT_WORKERS)
+metrics.add(Gauge(
+    'tgbot_script_jobs', 'Задачи скрипта: ждут воркера или выполняются',
+    lambda: {
+        ('waiting',): executor.queued(),
+        ('running',): len(executor.jobs) - executor.queued(),
+    },
+    ('state',)
+))
+
+
+async def run_script(extra_args: str = '', timeout: int = 300, on_line=None) -> tuple:
+    """Запускает скрипт. Возвращает (exit_code, output).
+
+    on_line(str) вызывается для каждой строки stdout/stderr по мере вывода.
+    """
+    return await executor.run(extra_args, timeout, on_line)
+
+
+class ProgressMessage:
+    """Сообщение с хвостом вывода скрипта, которое обновляется по ходу работы.
+
+    Строки копятся в deque, а edit_message_text вызывается не чаще раза
+    в PROGRESS_INTERVAL и только если хвост изменился — так долгая операция
+    видна, но не упирается в лимиты Telegram на редактирование.
+    """
+
+    def __init__(self, bot, chat_id, title: str, markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.title = title
+        self.markup = markup
+        self.tail = deque(maxlen=PROGRESS_LINES)
+        self.message_id = None
+        self._shown = None
+        self._task = None
+
+    def feed(self, line: str):
+        if line.strip():
+            self.tail.append(line)
+
+    def _text(self, head: str) -> str:
+        body = '\n'.join(self.tail)[-3500:]
+        if not body:
+            return head
+        return f"{head}\n<pre>{html.escape(body)}</pre>"
+
+    async def _edit(self, head: str):
+        shown = (self._text(head), self.markup)
+        if shown == self._shown or self.message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                shown[0], chat_id=self.chat_id, message_id=self.message_id,
+                parse_mode="HTML", reply_markup=self.markup
+            )
+            self._shown = shown
+        except RetryAfter as e:
+            telegram_retries.inc(method='editMessageText')
+            await asyncio.sleep(retry_delay(e))
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                logger.warning(f'progress edit: {e}')
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self._edit(self.title)
+
+    async def start(self):
+        msg = await self.bot.send_message(
+            self.chat_id, self.title, parse_mode="HTML", reply_markup=self.markup
+        )
+        self.message_id = msg.message_id
+        self._shown = (self.title, self.markup)
+        self._task = asyncio.create_task(self._loop())
+
+    async def finish(self, head: str, log: str, filename: str = 'log.txt'):
+        """Последнее обновление хвоста и полный лог отдельным документом."""
+        if self._task:
+            self._task.cancel()
+        self.markup = None
+        await self._edit(head)
+        if log:
+            await self.bot.send_document(
+                self.chat_id,
+                document=io.BytesIO(log.encode('utf-8')),
+                filename=filename
+            )
+
+
+class ReconfigureScheduler:
+    """Склеивает изменения настроек в один запуск reconfigure.
+
+    Изменения, пришедшие с паузой меньше RECONFIGURE_DELAY, попадают в одну
+    пачку (но пачка ждёт не дольше пяти таких пауз). Пока пачка применяется,
+    новые изменения копятся в следующую, которая запустится сразу после.
+    Аргументы скрипта объединяются по имени флага (последнее значение
+    побеждает), таймаут берётся максимальный. Каждый чат получает одно
+    сообщение с ходом применения, итог со списком изменений и полный лог;
+    изменения без чата (chat_id=None, фоновые задачи бота) применяются молча.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending = []
+        self._running = []
+        self._last = 0.0
+        self._task = None
+
+    def depth(self) -> int:
+        """Сколько изменений ждут применения или применяются сейчас."""
+        return len(self._pending) + len(self._running)
+
+    def busy(self) -> bool:
+        return bool(self._running)
+
+    def submit(self, bot, chat_id, label: str, args: str = '', timeout: int = 300) -> int:
+        """Добавляет изменение в пачку. Возвращает глубину очереди."""
+        self._pending.append({
+            'bot': bot, 'chat_id': chat_id, 'label': label,
+            'args': args, 'timeout': timeout,
+        })
+        self._last = asyncio.get_running_loop().time()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._worker())
+        return self.depth()
+
+    @staticmethod
+    def merge_args(batch: list) -> str:
+        flags = {}
+        for item in batch:
+            if item['args']:
+                flags[item['args'].split()[0]] = item['args']
+        return ' '.join(flags.values())
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            started = loop.time()
+            while True:
+                wait = self._last + self.delay - loop.time()
+                if wait <= 0 or loop.time() - started >= self.delay * 5:
+                    break
+                await asyncio.sleep(wait)
+            batch, self._pending = self._pending, []
+            self._running = batch
+            progress = []
+
+            def feed(line):
+                for p, _ in progress:
+                    p.feed(line)
+
+            job = executor.new_job(
+                self.merge_args(batch),
+                timeout=max(item['timeout'] for item in batch),
+                on_line=feed
+            )
+            cancel_kb = InlineKeyboardMarkup(
+                [[InlineKeyboardButton("⛔ Отменить", callback_data=f"cancel!{job.id}")]]
+            )
+            for chat_id, chat in self._chats(batch).items():
+                labels = ', '.join(chat['labels'])
+                p = ProgressMessage(chat['bot'], chat_id, f"⏳ Применяю: {labels}", cancel_kb)
+                try:
+                    await p.start()
+                except Exception as e:
+                    logger.warning(f'progress start: {e}')
+                progress.append((p, labels))
+            before = applied_state()
+            try:
+                rc, out = await executor.run_job(job)
+            except Exception as e:
+                rc, out = 1, str(e)
+            finally:
+                self._running = []
+            log_name = f"reconfigure_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
+            if job.cancelled:
+                head = "⛔ Отменено"
+                summary = html.escape(describe_applied(before, applied_state()))
+            else:
+                head = "✅ Применено" if rc == 0 else "❌ Ошибка применения"
+                summary = ''
+            for p, labels in progress:
+                try:
+                    await p.finish(f"{head}: {labels}" + (f"\n{summary}" if summary else ''), out, log_name)
+                    await send_settings_menu(p.bot, p.chat_id)
+                except Exception as e:
+                    logger.error(f'reconfigure report: {e}')
+
+    @staticmethod
+    def _chats(batch: list) -> dict:
+        chats = {}
+        for item in batch:
+            if item['chat_id'] is None:
+                continue
+            chat = chats.setdefault(item['chat_id'], {'bot': item['bot'], 'labels': []})
+            if item['label'] not in chat['labels']:
+                chat['labels'].append(item['label'])
+        return chats
+
+
+# Файлы, которые генерирует скрипт: по их mtime видно, что успело
+# записаться до отмены
+GENERATED_FILES = (
+    'engine.conf', 'haproxy.cfg', 'docker-compose.yml',
+    'certificate/server.pem', 'tgbot/docker-compose.yml',
+)
+
+
+def applied_state() -> dict:
+    files = {}
+    for name in GENERATED_FILES:
+        try:
+            files[name] = os.stat(os.path.join(DATA_DIR, name)).st_mtime_ns
+        except OSError:
+            files[name] = None
+    return {'config': read_config(), 'users': set(get_user_map()), 'files': files}
+
+
+def describe_applied(before: dict, after: dict) -> str:
+    """Что изменилось между двумя applied_state — для отчёта об отмене."""
+    lines = []
+    for key in sorted(set(before['config']) | set(after['config'])):
+        old, new = before['config'].get(key), after['config'].get(key)
+        if old != new:
+            lines.append(f"{key}: {old or '—'} → {new or '—'}")
+    added = sorted(after['users'] - before['users'])
+    removed = sorted(before['users'] - after['users'])
+    if added:
+        lines.append(f"+ пользователи: {', '.join(added)}")
+    if removed:
+        lines.append(f"− пользователи: {', '.join(removed)}")
+    files = [n for n in GENERATED_FILES if before['files'][n] != after['files'][n]]
+    if files:
+        lines.append(f"Перезаписаны: {', '.join(files)}")
+    if not lines:
+        return "Ничего не успело измениться."
+    return "Успело примениться:\n" + '\n'.join(lines)
+
+
+reconfigure = ReconfigureScheduler(RECONFIGURE_DELAY)
+metrics.add(Gauge(
+    'tgbot_reconfigure_queue', 'Изменения настроек, которые ждут применения или применяются',
+    lambda: {(): reconfigure.depth()}
+))
+
+
+async def schedule_reconfigure(bot, chat_id, label: str, text: str, args: str = '', timeout: int = 300):
+    """Ставит изменение в очередь reconfigure и сообщает глубину очереди."""
+    busy = reconfigure.busy()
+    depth = reconfigure.submit(bot, chat_id, label, args, timeout)
+    note = f"{text}\n📋 В очереди изменений: {depth}"
+    if busy:
+        note += "\nИдёт применение — изменение войдёт в следующий запуск."
+    await bot.send_message(chat_id, note)
+
+
+class FileSnapshot:
+    """Разобранное содержимое файла, которое перечитывается только при его изменении.
+
+    Актуальность проверяется одним stat(): inode, размер, mtime и ctime.
+    Скрипт пишет config/users через временный файл и mv (новый inode),
+    так что правки из CLI видны сразу при следующем обращении.
+    """
+
+    def __init__(self, path: str, parse):
+        self.path = path
+        self.parse = parse
+        self._key = None
+        self._value = parse(None)
+
+    def get(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._key = None
+            self._value = self.parse(None)
+            return self._value
+        key = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        if key != self._key:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._value = self.parse(f)
+                self._key = key
+            except (OSError, ValueError) as e:
+                logger.warning(f'{self.path}: {e}')
+        return self._value
+
+
+def parse_key_values(f) -> dict:
+    """key=value построчно; комментарии и строки без '=' пропускаются."""
+    result = {}
+    for line in f or ():
+        line = line.strip()
+        if '=' in line and not line.startswith('#'):
+            k, v = line.split('=', 1)
+            result[k.strip()] = v.strip()
+    return result
+
+
+def parse_config(f) -> dict:
+    return {k: v.strip('"').strip("'") for k, v in parse_key_values(f).items()}
+
+
+config_snapshot = FileSnapshot(CONFIG_FILE, parse_config)
+users_snapshot = FileSnapshot(USERS_FILE, parse_key_values)
+
+
+def read_config():
+    return dict(config_snapshot.get())
+
+
+def acquire_lock(lock, timeout: float = LOCK_TIMEOUT):
+    """flock без бесконечного ожидания: TimeoutError, если скрипт держит
+    блокировку дольше timeout секунд."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'{LOCK_FILE} занят дольше {timeout:.0f} с')
+            time.sleep(0.1)
+
+
+def locked_rewrite(path: str, transform):
+    """Перезаписывает файл под общей со скриптом блокировкой LOCK_FILE.
+
+    transform(lines) получает текущие строки (под блокировкой, то есть
+    свежие) и возвращает новые. Запись — временный файл, fsync, rename.
+    Ожидание блокировки синхронное: из event loop вызывать через
+    asyncio.to_thread.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(LOCK_FILE, 'a') as lock:
+        acquire_lock(lock)
+        try:
+            lines = []
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    lines = [l if l.endswith('\n') else l + '\n' for l in f]
+            new_lines = transform(lines)
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.writelines(new_lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ConfigTransaction:
+    """Набор изменений key=value, применяемый к config одной записью.
+
+    Под flock на LOCK_FILE (его же берёт reality-ezpz в update_config_file)
+    файл перечитывается, изменения накладываются, результат пишется во
+    временный файл, fsync и rename. Ни бот, ни параллельный запуск скрипта
+    не увидят обрезанный или наполовину записанный config. Скрипт, в свою
+    очередь, вносит под той же блокировкой только свои изменения и не
+    затирает записанное ботом.
+
+        tx = ConfigTransaction().set('warp', 'ON').set('warp_license', '')
+        if await tx.apply():
+            ...
+    """
+
+    def __init__(self):
+        self.changes = {}
+
+    def set(self, key: str, value: str):
+        self.changes[key] = value
+        return self
+
+    async def apply(self) -> bool:
+        """commit() в потоке: ожидание блокировки не останавливает бота."""
+        return await asyncio.to_thread(self.commit)
+
+    def _apply(self, lines: list) -> list:
+        pending = dict(self.changes)
+        new_lines = []
+        for line in lines:
+            key = line.split('=', 1)[0].strip()
+            if '=' in line and key in pending:
+                new_lines.append(f'{key}={pending.pop(key)}\n')
+            else:
+                new_lines.append(line)
+        new_lines.extend(f'{k}={v}\n' for k, v in pending.items())
+        return new_lines
+
+    def commit(self) -> bool:
+        if not self.changes:
+            return True
+        try:
+            locked_rewrite(CONFIG_FILE, self._apply)
+            self.changes = {}
+            return True
+        except Exception as e:
+            logger.error(f'config transaction {sorted(self.changes)}: {e}')
+            return False
+
+
+CONFIG_BUSY = "❌ Не удалось записать config: файл занят запуском скрипта. Повторите позже."
+
+
+def get_user_map():
+    """Пользователи из файла: {имя: uuid}. Общий снимок — не изменять."""
+    return users_snapshot.get()
+
+
+def get_users():
+    """Читает список пользователей из файла напрямую."""
+    return list(get_user_map())
+
+
+class UserIndex:
+    """Отсортированный список имён поверх users_snapshot.
+
+    Когда снимок меняется, в список вставляются/удаляются только разница
+    (bisect), а не сортируется всё заново; при крупной правке файла дешевле
+    пересобрать целиком. Страницы и поиск работают по этому списку.
+    """
+
+    def __init__(self, snapshot: FileSnapshot):
+        self.snapshot = snapshot
+        self._source = None
+        self.names = []
+
+    def refresh(self) -> list:
+        source = self.snapshot.get()
+        if source is self._source:
+            return self.names
+        old = set(self._source or ())
+        new = source.keys()
+        added = [n for n in new if n not in old]
+        removed = old - new
+        if len(added) + len(removed) > len(self.names) // 4:
+            self.names = sorted(new)
+        else:
+            for name in removed:
+                i = bisect.bisect_left(self.names, name)
+                if i < len(self.names) and self.names[i] == name:
+                    del self.names[i]
+            for name in added:
+                bisect.insort(self.names, name)
+        self._source = source
+        return self.names
+
+    def page(self, cursor: str = '', size: int = PAGE_SIZE) -> tuple:
+        """Страница, начинающаяся с имени >= cursor.
+
+        Возвращает (имена, позиция, курсор предыдущей, курсор следующей);
+        курсор — это имя, поэтому добавления и удаления между нажатиями
+        не сдвигают страницы.
+        """
+        names = self.refresh()
+        start = bisect.bisect_left(names, cursor) if cursor else 0
+        items = names[start:start + size]
+        prev = names[max(0, start - size)] if start > 0 else None
+        nxt = names[start + size] if start + size < len(names) else None
+        return items, start, prev, nxt
+
+    def find(self, query: str, limit: int = PAGE_SIZE) -> tuple:
+        """Сначала совпадения по префиксу (bisect), затем по подстроке.
+
+        Возвращает (первые limit имён, общее число совпадений).
+        """
+        names = self.refresh()
+        q = query.lower()
+        lo = bisect.bisect_left(names, query)
+        hi = bisect.bisect_left(names, query + '\U0010ffff', lo)
+        found = names[lo:hi]
+        seen = set(found)
+        found += [n for n in names if q in n.lower() and n not in seen]
+        return found[:limit], len(found)
+
+
+user_index = UserIndex(users_snapshot)
+
+
+# --- Массовый импорт и удаление ---
+uuid_regex = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+# Размер загружаемого списка пользователей
+IMPORT_MAX_BYTES = 2 * 1024 * 1024
+
+
+def parse_user_list(text: str) -> tuple:
+    """Список пользователей из CSV/TXT, как read_user_list_file в reality-ezpz.
+
+    Имя — первое поле строки, за ним через , ; = или пробел может идти
+    uuid. Возвращает ({имя: uuid или ''}, число неверных строк).
+    """
+    result = {}
+    invalid = 0
+    first = True
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        fields = re.split(r'[,;=\s]+', line)
+        name = fields[0]
+        if first:
+            first = False
+            if name.lower() in ('name', 'user', 'username', 'имя'):
+                continue
+        if not username_regex.match(name):
+            invalid += 1
+            continue
+        result[name] = fields[1] if len(fields) > 1 else ''
+    return result, invalid
+
+
+def apply_users_batch(add: dict = None, remove=()) -> dict:
+    """Добавляет и удаляет пользователей одной записью файла users.
+
+    Новым без корректного uuid выдаётся uuid4. Удалить всех нельзя —
+    как и в скрипте, тогда ValueError и файл не меняется.
+    """
+    stats = {'added': 0, 'existing': 0, 'deleted': 0, 'missing': 0}
+
+    def transform(lines):
+        current = parse_key_values(lines)
+        for name in remove:
+            if name in current:
+                stats['deleted'] += 1
+            else:
+                stats['missing'] += 1
+        if stats['deleted'] and stats['deleted'] >= len(current):
+            raise ValueError("Нельзя удалить всех пользователей.")
+        drop = set(remove)
+        new_lines = [
+            l for l in lines
+            if not ('=' in l and l.split('=', 1)[0].strip() in drop)
+        ]
+        for name, uuid in (add or {}).items():
+            if name in current and name not in drop:
+                stats['existing'] += 1
+                continue
+            if not uuid_regex.match(uuid):
+                uuid = str(uuid4())
+            new_lines.append(f'{name}={uuid}\n')
+            stats['added'] += 1
+        return new_lines
+
+    locked_rewrite(USERS_FILE, transform)
+    return stats
+
+
+def collect_links() -> tuple:
+    """Ссылки всех пользователей по имени. Форматы, которые знает только
+    скрипт, добираются через --show-user."""
+    conf = read_config()
+    users = get_user_map()
+    result = []
+    missing = []
+    for name in sorted(users):
+        link = render_link(conf, name, users[name])
+        if link:
+            result.append((name, link))
+        else:
+            missing.append(name)
+    return result, missing
+
+
+async def export_links_document(bot, chat_id):
+    links, missing = collect_links()
+    if not links and not missing:
+        await bot.send_message(chat_id, "Список пуст.")
+        return
+    lines = []
+    ipv6 = await get_ipv6() if links else ''
+    conf = read_config()
+    for name, link in links:
+        lines.append(link)
+        if ipv6:
+            lines.append(ipv6_link(link, conf, name, ipv6))
+    for name in missing:
+        lines.extend(await get_user_conf(name))
+    await bot.send_document(
+        chat_id,
+        document=io.BytesIO(('\n'.join(lines) + '\n').encode('utf-8')),
+        filename=f"links_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.txt",
+        caption=f"🔗 Ссылки {len(links) + len(missing)} пользователей"
+    )
+
+
+async def import_users(bot, chat_id, text: str, mode: str):
+    """Применяет загруженный список: одна запись users и один reconfigure."""
+    entries, invalid = parse_user_list(text)
+    if not entries:
+        await bot.send_message(chat_id, f"❌ В файле нет имён пользователей (неверных строк: {invalid}).")
+        return
+    try:
+        if mode == "del":
+            stats = await asyncio.to_thread(apply_users_batch, remove=list(entries))
+            summary = f"удалено {stats['deleted']}, не найдено {stats['missing']}"
+            label = f"удаление списком: −{stats['deleted']}"
+            changed = stats['deleted']
+        else:
+            stats = await asyncio.to_thread(apply_users_batch, add=entries)
+            summary = f"добавлено {stats['added']}, уже существовали {stats['existing']}"
+            label = f"импорт: +{stats['added']}"
+            changed = stats['added']
+    except (ValueError, TimeoutError) as e:
+        await bot.send_message(chat_id, f"❌ {e}")
+        return
+    text = f"📋 Список: {summary}, неверных строк {invalid}."
+    if not changed:
+        await bot.send_message(chat_id, text + "\nМенять нечего.")
+        return
+    await schedule_reconfigure(bot, chat_id, label, text)
+
+
+# --- Статистика трафика ---
+
+async def engine_exec(*argv, timeout: int = 30) -> str:
+    """Команда внутри контейнера engine (docker compose exec). Возвращает stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        'docker', 'compose', '--project-directory', DATA_DIR, '-p', COMPOSE_PROJECT,
+        'exec', '-T', 'engine', *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f'{argv[0]}: timeout')
+    if proc.returncode != 0:
+        raise RuntimeError(f'{" ".join(argv[:3])}: {err.decode(errors="ignore").strip() or proc.returncode}')
+    return out.decode(errors='ignore')
+
+
+async def engine_api(*args, timeout: int = 30) -> str:
+    """xray api <команда> внутри контейнера engine."""
+    return await engine_exec('xray', 'api', args[0], f'--server={ENGINE_API}', *args[1:], timeout=timeout)
+
+
+def write_json(path: str, data: dict):
+    """Атомарная запись JSON-снимка: временный файл и rename."""
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def parse_user_traffic(reply: dict) -> dict:
+    """statsquery -> {имя: [uplink, downlink]}.
+
+    Имена счётчиков: user>>>ИМЯ>>>traffic>>>uplink. Нулевые значения
+    protobuf опускает, int64 приходит строкой.
+    """
+    result = {}
+    for stat in reply.get('stat') or ():
+        parts = stat.get('name', '').split('>>>')
+        if len(parts) != 4 or parts[0] != 'user' or parts[2] != 'traffic':
+            continue
+        value = int(stat.get('value') or 0)
+        if value:
+            pair = result.setdefault(parts[1], [0, 0])
+            pair[0 if parts[3] == 'uplink' else 1] += value
+    return result
+
+
+class TrafficStore:
+    """SQLite-ряд трафика пользователей и снимок traffic.json для чтения.
+
+    Engine отдаёт приращения (statsquery -reset). Они пишутся в ряд по
+    интервалам сбора (traffic, хранится STATS_RETENTION дней), в суммы
+    по дням (daily) и за всё время (totals). Бот и --user-stats читают
+    только traffic.json, который пересобирается после каждого сбора.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS traffic (
+            ts INTEGER NOT NULL, user TEXT NOT NULL, uplink INTEGER NOT NULL, downlink INTEGER NOT NULL,
+            PRIMARY KEY (ts, user)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily (
+            day TEXT NOT NULL, user TEXT NOT NULL, uplink INTEGER NOT NULL, downlink INTEGER NOT NULL,
+            PRIMARY KEY (day, user)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS totals (
+            user TEXT PRIMARY KEY, uplink INTEGER NOT NULL, downlink INTEGER NOT NULL, since INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, db_path: str, snapshot_path: str):
+        self.db_path = db_path
+        self.snapshot_path = snapshot_path
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def record(self, deltas: dict, ts: int) -> dict:
+        """Записывает приращения и пересобирает снимок. Вызывается в потоке."""
+        now = datetime.fromtimestamp(ts)
+        day = now.strftime('%Y-%m-%d')
+        rows = [(ts, name, up, down) for name, (up, down) in deltas.items()]
+        db = self._conn()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO traffic VALUES (?, ?, ?, ?)', rows)
+            db.executemany(
+                'INSERT INTO daily VALUES (?, ?, ?, ?) ON CONFLICT (day, user) DO UPDATE SET '
+                'uplink = uplink + excluded.uplink, downlink = downlink + excluded.downlink',
+                [(day, name, up, down) for _, name, up, down in rows]
+            )
+            db.executemany(
+                'INSERT INTO totals VALUES (?, ?, ?, ?) ON CONFLICT (user) DO UPDATE SET '
+                'uplink = uplink + excluded.uplink, downlink = downlink + excluded.downlink',
+                [(name, up, down, ts) for _, name, up, down in rows]
+            )
+            db.execute('DELETE FROM traffic WHERE ts < ?', (ts - STATS_RETENTION * 86400,))
+        snapshot = self.snapshot(ts, day, now.strftime('%Y-%m-01'))
+        self._write(snapshot)
+        return snapshot
+
+    def snapshot(self, ts: int, day: str, month: str) -> dict:
+        db = self._conn()
+        users = {}
+        for name, up, down, since in db.execute('SELECT user, uplink, downlink, since FROM totals'):
+            users[name] = {'today': [0, 0], 'month': [0, 0], 'total': [up, down], 'since': since}
+        for name, up, down in db.execute(
+            'SELECT user, SUM(uplink), SUM(downlink) FROM daily WHERE day >= ? GROUP BY user', (month,)
+        ):
+            if name in users:
+                users[name]['month'] = [up, down]
+        for name, up, down in db.execute('SELECT user, uplink, downlink FROM daily WHERE day = ?', (day,)):
+            if name in users:
+                users[name]['today'] = [up, down]
+        return {'updated': ts, 'interval': STATS_INTERVAL, 'users': users}
+
+    def _write(self, snapshot: dict):
+        write_json(self.snapshot_path, snapshot)
+
+
+traffic_store = TrafficStore(STATS_DB, TRAFFIC_FILE)
+traffic_snapshot = FileSnapshot(TRAFFIC_FILE, lambda f: json.load(f) if f else {'users': {}})
+
+
+async def traffic_collector():
+    """Каждые STATS_INTERVAL секунд забирает приращения счётчиков из engine."""
+    failing = False
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        try:
+            reply = await engine_api('statsquery', '-pattern', 'user>>>', '-reset')
+            deltas = parse_user_traffic(json.loads(reply or '{}'))
+            await asyncio.to_thread(traffic_store.record, deltas, int(time.time()))
+            failing = False
+        except Exception as e:
+            # Engine перезапускается или ещё без StatsService — пишем в лог один раз
+            if not failing:
+                logger.warning(f'traffic stats: {e}')
+            failing = True
+
+
+def human_bytes(n: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def traffic_report(limit: int = 30) -> str:
+    """Таблица трафика текущих пользователей по убыванию за месяц."""
+    snap = traffic_snapshot.get()
+    if not snap.get('updated'):
+        return "📊 Статистика трафика ещё не собрана."
+    stats = snap.get('users', {})
+    zero = {'today': [0, 0], 'month': [0, 0], 'total': [0, 0]}
+    rows = sorted(
+        ((name, stats.get(name, zero)) for name in get_user_map()),
+        key=lambda r: -sum(r[1]['month'])
+    )
+    lines = [f"{'Пользователь':<16} {'Сегодня':>10} {'Месяц':>10} {'Всего':>10}"]
+    for name, t in rows[:limit]:
+        lines.append(
+            f"{name[:16]:<16} {human_bytes(sum(t['today'])):>10} "
+            f"{human_bytes(sum(t['month'])):>10} {human_bytes(sum(t['total'])):>10}"
+        )
+    if len(rows) > limit:
+        lines.append(f"… и ещё {len(rows) - limit}")
+    month = sum(sum(t['month']) for _, t in rows)
+    updated = datetime.fromtimestamp(snap['updated']).strftime('%Y-%m-%d %H:%M')
+    return (
+        f"📊 <b>Трафик</b> (за месяц всего {human_bytes(month)}, обновлено {updated})\n"
+        f"<pre>{html.escape(chr(10).join(lines))}</pre>"
+    )
+
+
+# --- Подключения онлайн ---
+# Кто онлайн — один вызов statsgetallonlineusers. Списки IP есть только по
+# одному пользователю (statsonlineiplist), поэтому за опрос их берут не
+# больше ONLINE_BATCH в одном exec: сначала пользователей с лимитом
+# устройств, затем остальных по кругу. Ответы — поток JSON-объектов.
+ONLINE_QUERY = 'for e in "$@"; do xray api statsonlineiplist --server=$S -email "$e" || true; done'
+
+
+def parse_json_stream(text: str) -> list:
+    decoder = json.JSONDecoder()
+    result = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        obj, end = decoder.raw_decode(text, pos)
+        result.append(obj)
+        pos = end
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+    return result
+
+
+def online_user_name(counter: str) -> str:
+    """user>>>ИМЯ>>>online -> ИМЯ."""
+    parts = counter.split('>>>')
+    return parts[1] if len(parts) == 3 and parts[0] == 'user' else counter
+
+
+def parse_online(replies: list) -> dict:
+    """Ответы statsonlineiplist -> {имя: {conns, ips: {ip: last_seen}}}.
+
+    conns — число IP: OnlineMap engine считает подключения по адресам.
+    """
+    users = {}
+    for reply in replies:
+        if 'ips' in reply or 'name' in reply:
+            name = online_user_name(reply.get('name', ''))
+            ips = {ip: int(ts) for ip, ts in (reply.get('ips') or {}).items()}
+            users[name] = {'conns': len(ips), 'ips': ips}
+    return {n: u for n, u in users.items() if u['ips']}
+
+
+def rotate(names: list, cursor: str, size: int) -> list:
+    """size имён из отсортированного списка, начиная после cursor, по кругу."""
+    i = bisect.bisect_right(names, cursor)
+    return (names[i:] + names[:i])[:size]
+
+
+class OnlinePoller:
+    """Выбор пользователей для statsonlineiplist и сборка online.json.
+
+    Пользователи с лимитом устройств опрашиваются каждый раз (если их не
+    больше ONLINE_BATCH), остальные онлайн — по кругу на оставшиеся места.
+    Для тех, до кого очередь не дошла, остаются IP прошлых опросов:
+    active_ips всё равно отбрасывает устаревшие по времени.
+    """
+
+    def __init__(self, batch: int):
+        self.batch = max(1, batch)
+        self._cursors = {'limited': '', 'rest': ''}
+
+    def pick(self, names: list, limited: set) -> list:
+        groups = {
+            'limited': [n for n in names if n in limited],
+            'rest': [n for n in names if n not in limited],
+        }
+        picked = []
+        for group, members in groups.items():
+            chunk = rotate(members, self._cursors[group], self.batch - len(picked))
+            if chunk:
+                self._cursors[group] = chunk[-1]
+            picked += chunk
+        return picked
+
+    @staticmethod
+    def merge(names: list, fresh: dict, previous: dict) -> dict:
+        users = {}
+        for name in names:
+            if name in fresh:
+                users[name] = fresh[name]
+            else:
+                prev = previous.get(name) or {'conns': 0, 'ips': {}}
+                users[name] = {'conns': max(1, prev['conns']), 'ips': prev['ips']}
+        return users
+
+    async def query(self) -> dict:
+        reply = json.loads(await engine_api('statsgetallonlineusers') or '{}')
+        names = sorted({online_user_name(u) for u in reply.get('users') or ()})
+        if not names:
+            return {}
+        limited = {n for n, m in users_meta.get().items() if m['devices']}
+        picked = self.pick(names, limited)
+        out = await engine_exec('env', f'S={ENGINE_API}', 'sh', '-c', ONLINE_QUERY, 'sh', *picked, timeout=60)
+        fresh = parse_online(parse_json_stream(out))
+        return self.merge(names, fresh, online_snapshot.get().get('users', {}))
+
+
+online_snapshot = FileSnapshot(ONLINE_FILE, lambda f: json.load(f) if f else {'users': {}})
+online_poller = OnlinePoller(ONLINE_BATCH)
+
+
+def active_ips(entry: dict, now: float) -> list:
+    """IP, с которых пользователь был активен за последние два опроса."""
+    return [ip for ip, seen in entry.get('ips', {}).items() if now - seen <= 2 * ONLINE_INTERVAL]
+
+
+async def online_collector(app):
+    """Опрашивает онлайн-статистику engine, пишет online.json и выключает
+    пользователей, у которых активных IP больше лимита устройств."""
+    failing = False
+    while True:
+        await asyncio.sleep(ONLINE_INTERVAL)
+        try:
+            online = await online_poller.query()
+            now = int(time.time())
+            await asyncio.to_thread(write_json, ONLINE_FILE, {'updated': now, 'users': online})
+            failing = False
+        except Exception as e:
+            if not failing:
+                logger.warning(f'online stats: {e}')
+            failing = True
+            continue
+        try:
+            await enforce_devices(app.bot, online, now)
+        except Exception as e:
+            logger.error(f'devices: {e}')
+
+
+def online_report(limit: int = 30) -> str:
+    snap = online_snapshot.get()
+    if not snap.get('updated'):
+        return "🟢 Данные о подключениях ещё не собраны."
+    users = get_user_map()
+    rows = sorted(
+        ((n, u) for n, u in snap.get('users', {}).items() if n in users),
+        key=lambda r: (-len(r[1]['ips']), r[0])
+    )
+    updated = datetime.fromtimestamp(snap['updated']).strftime('%H:%M:%S')
+    if not rows:
+        return f"🟢 <b>Онлайн</b> (обновлено {updated})\nНикто не подключён."
+    lines = [f"{'Пользователь':<16} {'Подкл.':>6} {'IP':>4}"]
+    for name, u in rows[:limit]:
+        lines.append(f"{name[:16]:<16} {u['conns']:>6} {len(u['ips']):>4}")
+    if len(rows) > limit:
+        lines.append(f"… и ещё {len(rows) - limit}")
+    return (
+        f"🟢 <b>Онлайн</b>: {len(rows)} польз., {sum(u['conns'] for _, u in rows)} подкл. "
+        f"(обновлено {updated})\n<pre>{html.escape(chr(10).join(lines))}</pre>"
+    )
+
+
+# --- Квоты и сроки пользователей ---
+USER_STATES = {
+    'ON': '✅ включён',
+    'OFF': '⛔ выключен вручную',
+    'quota': '📉 превышена квота',
+    'expired': '⌛ срок истёк',
+    'devices': '📱 превышен лимит устройств',
+}
+META_HEADER = (
+    '# имя квота(байт в месяц) срок(unix time) состояние(ON|OFF|quota|expired|devices) устройства\n'
+    '# 0 — без ограничения. quota/expired выставляет и снимает бот, devices — только выставляет.\n'
+)
+META_DEFAULT = {'quota': 0, 'expires': 0, 'state': 'ON', 'devices': 0}
+
+
+def parse_users_meta(f) -> dict:
+    result = {}
+    for line in f or ():
+        fields = line.split()
+        if len(fields) < 4 or fields[0].startswith('#'):
+            continue
+        try:
+            result[fields[0]] = {
+                'quota': int(fields[1]), 'expires': int(fields[2]), 'state': fields[3],
+                'devices': int(fields[4]) if len(fields) > 4 else 0,
+            }
+        except ValueError:
+            continue
+    return result
+
+
+users_meta = FileSnapshot(USERS_META_FILE, parse_users_meta)
+
+
+def user_meta(name: str) -> dict:
+    return dict(users_meta.get().get(name, META_DEFAULT))
+
+
+def update_users_meta(changes: dict):
+    """changes: {имя: {поле: значение}}. Записи без ограничений удаляются."""
+    def transform(lines):
+        meta = parse_users_meta(lines)
+        for name, fields in changes.items():
+            meta[name] = {**META_DEFAULT, **meta.get(name, {}), **fields}
+        return [META_HEADER] + [
+            f"{name} {m['quota']} {m['expires']} {m['state']} {m['devices']}\n"
+            for name, m in sorted(meta.items()) if m != META_DEFAULT
+        ]
+
+    locked_rewrite(USERS_META_FILE, transform)
+
+
+def engine_clients() -> tuple:
+    """(имена клиентов inbound в engine.conf — кто сейчас подключается,
+    есть ли у engine API xray). У sing-box клиенты — users с name."""
     try:
-        proc = subprocess.Popen(
-            cmd, shell=True, executable='/bin/bash',
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        out, err = proc.communicate(timeout=timeout)
-        out_s = out.decode(errors='ignore').strip()
-        err_s = err.decode(errors='ignore').strip()
-        if proc.returncode != 0 and err_s:
-            combined = out_s + '\n' + err_s
-        else:
-            combined = out_s
-        return proc.returncode, combined.strip()
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        return 1, "Команда заняла слишком много времени."
-    except Exception as e:
-        return 1, str(e)
+        with open(ENGINE_FILE, encoding='utf-8') as f:
+            conf = json.load(f)
+    except (OSError, ValueError):
+        return set(), False
+    names = set()
+    for i in conf.get('inbounds', []):
+        if i.get('tag') == 'inbound':
+            for c in i.get('settings', {}).get('clients', []) + i.get('users', []):
+                names.add(c.get('email') or c.get('name'))
+    return names, 'api' in conf
 
 
-def apply_reconfigure():
-    _, out = run_script('')
-    return out
+async def disable_users(reasons: dict, bot=None):
+    """reasons: {имя: OFF | quota | expired | devices}. Пользователь сразу
+    удаляется из работающего engine через API (rmu), см. kick_users."""
+    await asyncio.to_thread(update_users_meta, {n: {'state': r} for n, r in reasons.items()})
+    await kick_users(set(reasons), bot)
 
 
-def read_config():
-    conf = {}
-    if not os.path.exists(CONFIG_FILE):
-        return conf
-    try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            for l in f:
-                l = l.strip()
-                if '=' in l and not l.startswith('#'):
-                    k, v = l.split("=", 1)
-                    conf[k.strip()] = v.strip().strip('"').strip("'")
-    except:
-        pass
-    return conf
+async def kick_users(names: set, bot=None):
+    """Убирает выключенных из engine. engine.conf генерирует только скрипт:
+    бот удаляет клиентов из работающего xray (rmu) и ставит reconfigure,
+    который пересоберёт engine.conf по users.meta, чтобы перезапуск engine
+    их не вернул. У sing-box API нет — там применяет только reconfigure."""
+    clients, has_api = engine_clients()
+    present = names & clients
+    if not present:
+        return
+    if has_api:
+        try:
+            await engine_api('rmu', '-tag=inbound', *sorted(present))
+        except Exception as e:
+            logger.warning(f'rmu {", ".join(sorted(present))}: {e}')
+    reconfigure.submit(bot, None, f"выключение: {', '.join(sorted(present))}")
 
 
-def write_config(key: str, value: str):
-    """Атомарная запись key=value. Безопасна для любых значений."""
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(CONFIG_FILE):
-        open(CONFIG_FILE, 'a').close()
-    try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        found = False
-        new_lines = []
-        for line in lines:
-            if line.strip().startswith(f'{key}='):
-                new_lines.append(f'{key}={value}\n')
-                found = True
+def month_usage(name: str) -> int:
+    return sum(traffic_snapshot.get().get('users', {}).get(name, {}).get('month', [0, 0]))
+
+
+def limit_verdict(name: str, meta: dict, now: float):
+    """Какое состояние должно быть у пользователя по квоте и сроку."""
+    if meta['expires'] and meta['expires'] <= now:
+        return 'expired'
+    if meta['quota'] and month_usage(name) >= meta['quota']:
+        return 'quota'
+    return 'ON'
+
+
+async def enforce_limits(bot=None, chat_id=None) -> tuple:
+    """Выключает превысивших квоту и истёкших, включает обратно тех, у кого
+    ограничение снято (новый месяц, увеличена квота, продлён срок).
+    Выключенные вручную (OFF) и за лимит устройств (devices) не трогаются:
+    их включает админ. Трафик берётся из traffic.json.
+
+    Включение идёт через очередь reconfigure: с chat_id ход применения
+    виден в этом чате, без него (фоновая проверка) админы получают
+    уведомление."""
+    meta = users_meta.get()
+    users = get_user_map()
+    now = time.time()
+    disable, enable = {}, []
+    for name, m in meta.items():
+        if name not in users or m['state'] in ('OFF', 'devices'):
+            continue
+        verdict = limit_verdict(name, m, now)
+        if m['state'] == 'ON' and verdict != 'ON':
+            disable[name] = verdict
+        elif m['state'] != 'ON' and verdict != m['state']:
+            if verdict == 'ON':
+                enable.append(name)
             else:
-                new_lines.append(line)
-        if not found:
-            new_lines.append(f'{key}={value}\n')
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            f.writelines(new_lines)
-    except Exception as e:
-        logger.error(f'write_config({key}): {e}')
+                disable[name] = verdict
+    if disable:
+        await disable_users(disable, bot)
+    # Выключенные, которые всё ещё в engine.conf (его перезаписал скрипт,
+    # запущенный до обновления users.meta)
+    await kick_users({n for n, m in meta.items() if m['state'] != 'ON' and n in users} - set(disable), bot)
+    if enable:
+        await asyncio.to_thread(update_users_meta, {n: {'state': 'ON'} for n in enable})
+        # Скрипт вернёт их в engine через API (adu), без перезапуска
+        reconfigure.submit(bot, chat_id, f"включение: {', '.join(sorted(enable))}")
+    if bot and chat_id is None and (disable or enable):
+        lines = [f"{name}: {USER_STATES[r]}" for name, r in sorted(disable.items())]
+        lines += [f"{name}: {USER_STATES['ON']}" for name in sorted(enable)]
+        await notify_admins(bot, "👮 Ограничения пользователей:\n" + '\n'.join(lines))
+    return disable, enable
 
 
-def get_users():
-    """Читает список пользователей из файла напрямую."""
-    users = []
+async def enforce_devices(bot, online: dict, now: float) -> dict:
+    """Выключает включённых пользователей, у которых активных IP больше лимита."""
+    meta = users_meta.get()
+    over = {}
+    for name, m in meta.items():
+        if m['state'] == 'ON' and m['devices'] and name in online:
+            ips = active_ips(online[name], now)
+            if len(ips) > m['devices']:
+                over[name] = ips
+    if over:
+        await disable_users({name: 'devices' for name in over}, bot)
+        await notify_admins(bot, "📱 Превышен лимит устройств, пользователи выключены:\n" + '\n'.join(
+            f"{name}: {len(ips)} IP ({', '.join(sorted(ips)[:5])})" for name, ips in sorted(over.items())
+        ))
+    return over
+
+
+async def limits_enforcer(app):
+    while True:
+        await asyncio.sleep(LIMITS_INTERVAL)
+        if not users_meta.get():
+            continue
+        try:
+            await enforce_limits(app.bot)
+        except Exception as e:
+            logger.error(f'limits: {e}')
+
+
+def parse_quota(text: str):
+    """'50' или '50G' -> байты, '500M', '1.5T'; 0 — без квоты. None — не разобрано."""
+    m = re.match(r'^\s*(\d+(?:[.,]\d+)?)\s*([KMGT]?)(?:I?B)?\s*$', text.upper())
+    if not m:
+        return None
+    unit = {'K': 1, 'M': 2, 'G': 3, 'T': 4}.get(m.group(2) or 'G')
+    return int(float(m.group(1).replace(',', '.')) * 1024 ** unit)
+
+
+def parse_expires(text: str):
+    """'2026-12-31' (включительно), '30' — дней от сейчас, 0 — бессрочно."""
+    text = text.strip()
+    if text == '0':
+        return 0
+    if text.isdigit():
+        return int(time.time()) + int(text) * 86400
+    try:
+        day = datetime.strptime(text, '%Y-%m-%d')
+    except ValueError:
+        return None
+    return int(day.timestamp()) + 86400
+
+
+def limits_card(name: str) -> tuple:
+    m = user_meta(name)
+    used = month_usage(name)
+    quota = f" из {human_bytes(m['quota'])}" if m['quota'] else " (без квоты)"
+    online = online_snapshot.get().get('users', {}).get(name, {'conns': 0, 'ips': {}})
+    devices = f" из {m['devices']}" if m['devices'] else " (без лимита)"
+    expires = (
+        datetime.fromtimestamp(m['expires'] - 1).strftime('%Y-%m-%d') if m['expires'] else "бессрочно"
+    )
+    text = (
+        f"👤 <b>{html.escape(name)}</b>\n"
+        f"Состояние: {USER_STATES.get(m['state'], m['state'])}\n"
+        f"Трафик за месяц: {human_bytes(used)}{quota}\n"
+        f"Действует до: {expires}\n"
+        f"Сейчас: {online['conns']} подкл., IP {len(online['ips'])}{devices}"
+    )
+    toggle = (
+        InlineKeyboardButton("⛔ Выключить", callback_data=f"u_lim_t!{name}") if m['state'] == 'ON'
+        else InlineKeyboardButton("✅ Включить", callback_data=f"u_lim_t!{name}")
+    )
+    kb = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("📉 Квота", callback_data=f"u_lim_q!{name}"),
+            InlineKeyboardButton("⌛ Срок", callback_data=f"u_lim_e!{name}")
+        ],
+        [InlineKeyboardButton("📱 Устройства", callback_data=f"u_lim_d!{name}"), toggle],
+        [InlineKeyboardButton("🔙 Назад", callback_data="m_users")]
+    ])
+    return text, kb
+
+
+async def send_limits_card(bot, chat_id, name: str, note: str = ''):
+    text, kb = limits_card(name)
+    await bot.send_message(chat_id, (note + '\n\n' if note else '') + text, parse_mode="HTML", reply_markup=kb)
+
+
+# --- Ссылки клиентов ---
+# Повторяет build_client_link из reality-ezpz без запуска скрипта.
+# Транспорты, которые есть только в sing-box варианте скрипта
+# (tuic, hysteria2 как транспорт, shadowtls), отдаются скрипту.
+
+LINK_DEFAULTS = {
+    'protocol': 'vless',
+    'transport': 'tcp',
+    'domain': 'yahoo.com',
+    'port': '443',
+    'security': 'reality',
+}
+LINK_TRANSPORTS = ('tcp', 'http', 'grpc', 'ws', 'xhttp')
+
+
+def hy2_password(name: str, uuid: str) -> str:
+    """Пароль hysteria2: первые 16 hex-символов sha256(имя + uuid)."""
+    return hashlib.sha256(f'{name}{uuid}'.encode()).hexdigest()[:16]
+
+
+def render_link(conf: dict, name: str, uuid: str):
+    """Строит ссылку клиента. None — если формат знает только скрипт."""
+    c = {k: conf.get(k) or LINK_DEFAULTS.get(k, '') for k in (
+        'protocol', 'transport', 'domain', 'port', 'security', 'server',
+        'service_path', 'host_header', 'public_key', 'short_id', 'core'
+    )}
+    if not c['server'] or c['core'] == 'sing-box':
+        return None
+    if c['protocol'] == 'hysteria2':
+        params = f"sni={c['domain'] or c['server']}"
+        if c['security'] == 'selfsigned':
+            params += '&insecure=1'
+        return f"hy2://{hy2_password(name, uuid)}@{c['server']}:{c['port']}/?{params}#{name}"
+    t = c['transport']
+    if t not in LINK_TRANSPORTS:
+        return None
+    sec = c['security']
+    link = f"vless://{uuid}@{c['server']}:{c['port']}"
+    link += '?security=' + ('reality' if sec == 'reality' else 'none' if sec == 'notls' else 'tls')
+    link += f'&encryption=none&headerType=none&type={t}'
+    if sec != 'notls':
+        link += '&alpn=' + ('http/1.1' if t == 'ws' else 'h2,http/1.1')
+        link += f"&fp=chrome&sni={c['domain'].split(':')[0]}"
+        if t == 'tcp':
+            link += '&flow=xtls-rprx-vision'
+    if sec == 'reality':
+        link += f"&pbk={c['public_key']}&sid={c['short_id']}"
+    if t in ('ws', 'http', 'xhttp'):
+        link += f"&path=%2F{c['service_path']}"
+    if t == 'xhttp' and c['host_header']:
+        link += f"&host={c['host_header']}"
+    if t in ('ws', 'http'):
+        link += f"&host={c['host_header'] or c['server']}"
+    if t == 'xhttp':
+        link += '&mode=auto'
+    if t == 'grpc':
+        link += f"&mode=gun&serviceName={c['service_path']}"
+    return f'{link}#{name}'
+
+
+def ipv6_link(link: str, conf: dict, name: str, ipv6: str) -> str:
+    """IPv6 вариант ссылки — как sed в print_client_configuration."""
+    link = link.replace(f"@{conf.get('server', '')}:", f'@[{ipv6}]:', 1)
+    return link.replace(f'#{name}', f'#{name}-ipv6', 1)
+
+
+def read_address_cache() -> dict:
+    cache = {}
     try:
-        with open(USERS_FILE, encoding='utf-8') as f:
+        with open(ADDRESS_CACHE_FILE, encoding='utf-8') as f:
             for line in f:
-                line = line.strip()
-                if '=' in line and not line.startswith('#'):
-                    users.append(line.split('=', 1)[0].strip())
-    except FileNotFoundError:
+                if '=' in line:
+                    k, v = line.rstrip('\n').split('=', 1)
+                    cache[k] = v
+    except OSError:
         pass
-    return users
+    return cache
+
+
+def write_address_cache(cache: dict):
+    tmp = f'{ADDRESS_CACHE_FILE}.{os.getpid()}'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(f'{k}={v}\n' for k, v in cache.items())
+        os.replace(tmp, ADDRESS_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f'address cache: {e}')
+
+
+async def get_ipv6() -> str:
+    """Публичный IPv6 сервера (пусто, если его нет) из общего кеша со скриптом."""
+    cache = read_address_cache()
+    ttl = IPV6_TTL if cache.get('ipv6') else IPV6_NEGATIVE_TTL
+    try:
+        fresh = time.time() - int(cache.get('ipv6_time', '0')) < ttl
+    except ValueError:
+        fresh = False
+    if fresh:
+        return cache.get('ipv6', '')
+    ipv6 = ''
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'curl', '-fsSL', '-m', '5', '--ipv6', 'https://cloudflare.com/cdn-cgi/trace',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        out, _ = await proc.communicate()
+        for line in out.decode(errors='ignore').splitlines():
+            if line.startswith('ip='):
+                ipv6 = line.split('=', 1)[1].strip()
+    except Exception as e:
+        logger.warning(f'get_ipv6: {e}')
+    cache['ipv6'] = ipv6
+    cache['ipv6_time'] = str(int(time.time()))
+    write_address_cache(cache)
+    return ipv6
 
 
-def get_user_conf(name):
+async def get_user_conf(name):
     """Получает vless:// / tuic:// / hy2:// ссылки пользователя."""
-    _, out = run_script(f'--show-user {name}', timeout=120)
+    conf = read_config()
+    uuid = get_user_map().get(name)
+    link = render_link(conf, name, uuid) if uuid else None
+    if link:
+        result = [link]
+        ipv6 = await get_ipv6()
+        if ipv6:
+            result.append(ipv6_link(link, conf, name, ipv6))
+        return result
+    _, out = await run_script(f'--show-user {name}', timeout=120)
     result = []
     for line in out.splitlines():
         s = line.strip()
@@ -139,12 +1954,506 @@ def get_user_conf(name):
     return result
 
 
+# --- Подписки ---
+
+def sub_token(name: str) -> str:
+    """Токен подписки пользователя: HMAC-SHA256(SUB_SECRET, имя), 32 hex."""
+    return hmac.new(SUB_SECRET.encode(), name.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def sub_url(name: str, fmt: str = '') -> str:
+    url = f"{SUB_URL.rstrip('/')}/{name}/{sub_token(name)}"
+    return f'{url}?format={fmt}' if fmt else url
+
+
+def client_params(conf: dict) -> dict:
+    """Параметры подключения, общие для ссылки и JSON-конфигов (см. render_link)."""
+    c = {k: conf.get(k) or LINK_DEFAULTS.get(k, '') for k in (
+        'transport', 'domain', 'port', 'security', 'server',
+        'service_path', 'host_header', 'public_key', 'short_id'
+    )}
+    c['sni'] = c['domain'].split(':')[0]
+    c['path'] = '/' + c['service_path']
+    c['alpn'] = ['http/1.1'] if c['transport'] == 'ws' else ['h2', 'http/1.1']
+    c['flow'] = 'xtls-rprx-vision' if c['transport'] == 'tcp' and c['security'] != 'notls' else ''
+    return c
+
+
+def xray_client_config(c: dict, name: str, uuid: str) -> dict:
+    t = c['transport']
+    stream = {'network': t}
+    if c['security'] == 'reality':
+        stream['security'] = 'reality'
+        stream['realitySettings'] = {
+            'serverName': c['sni'], 'fingerprint': 'chrome',
+            'publicKey': c['public_key'], 'shortId': c['short_id'],
+        }
+    elif c['security'] != 'notls':
+        stream['security'] = 'tls'
+        stream['tlsSettings'] = {
+            'serverName': c['sni'], 'fingerprint': 'chrome', 'alpn': c['alpn'],
+            'allowInsecure': c['security'] == 'selfsigned',
+        }
+    if t == 'ws':
+        stream['wsSettings'] = {'path': c['path'], 'host': c['host_header'] or c['server']}
+    elif t == 'http':
+        stream['httpSettings'] = {'path': c['path'], 'host': [c['host_header'] or c['server']]}
+    elif t == 'xhttp':
+        stream['xhttpSettings'] = {'path': c['path'], 'host': c['host_header'], 'mode': 'auto'}
+    elif t == 'grpc':
+        stream['grpcSettings'] = {'serviceName': c['service_path']}
+    return {
+        'remarks': name,
+        'log': {'loglevel': 'warning'},
+        'inbounds': [
+            {'tag': 'socks', 'listen': '127.0.0.1', 'port': 10808, 'protocol': 'socks', 'settings': {'udp': True}},
+            {'tag': 'http', 'listen': '127.0.0.1', 'port': 10809, 'protocol': 'http'},
+        ],
+        'outbounds': [
+            {
+                'tag': 'proxy', 'protocol': 'vless',
+                'settings': {'vnext': [{
+                    'address': c['server'], 'port': int(c['port']),
+                    'users': [{'id': uuid, 'encryption': 'none', 'flow': c['flow']}],
+                }]},
+                'streamSettings': stream,
+            },
+            {'tag': 'direct', 'protocol': 'freedom'},
+        ],
+    }
+
+
+def singbox_client_config(c: dict, name: str, uuid: str):
+    """None — транспорт, которого нет в sing-box (xhttp)."""
+    t = c['transport']
+    outbound = {
+        'type': 'vless', 'tag': 'proxy', 'server': c['server'], 'server_port': int(c['port']),
+        'uuid': uuid, 'flow': c['flow'],
+    }
+    if c['security'] != 'notls':
+        tls = {
+            'enabled': True, 'server_name': c['sni'],
+            'utls': {'enabled': True, 'fingerprint': 'chrome'},
+        }
+        if c['security'] == 'reality':
+            tls['reality'] = {'enabled': True, 'public_key': c['public_key'], 'short_id': c['short_id']}
+        else:
+            tls['alpn'] = c['alpn']
+            tls['insecure'] = c['security'] == 'selfsigned'
+        outbound['tls'] = tls
+    if t == 'ws':
+        outbound['transport'] = {'type': 'ws', 'path': c['path'], 'headers': {'Host': c['host_header'] or c['server']}}
+    elif t == 'http':
+        outbound['transport'] = {'type': 'http', 'path': c['path'], 'host': [c['host_header'] or c['server']]}
+    elif t == 'grpc':
+        outbound['transport'] = {'type': 'grpc', 'service_name': c['service_path']}
+    elif t != 'tcp':
+        return None
+    return {
+        'log': {'level': 'warn'},
+        'inbounds': [{'type': 'mixed', 'tag': 'mixed-in', 'listen': '127.0.0.1', 'listen_port': 2080}],
+        'outbounds': [outbound, {'type': 'direct', 'tag': 'direct'}],
+        'route': {'final': 'proxy'},
+    }
+
+
+class SubscriptionServer:
+    """Подписки пользователей на asyncio-сервере в event loop бота.
+
+    Адрес: <BOT_SUB_URL>/<имя>/<токен>[?format=xray|sing-box], без format —
+    base64 со ссылками. Ответы всех включённых пользователей собираются
+    заранее, когда меняются config, users или users.meta (проверка — stat()
+    не чаще раза в секунду), и отдаются из памяти. Клиент с совпавшим
+    If-None-Match получает 304 без тела, формат, которого нет у этого
+    пользователя (например sing-box для xhttp), — 415.
+    """
+
+    FORMATS = {
+        'base64': 'text/plain; charset=utf-8',
+        'xray': 'application/json',
+        'sing-box': 'application/json',
+    }
+
+    def __init__(self, url: str):
+        self.prefix = urlsplit(url).path.rstrip('/') + '/'
+        self._docs = {}
+        self._key = None
+        self._checked = 0.0
+        self._rebuild = None
+        self._server = None
+
+    def _source_key(self):
+        # FileSnapshot возвращает тот же объект, пока файл не изменился
+        return id(config_snapshot.get()), id(users_snapshot.get()), id(users_meta.get())
+
+    async def docs(self) -> dict:
+        now = time.monotonic()
+        if now - self._checked >= 1:
+            self._checked = now
+            key = self._source_key()
+            if key != self._key and (self._rebuild is None or self._rebuild.done()):
+                self._rebuild = asyncio.create_task(self._build(key))
+                self._rebuild.add_done_callback(self._build_done)
+        if not self._docs and self._rebuild is not None:
+            # Ошибку сборки уже записал _build_done, отдаём что есть
+            await asyncio.wait({self._rebuild})
+        return self._docs
+
+    @staticmethod
+    def _build_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'subscriptions: build failed: {task.exception()!r}')
+
+    async def _build(self, key):
+        conf = config_snapshot.get()
+        meta = users_meta.get()
+        ipv6 = await get_ipv6()
+        c = client_params(conf)
+        now = time.time()
+        docs = {}
+        for name, uuid in users_snapshot.get().items():
+            m = meta.get(name, META_DEFAULT)
+            if m['state'] != 'ON' or (m['expires'] and m['expires'] <= now):
+                continue
+            try:
+                bodies = self._bodies(conf, c, name, uuid, ipv6)
+            except Exception as e:
+                logger.error(f'subscription {name}: {e!r}')
+                continue
+            if bodies:
+                docs[name] = {
+                    fmt: (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+                    for fmt, body in bodies.items()
+                }
+        self._docs = docs
+        self._key = key
+        logger.info(f'subscriptions: {len(docs)} users')
+
+    @staticmethod
+    def _bodies(conf: dict, c: dict, name: str, uuid: str, ipv6) -> dict:
+        """Тела ответов пользователя по форматам; пусто, если ссылки нет."""
+        link = render_link(conf, name, uuid)
+        if not link:
+            return {}
+        links = [link] + ([ipv6_link(link, conf, name, ipv6)] if ipv6 else [])
+        bodies = {'base64': base64.b64encode('\n'.join(links).encode())}
+        if link.startswith('vless://'):
+            bodies['xray'] = json.dumps(xray_client_config(c, name, uuid), indent=2).encode()
+            singbox = singbox_client_config(c, name, uuid)
+            if singbox:
+                bodies['sing-box'] = json.dumps(singbox, indent=2).encode()
+        return bodies
+
+    def _userinfo(self, name: str) -> str:
+        m = users_meta.get().get(name, META_DEFAULT)
+        up, down = traffic_snapshot.get().get('users', {}).get(name, {}).get('month', [0, 0])
+        return f"upload={up}; download={down}; total={m['quota']}; expire={m['expires']}"
+
+    @staticmethod
+    def request_format(target: str) -> str:
+        query = dict(p.split('=', 1) for p in urlsplit(target).query.split('&') if '=' in p)
+        return query.get('format', 'base64').replace('singbox', 'sing-box')
+
+    async def handle(self, method: bytes, target: str, headers: dict) -> tuple:
+        """(статус, заголовки, тело) для запроса подписки."""
+        parts = urlsplit(target)
+        fmt = self.request_format(target)
+        if method not in (b'GET', b'HEAD') or not parts.path.startswith(self.prefix):
+            return '404 Not Found', {}, b''
+        name, _, token = parts.path[len(self.prefix):].partition('/')
+        if not hmac.compare_digest(token.encode(), sub_token(name).encode()):
+            return '404 Not Found', {}, b''
+        user = (await self.docs()).get(name)
+        if user is None:
+            return '404 Not Found', {}, b''
+        if fmt not in user:
+            text = f'format {fmt} is not available; use one of: {", ".join(user)}\n'.encode()
+            return '415 Unsupported Media Type', {'Content-Type': 'text/plain; charset=utf-8'}, text
+        etag, body = user[fmt]
+        out = {
+            'Content-Type': self.FORMATS[fmt],
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+            'Profile-Update-Interval': str(SUB_UPDATE_HOURS),
+            'Subscription-Userinfo': self._userinfo(name),
+        }
+        if headers.get('if-none-match') == etag:
+            return '304 Not Modified', out, b''
+        return '200 OK', out, b'' if method == b'HEAD' else body
+
+    async def _serve(self, reader, writer):
+        status = '400 Bad Request'
+        fmt = 'unknown'
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = head.decode('latin-1').split('\r\n')
+            method, target = (lines[0].split(' ') + ['', ''])[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+            fmt = self.request_format(target)
+            if fmt not in self.FORMATS:
+                fmt = 'unknown'
+            status, out, body = await self.handle(method.encode(), target, headers)
+            out['Content-Length'] = str(len(body))
+            out['Connection'] = 'close'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'.encode()
+                + ''.join(f'{k}: {v}\r\n' for k, v in out.items()).encode()
+                + b'\r\n' + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f'subscription: {e}')
+            status = '500 Internal Server Error'
+        finally:
+            subscription_requests.inc(format=fmt, status=status.split()[0])
+            writer.close()
+
+    async def start(self, port: int):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, '0.0.0.0', port)
+            asyncio.create_task(self.docs())
+            logger.info(f'subscriptions on :{port}{self.prefix}')
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+subscriptions = SubscriptionServer(SUB_URL)
+
+
+async def send_subscription(bot, chat_id, name: str):
+    if not SUB_URL or not SUB_SECRET:
+        await bot.send_message(chat_id, "Подписки выключены: reality-ezpz --enable-subscription true.")
+        return
+    await send_link_qr(bot, chat_id, sub_url(name))
+    await bot.send_message(
+        chat_id,
+        f"📡 <b>Подписка {html.escape(name)}</b>\n"
+        f"Ссылки (v2rayN, Hiddify, Streisand): <code>{html.escape(sub_url(name))}</code>\n"
+        f"Xray JSON: <code>{html.escape(sub_url(name, 'xray'))}</code>\n"
+        f"sing-box JSON: <code>{html.escape(sub_url(name, 'sing-box'))}</code>\n"
+        "Клиент сам подтянет изменения сервера (порт, SNI, ключи).",
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="m_users")]])
+    )
+
+
+# --- QR-коды ---
+# qrcode + PNG-кодирование — чистый CPU, поэтому рендер уходит в пул
+# процессов, а не в поток: GIL не держит event loop. Готовые PNG и
+# file_id уже загруженных в Telegram фото кешируются по тексту ссылки.
+
+def render_qr_png(link: str) -> bytes:
+    """Рисует QR для ссылки и возвращает PNG. Выполняется в пуле процессов."""
+    bio = io.BytesIO()
+    qrcode.make(link).save(bio, "PNG")
+    return bio.getvalue()
+
+
+class QRCache:
+    """LRU кеш QR-кодов: ссылка -> PNG и file_id из Telegram.
+
+    Ограничен числом записей и возрастом: старые ссылки (сменился
+    порт, SNI, ключи) вытесняются сами, без явной инвалидации.
+    """
+
+    def __init__(self, size: int, ttl: int):
+        self.size = max(1, size)
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._pool = None
+
+    def _get(self, link: str):
+        item = self._items.get(link)
+        if item is None:
+            return None
+        if time.monotonic() - item['time'] > self.ttl:
+            del self._items[link]
+            return None
+        self._items.move_to_end(link)
+        return item
+
+    def _put(self, link: str, **fields):
+        item = self._items.get(link)
+        if item is None:
+            item = self._items[link] = {'png': None, 'file_id': None}
+        item.update(fields)
+        item['time'] = time.monotonic()
+        self._items.move_to_end(link)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def file_id(self, link: str):
+        item = self._get(link)
+        return item['file_id'] if item else None
+
+    def remember(self, link: str, file_id: str):
+        self._put(link, file_id=file_id)
+
+    def forget(self, link: str):
+        """Сбрасывает file_id, который Telegram больше не принимает."""
+        item = self._items.get(link)
+        if item:
+            item['file_id'] = None
+
+    async def png(self, link: str) -> bytes:
+        item = self._get(link)
+        if item and item['png']:
+            return item['png']
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=max(1, QR_WORKERS))
+        started = time.perf_counter()
+        data = await asyncio.get_running_loop().run_in_executor(self._pool, render_qr_png, link)
+        qr_render_seconds.observe(time.perf_counter() - started)
+        self._put(link, png=data)
+        return data
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+qr_cache = QRCache(QR_CACHE_SIZE, QR_CACHE_TTL)
+
+
+async def send_link_qr(bot, chat_id, link: str):
+    """Отправляет QR ссылки: по file_id, если он уже загружен, иначе PNG."""
+    caption = f"<code>{link[:1000]}</code>"
+    file_id = qr_cache.file_id(link)
+    if file_id:
+        try:
+            await bot.send_photo(chat_id, photo=file_id, caption=caption, parse_mode="HTML")
+            return
+        except Exception as e:
+            logger.warning(f'qr file_id rejected: {e}')
+            qr_cache.forget(link)
+    try:
+        png = await qr_cache.png(link)
+        msg = await bot.send_photo(chat_id, photo=png, caption=caption, parse_mode="HTML")
+        if msg.photo:
+            qr_cache.remember(link, msg.photo[-1].file_id)
+    except Exception:
+        await bot.send_message(chat_id, f"<code>{link[:3000]}</code>", parse_mode="HTML")
+
+
+# Telegram принимает в одном альбоме от 2 до 10 фото
+MEDIA_GROUP_SIZE = 10
+
+
+def retry_delay(e: RetryAfter) -> float:
+    delay = e.retry_after
+    return delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+
+
+async def send_qr_group(bot, chat_id, links: list):
+    """Один альбом из 2–10 QR. Уже загруженные фото уходят по file_id."""
+    media = []
+    for link in links:
+        photo = qr_cache.file_id(link) or await qr_cache.png(link)
+        media.append(InputMediaPhoto(photo, caption=f"<code>{link[:1000]}</code>", parse_mode="HTML"))
+    for attempt in range(QR_GROUP_RETRIES + 1):
+        try:
+            msgs = await bot.send_media_group(chat_id, media=media)
+            break
+        except RetryAfter as e:
+            if attempt == QR_GROUP_RETRIES:
+                raise
+            telegram_retries.inc(method='sendMediaGroup')
+            await asyncio.sleep(retry_delay(e))
+    for link, msg in zip(links, msgs):
+        if msg.photo:
+            qr_cache.remember(link, msg.photo[-1].file_id)
+
+
+async def send_qr_batch(bot, chat_id, links: list):
+    """Отправляет QR для списка ссылок минимальным числом запросов."""
+    links = [l for l in links if l]
+    for i in range(0, len(links), MEDIA_GROUP_SIZE):
+        chunk = links[i:i + MEDIA_GROUP_SIZE]
+        if i:
+            await asyncio.sleep(QR_GROUP_DELAY)
+        if len(chunk) == 1:
+            await send_link_qr(bot, chat_id, chunk[0])
+            continue
+        try:
+            await send_qr_group(bot, chat_id, chunk)
+            continue
+        except RetryAfter:
+            # Повторы исчерпаны: одиночные отправки упрутся в тот же лимит
+            raise
+        except Exception as e:
+            logger.warning(f'qr media group: {e}')
+        # Альбом не ушёл (например, протух file_id) — повтор с загрузкой PNG,
+        # затем по одному, чтобы не потерять ни одной ссылки
+        for link in chunk:
+            qr_cache.forget(link)
+        try:
+            await send_qr_group(bot, chat_id, chunk)
+        except RetryAfter:
+            raise
+        except Exception:
+            for link in chunk:
+                await asyncio.sleep(QR_GROUP_DELAY / MEDIA_GROUP_SIZE)
+                await send_link_qr(bot, chat_id, link)
+
+
+async def send_user_confs(bot, chat_id, confs: list, name: str = None):
+    await send_qr_batch(bot, chat_id, confs)
+    kb = [[InlineKeyboardButton("🔙 Назад", callback_data="m_users")]]
+    if name:
+        row = [InlineKeyboardButton("⚙️ Квота и срок", callback_data=f"u_lim!{name}")]
+        if SUB_URL:
+            row.append(InlineKeyboardButton("📡 Подписка", callback_data=f"u_sub!{name}"))
+        kb.insert(0, row)
+    await bot.send_message(chat_id, "↩️ Вернуться к пользователям", reply_markup=InlineKeyboardMarkup(kb))
+
+
+async def export_all_qr(bot, chat_id):
+    """QR-коды всех пользователей альбомами по 10 фото.
+
+    Ссылки строятся без скрипта (collect_links); пользователи, чьи ссылки
+    знает только скрипт, пропускаются — на каждого был бы свой --show-user.
+    """
+    links, missing = collect_links()
+    if not links and not missing:
+        await bot.send_message(chat_id, "Список пуст.")
+        return
+    msg = await bot.send_message(chat_id, f"📦 Готовлю QR для {len(links)} пользователей...")
+    ipv6 = await get_ipv6() if links else ''
+    conf = read_config()
+    confs = []
+    for name, link in links:
+        confs.append(link)
+        if ipv6:
+            confs.append(ipv6_link(link, conf, name, ipv6))
+    await bot.delete_message(chat_id, msg.message_id)
+    if missing:
+        await bot.send_message(
+            chat_id,
+            f"⚠️ Без QR ({len(missing)}): {html.escape(', '.join(missing[:50]))}"
+            f"{' …' if len(missing) > 50 else ''}\n"
+            "Их ссылки — в карточке пользователя или в экспорте ссылок.",
+            parse_mode="HTML"
+        )
+    await send_user_confs(bot, chat_id, confs)
+
+
 def make_backup():
     ts = datetime.now().strftime("%Y-%m-%d_%H-%M")
     fname = f"/tmp/backup_{ts}.zip"
     try:
         with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as z:
-            for f in ['config', 'users']:
+            for f in ['config', 'users', 'users.meta']:
                 p = os.path.join(DATA_DIR, f)
                 if os.path.exists(p):
                     z.write(p, arcname=f)
@@ -154,7 +2463,25 @@ def make_backup():
 
 
 # --- Декоратор доступа ---
+# Чаты админов, писавших боту с момента запуска: туда уходят уведомления
+admin_chats = set()
+
+
+async def notify_admins(bot, text: str):
+    """Сообщение админам: в известные чаты и по числовым id из BOT_ADMIN."""
+    chats = set(admin_chats)
+    chats.update(int(x) for x in (a.strip() for a in ADMIN.split(',')) if x.isdigit())
+    for chat_id in chats:
+        try:
+            await bot.send_message(chat_id, text)
+        except TelegramError as e:
+            logger.warning(f'notify {chat_id}: {e}')
+
+
 def restricted(func):
+    """Пускает к обработчику только админов; остальные не попадают и в метрики
+    (restricted стоит снаружи observed). /start открыт всем, как и раньше."""
+    @functools.wraps(func)
     async def wrap(update: Update, context: ContextTypes.DEFAULT_TYPE, *a, **kw):
         u = update.effective_user
         if not u:
@@ -164,6 +2491,8 @@ def restricted(func):
         uname = (u.username or '').lstrip('@')
         admins = {x.strip().lstrip('@') for x in ADMIN.split(',') if x.strip()}
         if uid in admins or (uname and uname in admins):
+            if update.effective_chat:
+                admin_chats.add(update.effective_chat.id)
             return await func(update, context, *a, **kw)
         await context.bot.send_message(chat_id=update.effective_chat.id, text="⛔ Нет доступа")
     return wrap
@@ -200,6 +2529,8 @@ async def send_settings_menu(bot, chat_id, text=None):
             f"Path: <code>/{c.get('service_path','')}</code>\n"
             f"WARP: <b>{warp}</b>"
         )
+        if reconfigure.depth():
+            text += f"\n⏳ Очередь применения: {reconfigure.depth()}"
     warp_btn = InlineKeyboardButton(
         "WARP OFF" if warp == "ON" else "WARP ON",
         callback_data="warp_off" if warp == "ON" else "sub!warp"
@@ -246,8 +2577,17 @@ async def menu_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ],
         [
             InlineKeyboardButton("➖ Удалить", callback_data="u_del_m"),
-            InlineKeyboardButton("🔙 Назад", callback_data="main")
-        ]
+            InlineKeyboardButton("📦 QR всех", callback_data="u_export")
+        ],
+        [
+            InlineKeyboardButton("📥 Импорт", callback_data="u_import"),
+            InlineKeyboardButton("🔗 Ссылки всех", callback_data="u_links")
+        ],
+        [
+            InlineKeyboardButton("📊 Трафик", callback_data="u_traffic"),
+            InlineKeyboardButton("🟢 Онлайн", callback_data="u_online")
+        ],
+        [InlineKeyboardButton("🔙 Назад", callback_data="main")]
     ]
     await context.bot.send_message(
         update.effective_chat.id,
@@ -258,23 +2598,72 @@ async def menu_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @restricted
-async def users_action(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str):
-    users = get_users()
-    kb = []
-    cb = "u_show" if mode == "show" else "u_del"
-    if not users:
+async def users_action(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str, cursor: str = ''):
+    """Страница списка пользователей. Листание редактирует то же сообщение."""
+    items, start, prev, nxt = user_index.page(cursor)
+    total = len(user_index.names)
+    if not total:
         await context.bot.send_message(update.effective_chat.id, "Список пуст.")
         return
-    for u in users:
-        kb.append([InlineKeyboardButton(u, callback_data=f"{cb}!{u}")])
-    kb.append([InlineKeyboardButton("🔙 Назад", callback_data="m_users")])
+    cb = "u_show" if mode == "show" else "u_del"
+    kb = [
+        [InlineKeyboardButton(u, callback_data=f"{cb}!{u}") for u in items[i:i + 2]]
+        for i in range(0, len(items), 2)
+    ]
+    nav = []
+    if prev is not None:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"u_pg!{mode}!{prev}"))
+    if nxt is not None:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"u_pg!{mode}!{nxt}"))
+    if nav:
+        kb.append(nav)
+    kb.append([
+        InlineKeyboardButton("🔍 Поиск", callback_data=f"u_find!{mode}"),
+        InlineKeyboardButton("🔙 Назад", callback_data="m_users")
+    ])
+    text = f"Выберите пользователя ({start + 1}–{start + len(items)} из {total}):"
+    if cursor and update.callback_query:
+        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        return
     await context.bot.send_message(
         update.effective_chat.id,
-        "Выберите пользователя:",
+        text,
         reply_markup=InlineKeyboardMarkup(kb)
     )
 
 
+async def send_search_results(bot, chat_id, query: str, mode: str = "show"):
+    items, total = user_index.find(query)
+    cb = "u_show" if mode == "show" else "u_del"
+    kb = [
+        [InlineKeyboardButton(u, callback_data=f"{cb}!{u}") for u in items[i:i + 2]]
+        for i in range(0, len(items), 2)
+    ]
+    kb.append([
+        InlineKeyboardButton("🔍 Ещё поиск", callback_data=f"u_find!{mode}"),
+        InlineKeyboardButton("🔙 Назад", callback_data="m_users")
+    ])
+    if not total:
+        text = f"По запросу «{query}» никого нет."
+    elif total > len(items):
+        text = f"Найдено {total}, показаны первые {len(items)} — уточните запрос:"
+    else:
+        text = f"Найдено {total}:"
+    await bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(kb))
+
+
+@restricted
+@observed
+async def find_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <часть имени> — поиск пользователя по префиксу и подстроке."""
+    query = ' '.join(context.args or []).strip()
+    if not query:
+        context.user_data["state"] = "find_user"
+        await update.message.reply_text("Введите часть имени пользователя:")
+        return
+    await send_search_results(context.bot, update.effective_chat.id, query)
+
+
 @restricted
 async def ask_input(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str):
     context.user_data["state"] = "setting"
@@ -302,37 +2691,27 @@ async def apply_setting(update: Update, context: ContextTypes.DEFAULT_TYPE, para
     chat_id = update.effective_chat.id
     if param == "warp_license":
         # WARP+ — передаём лицензию аргументом, скрипт сам создаст аккаунт
-        await context.bot.send_message(chat_id, "⏳ Включаю WARP+...\nМожет занять 1–2 минуты.")
-        rc, out = run_script(f'--warp-license {val}', timeout=240)
-    elif param == "service_path" and (val == "/" or val == ""):
-        write_config("service_path", "")
-        await context.bot.send_message(chat_id, "⏳ Применяю настройки...")
-        rc, out = run_script()
-    else:
-        write_config(param, val)
-        await context.bot.send_message(chat_id, "⏳ Применяю настройки...")
-        rc, out = run_script()
-    snippet = out if len(out) < 3900 else out[:3900] + "\n...(truncated)"
-    await context.bot.send_message(
-        chat_id,
-        f"✅ Готово.\n<blockquote>{snippet}</blockquote>",
-        parse_mode="HTML"
+        await schedule_reconfigure(
+            context.bot, chat_id, "WARP+",
+            "⏳ Включаю WARP+...\nМожет занять 1–2 минуты.",
+            f'--warp-license {val}', timeout=240
+        )
+        return
+    if param == "service_path" and (val == "/" or val == ""):
+        val = ""
+    if not await ConfigTransaction().set(param, val).apply():
+        await context.bot.send_message(chat_id, CONFIG_BUSY)
+        return
+    await schedule_reconfigure(
+        context.bot, chat_id, f"{param}={val}", "⏳ Применяю настройки..."
     )
-    await send_settings_menu(context.bot, chat_id)
 
 
 @restricted
 async def do_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    await context.bot.send_message(chat_id, "⏳ Перезапуск служб...")
-    out = apply_reconfigure()
-    snippet = out if len(out) < 3900 else out[:3900] + "\n...(truncated)"
-    await context.bot.send_message(
-        chat_id,
-        f"✅ Перезапуск завершён.\n<blockquote>{snippet}</blockquote>",
-        parse_mode="HTML"
+    await schedule_reconfigure(
+        context.bot, update.effective_chat.id, "перезапуск служб", "⏳ Перезапуск служб..."
     )
-    await send_settings_menu(context.bot, chat_id)
 
 
 @restricted
@@ -353,6 +2732,7 @@ async def do_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @restricted
+@observed
 async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -373,6 +2753,18 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await users_action(update, context, "show")
     elif cmd == "u_del_m":
         await users_action(update, context, "del")
+    elif cmd == "u_pg":
+        await users_action(update, context, arg, arg2)
+    elif cmd == "u_find":
+        context.user_data["state"] = "find_user"
+        context.user_data["find_mode"] = arg or "show"
+        await context.bot.send_message(
+            chat_id,
+            "Введите часть имени пользователя:",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("Отмена", callback_data="m_users")]]
+            )
+        )
     elif cmd == "u_add":
         context.user_data["state"] = "add_user"
         await context.bot.send_message(
@@ -383,28 +2775,81 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         )
     elif cmd == "u_show":
-        confs = get_user_conf(arg)
-        for c in confs:
-            if not c:
-                continue
-            try:
-                qr = qrcode.make(c)
-                bio = io.BytesIO()
-                qr.save(bio, "PNG")
-                bio.seek(0)
-                await context.bot.send_photo(
-                    chat_id,
-                    photo=bio,
-                    caption=f"<code>{c[:1000]}</code>",
-                    parse_mode="HTML"
+        confs = await get_user_conf(arg)
+        await send_user_confs(context.bot, chat_id, confs, arg)
+    elif cmd == "u_lim":
+        await send_limits_card(context.bot, chat_id, arg)
+    elif cmd == "u_sub":
+        await send_subscription(context.bot, chat_id, arg)
+    elif cmd in ("u_lim_q", "u_lim_e", "u_lim_d"):
+        context.user_data["state"] = {
+            "u_lim_q": "user_quota", "u_lim_e": "user_expires", "u_lim_d": "user_devices"
+        }[cmd]
+        context.user_data["limit_user"] = arg
+        prompt = {
+            "u_lim_q": "Квота трафика в месяц: <code>50</code> (ГиБ), <code>500M</code>, <code>1.5T</code>; 0 — без квоты.",
+            "u_lim_e": "Срок действия: дата <code>2026-12-31</code> (включительно), число дней <code>30</code>; 0 — бессрочно.",
+            "u_lim_d": "Сколько IP может быть подключено одновременно; 0 — без лимита.",
+        }[cmd]
+        await context.bot.send_message(
+            chat_id, prompt, parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена", callback_data=f"u_lim!{arg}")]])
+        )
+    elif cmd == "u_lim_t":
+        if arg not in get_user_map():
+            await context.bot.send_message(chat_id, "Пользователь не найден.")
+        elif user_meta(arg)['state'] == 'ON':
+            await disable_users({arg: 'OFF'}, context.bot)
+            await send_limits_card(context.bot, chat_id, arg, "⛔ Выключен, подключения сброшены.")
+        else:
+            verdict = limit_verdict(arg, user_meta(arg), time.time())
+            if verdict != 'ON':
+                await send_limits_card(
+                    context.bot, chat_id, arg, f"⚠️ {USER_STATES[verdict]}: сначала измените квоту или срок."
                 )
-            except Exception:
-                await context.bot.send_message(chat_id, f"<code>{c[:3000]}</code>", parse_mode="HTML")
+            else:
+                await asyncio.to_thread(update_users_meta, {arg: {'state': 'ON'}})
+                await schedule_reconfigure(context.bot, chat_id, f"включение {arg}", f"✅ {arg} будет включён.")
+    elif cmd == "u_export":
+        await export_all_qr(context.bot, chat_id)
+    elif cmd == "u_links":
+        await export_links_document(context.bot, chat_id)
+    elif cmd in ("u_traffic", "u_online"):
+        text = traffic_report() if cmd == "u_traffic" else online_report()
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Обновить", callback_data=f"{cmd}!r")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="m_users")]
+        ])
+        if arg == "r":
+            try:
+                await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
+            except BadRequest as e:
+                if 'not modified' not in str(e):
+                    raise
+        else:
+            await context.bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=kb)
+    elif cmd == "u_import":
+        kb = [
+            [
+                InlineKeyboardButton("➕ Добавить из файла", callback_data="u_imp!add"),
+                InlineKeyboardButton("➖ Удалить по файлу", callback_data="u_imp!del")
+            ],
+            [InlineKeyboardButton("🔙 Назад", callback_data="m_users")]
+        ]
+        await context.bot.send_message(
+            chat_id,
+            "📥 Список пользователей — CSV или TXT, по имени в строке.\n"
+            "Для добавления после имени через запятую можно указать uuid.",
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+    elif cmd == "u_imp":
+        context.user_data["state"] = "import_users"
+        context.user_data["import_mode"] = arg
         await context.bot.send_message(
             chat_id,
-            "↩️ Вернуться к пользователям",
+            "Отправьте файл (или вставьте список текстом):",
             reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Назад", callback_data="m_users")]]
+                [[InlineKeyboardButton("Отмена", callback_data="m_users")]]
             )
         )
     elif cmd == "u_del":
@@ -420,7 +2865,7 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(kb)
         )
     elif cmd == "confirm_del":
-        run_script(f"--delete-user {arg}")
+        await run_script(f"--delete-user {arg}")
         await context.bot.send_message(chat_id, "Удалён.")
         await menu_users(update, context)
     elif cmd == "ask":
@@ -428,16 +2873,10 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif cmd == "set":
         await apply_setting(update, context, arg, arg2)
     elif cmd == "warp_off":
-        write_config("warp", "OFF")
-        await context.bot.send_message(chat_id, "⏳ Отключаю WARP...")
-        rc, out = run_script()
-        snippet = out if len(out) < 3900 else out[:3900] + "\n...(truncated)"
-        await context.bot.send_message(
-            chat_id,
-            f"✅ WARP отключён.\n<blockquote>{snippet}</blockquote>",
-            parse_mode="HTML"
-        )
-        await send_settings_menu(context.bot, chat_id)
+        if not await ConfigTransaction().set("warp", "OFF").apply():
+            await context.bot.send_message(chat_id, CONFIG_BUSY)
+            return
+        await schedule_reconfigure(context.bot, chat_id, "WARP OFF", "⏳ Отключаю WARP...")
     elif cmd == "sub":
         if arg == "core":
             kb = [
@@ -480,17 +2919,18 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     elif cmd == "warp_free":
         # Пишем warp=ON без лицензии — скрипт сам создаёт аккаунт
-        write_config("warp", "ON")
-        write_config("warp_license", "")
-        await context.bot.send_message(chat_id, "⏳ Включаю WARP...\nМожет занять 1–2 минуты.")
-        rc, out = run_script(timeout=240)
-        snippet = out if len(out) < 3900 else out[:3900] + "\n...(truncated)"
-        await context.bot.send_message(
-            chat_id,
-            f"✅ WARP включён.\n<blockquote>{snippet}</blockquote>",
-            parse_mode="HTML"
+        if not await ConfigTransaction().set("warp", "ON").set("warp_license", "").apply():
+            await context.bot.send_message(chat_id, CONFIG_BUSY)
+            return
+        await schedule_reconfigure(
+            context.bot, chat_id, "WARP ON",
+            "⏳ Включаю WARP...\nМожет занять 1–2 минуты.", timeout=240
         )
-        await send_settings_menu(context.bot, chat_id)
+    elif cmd == "cancel":
+        if arg.isdigit() and executor.cancel(int(arg)):
+            await context.bot.send_message(chat_id, "⛔ Останавливаю...")
+        else:
+            await context.bot.send_message(chat_id, "Операция уже завершена.")
     elif cmd == "do_restart":
         await do_restart(update, context)
     elif cmd == "do_backup":
@@ -498,6 +2938,7 @@ async def cb_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @restricted
+@observed
 async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = context.user_data.pop("state", None)
     text = update.message.text.strip()
@@ -507,30 +2948,35 @@ async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Недопустимое имя.")
             return
         await update.message.reply_text("Создаю пользователя...")
-        run_script(f"--add-user {text}")
+        await run_script(f"--add-user {text}")
         await update.message.reply_text(f"✅ Создан: {text}")
-        confs = get_user_conf(text)
-        for c in confs:
-            try:
-                qr = qrcode.make(c)
-                bio = io.BytesIO()
-                qr.save(bio, "PNG")
-                bio.seek(0)
-                await context.bot.send_photo(
-                    chat_id,
-                    photo=bio,
-                    caption=f"<code>{c[:1000]}</code>",
-                    parse_mode="HTML"
-                )
-            except Exception:
-                await context.bot.send_message(chat_id, f"<code>{c[:3000]}</code>", parse_mode="HTML")
-        await context.bot.send_message(
-            chat_id,
-            "↩️ Вернуться к пользователям",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🔙 Назад", callback_data="m_users")]]
-            )
-        )
+        confs = await get_user_conf(text)
+        await send_user_confs(context.bot, chat_id, confs, text)
+    elif state in ("user_quota", "user_expires", "user_devices"):
+        name = context.user_data.pop("limit_user", "")
+        if state == "user_quota":
+            field, value = 'quota', parse_quota(text)
+        elif state == "user_expires":
+            field, value = 'expires', parse_expires(text)
+        else:
+            field, value = 'devices', int(text) if text.isdigit() else None
+        if value is None or name not in get_user_map():
+            await update.message.reply_text("❌ Не удалось разобрать значение.")
+            return
+        await asyncio.to_thread(update_users_meta, {name: {field: value}})
+        disabled, enabled = await enforce_limits(context.bot, chat_id)
+        note = "✅ Сохранено."
+        if name in disabled:
+            note += f" {USER_STATES[disabled[name]]} — пользователь выключен."
+        elif name in enabled:
+            note += " Ограничение снято — пользователь включается."
+        await send_limits_card(context.bot, chat_id, name, note)
+    elif state == "import_users":
+        mode = context.user_data.pop("import_mode", "add")
+        await import_users(context.bot, chat_id, text, mode)
+    elif state == "find_user":
+        mode = context.user_data.pop("find_mode", "show")
+        await send_search_results(context.bot, chat_id, text, mode)
     elif state == "setting":
         param = context.user_data.pop("param", None)
         if param == "port" and not text.isdigit():
@@ -549,18 +2995,145 @@ async def msg_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await apply_setting(update, context, key, text)
 
 
+@restricted
+@observed
+async def doc_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загруженный файл — список пользователей для импорта или удаления."""
+    chat_id = update.effective_chat.id
+    if context.user_data.get("state") != "import_users":
+        await update.message.reply_text("Чтобы импортировать пользователей, сначала выберите «📥 Импорт».")
+        return
+    context.user_data.pop("state", None)
+    mode = context.user_data.pop("import_mode", "add")
+    doc = update.message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("❌ Файл слишком большой.")
+        return
+    tg_file = await doc.get_file()
+    data = await tg_file.download_as_bytearray()
+    await import_users(context.bot, chat_id, bytes(data).decode('utf-8-sig', errors='replace'), mode)
+
+
+async def webhook_watchdog(app):
+    """Следит за доставкой webhook. Если Telegram дважды подряд сообщает
+    об ошибке при непустой очереди (или webhook сброшен), бот
+    останавливается и main() перезапускает его в режиме polling."""
+    failures = 0
+    while True:
+        await asyncio.sleep(WEBHOOK_CHECK)
+        try:
+            info = await app.bot.get_webhook_info()
+        except Exception as e:
+            logger.warning(f'webhook info: {e}')
+            continue
+        recent_error = (
+            info.last_error_date is not None
+            and info.pending_update_count > 0
+            and (datetime.now(timezone.utc) - info.last_error_date).total_seconds() < 2 * WEBHOOK_CHECK
+        )
+        failures = failures + 1 if (info.url != WEBHOOK_URL or recent_error) else 0
+        if failures >= 2:
+            logger.error(
+                f'webhook is not delivering ({info.last_error_message or "url reset"}), '
+                'switching to polling'
+            )
+            app.bot_data['webhook_failed'] = True
+            app.stop_running()
+            return
+
+
+async def post_init(app):
+    # Фоновое обновление локальной копии скрипта. post_init вызывается
+    # повторно, если бот переходит с webhook на polling.
+    task = app.bot_data.get('script_refresh')
+    if task is None or task.done():
+        app.bot_data['script_refresh'] = asyncio.create_task(script_cache.refresh_loop())
+    if app.bot_data.get('mode') == 'webhook':
+        app.bot_data['webhook_watchdog'] = asyncio.create_task(webhook_watchdog(app))
+    task = app.bot_data.get('traffic_collector')
+    if STATS_INTERVAL > 0 and (task is None or task.done()):
+        app.bot_data['traffic_collector'] = asyncio.create_task(traffic_collector())
+    task = app.bot_data.get('online_collector')
+    if ONLINE_INTERVAL > 0 and (task is None or task.done()):
+        app.bot_data['online_collector'] = asyncio.create_task(online_collector(app))
+    task = app.bot_data.get('limits_enforcer')
+    if LIMITS_INTERVAL > 0 and (task is None or task.done()):
+        app.bot_data['limits_enforcer'] = asyncio.create_task(limits_enforcer(app))
+    if SUB_URL and SUB_SECRET:
+        try:
+            await subscriptions.start(SUB_PORT)
+        except OSError as e:
+            logger.error(f'subscriptions: {e}')
+    if METRICS_PORT:
+        try:
+            await metrics.start(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            logger.error(f'metrics: {e}')
+
+
+async def post_shutdown(app):
+    qr_cache.shutdown()
+    await metrics.stop()
+    await subscriptions.stop()
+
+
+@observed
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_main_menu(context.bot, update.effective_chat.id)
 
 
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    # concurrent_updates: долгий reconfigure не задерживает остальные нажатия
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if METRICS_PORT:
+        # Те же размеры пулов, что ApplicationBuilder выставляет по умолчанию
+        builder = (
+            builder
+            .request(MetricsRequest(connection_pool_size=256))
+            .get_updates_request(MetricsRequest(connection_pool_size=1))
+        )
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_handler))
+    app.add_handler(CommandHandler("find", find_handler))
     app.add_handler(CallbackQueryHandler(cb_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, msg_handler))
+    app.add_handler(MessageHandler(filters.Document.ALL, doc_handler))
     logger.info("Bot started.")
+    if WEBHOOK_URL and run_webhook(app):
+        return
+    app.bot_data['mode'] = 'polling'
     app.run_polling(drop_pending_updates=True)
 
 
+def run_webhook(app) -> bool:
+    """Webhook за haproxy: TLS снимает haproxy, бот слушает http на WEBHOOK_PORT.
+
+    False — webhook не поднялся или перестал доставлять обновления;
+    тогда вызывающий переключается на polling (getUpdates сам удаляет webhook).
+    """
+    app.bot_data['mode'] = 'webhook'
+    try:
+        app.run_webhook(
+            listen='0.0.0.0',
+            port=WEBHOOK_PORT,
+            url_path=urlsplit(WEBHOOK_URL).path.lstrip('/'),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            cert=WEBHOOK_CERT or None,
+            drop_pending_updates=True,
+            close_loop=False
+        )
+    except Exception as e:
+        logger.error(f'webhook mode failed: {e}; falling back to polling')
+        return False
+    return not app.bot_data.pop('webhook_failed', False)
+
+
 if __name__ == "__main__":
     main()